@@ -0,0 +1,137 @@
+"""Сравнение кодеков данных между задачами: время кодирования/чтения и размер на батчах фильмов
+
+Запуск в окружении Airflow (в контейнере воркера):
+    python benchmarks/bench_codecs.py --rows 500 5000 --repeat 5
+Кодеки без установленных пакетов пропускаются; размер (ratio) - относительно прежнего формата old-json.
+"""
+from typing import Callable, Dict, List, Tuple
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "dags"))
+
+from airflow.exceptions import AirflowException  # noqa: E402
+
+from settings import PAYLOAD_CODECS, PAYLOAD_CODEC_MSGPACK  # noqa: E402
+from utils.codecs import encode, decode  # noqa: E402
+from utils.dim_cache import NESTED_COLUMNS  # noqa: E402
+
+# прежний формат: json.dumps(indent=4), вложенные списки дополнительно закодированы строками JSON
+OLD_JSON = "old-json"
+
+WORDS = "star war night king city love dark lost last man world story time dream blood road".split()
+GENRES = [{"id": str(uuid.uuid4()), "name": name} for name in ("Action", "Drama", "Comedy", "Sci-Fi", "Documentary")]
+PERSONS = [{"id": str(uuid.uuid4()), "full_name": f"Person {i}"} for i in range(2000)]
+
+
+def _text(words: int) -> str:
+    return " ".join(random.choice(WORDS) for _ in range(words)).capitalize()
+
+
+def make_films(rows: int) -> List[Dict]:
+    """Батч в формате RealDictCursor: uuid - UUID, numeric - Decimal, timestamptz - datetime, json - списки"""
+    updated_at = datetime.now(timezone.utc) - timedelta(seconds=rows)
+    films = []
+    for i in range(rows):
+        films.append({
+            "id": uuid.uuid4(),
+            "title": _text(3),
+            "description": _text(random.randint(10, 60)),
+            "rating": Decimal(f"{random.uniform(1, 10):.1f}"),
+            "type": random.choice(["movie", "tv_show"]),
+            "created_at": updated_at - timedelta(days=1),
+            "updated_at": updated_at + timedelta(seconds=i, microseconds=random.randint(0, 999_999)),
+            "genre": random.sample(GENRES, random.randint(1, 3)),
+            "actors": random.sample(PERSONS, random.randint(3, 15)),
+            "writers": random.sample(PERSONS, random.randint(1, 3)),
+            "directors": random.sample(PERSONS, 1),
+        })
+    return films
+
+
+def _old_json_encode(films: List[Dict]) -> str:
+    films = [
+        {column: json.dumps(value) if column in NESTED_COLUMNS else value for column, value in film.items()}
+        for film in films
+    ]
+    return json.dumps(films, indent=4, default=str)
+
+
+def _old_json_decode(payload: str) -> List[Dict]:
+    return [
+        {column: json.loads(value) if column in NESTED_COLUMNS else value for column, value in film.items()}
+        for film in json.loads(payload)
+    ]
+
+
+def _codec_functions(codec: str) -> Tuple[Callable, Callable]:
+    """Кодирование и чтение для строки таблицы"""
+    if codec == OLD_JSON:
+        return _old_json_encode, _old_json_decode
+    return (lambda films: encode(films, codec)), (lambda payload: decode(payload, codec))
+
+
+def _expected(codec: str, films: List[Dict]) -> List[Dict]:
+    """Результат чтения без потерь для кодека: JSON-кодеки возвращают строки и числа вместо UUID/Decimal/datetime"""
+    if codec.startswith(PAYLOAD_CODEC_MSGPACK):
+        return films
+    if codec == OLD_JSON:
+        return json.loads(json.dumps(films, default=str))
+    return decode(encode(films, "json"), "json")
+
+
+def bench(codec: str, films: List[Dict], repeat: int) -> Dict:
+    """Медианное время кодирования и чтения, размер строки для XCom"""
+    encode_films, decode_payload = _codec_functions(codec)
+    encode_times, decode_times = [], []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        payload = encode_films(films)
+        encode_times.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        result = decode_payload(payload)
+        decode_times.append(time.perf_counter() - start)
+    assert result == _expected(codec, films), f"{codec} round trip changed data"
+    return {
+        "encode_ms": statistics.median(encode_times) * 1000,
+        "decode_ms": statistics.median(decode_times) * 1000,
+        "bytes": len(payload.encode("utf-8")),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, nargs="+", default=[500, 5000])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--codecs", nargs="+", default=PAYLOAD_CODECS, choices=PAYLOAD_CODECS)
+    args = parser.parse_args()
+
+    random.seed(0)
+    print(f"{'rows':>6} {'codec':<14} {'encode ms':>10} {'decode ms':>10} {'bytes':>12} {'ratio':>6}")
+    for rows in args.rows:
+        films = make_films(rows)
+        # размер - относительно прежнего формата
+        baseline = None
+        for codec in [OLD_JSON, *args.codecs]:
+            try:
+                result = bench(codec, films, args.repeat)
+            except AirflowException as err:
+                print(f"{rows:>6} {codec:<14} skipped: {err}")
+                continue
+            baseline = baseline or result["bytes"]
+            print(
+                f"{rows:>6} {codec:<14} {result['encode_ms']:>10.2f} {result['decode_ms']:>10.2f} "
+                f"{result['bytes']:>12} {result['bytes'] / baseline:>6.2f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
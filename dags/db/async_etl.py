@@ -0,0 +1,355 @@
+from typing import AsyncIterator, Callable, Dict, List, Tuple
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+import asyncio
+import json
+import logging
+import math
+import sqlite3
+import uuid
+
+import pendulum
+from airflow.models.taskinstance import TaskInstance
+from airflow.hooks.base_hook import BaseHook
+from airflow.exceptions import AirflowException
+
+from settings import (
+    DBFields,
+    SQLiteDBTables,
+    MOVIES_UPDATED_STATE_KEY_TMP,
+    DT_FMT,
+    DT_FMT_PG,
+    SOURCE_MODE_DIM_CACHE,
+    SOURCE_MODE_JOIN,
+    WRITE_BATCH_SIZE,
+    ASYNC_QUEUE_SIZE,
+    ASYNC_MIN_BATCHES,
+)
+from db.es import (
+    ES_SOURCE_SORT,
+    _es_hosts,
+    _prepare_query_with_updated_state,
+    _get_transformed_items,
+    _get_index_profile,
+    _get_index_schema,
+    es_transform,
+)
+from db.pg import (
+    _get_films_query as _pg_get_films_query,
+    _get_poll_table as _pg_get_poll_table,
+    _get_create_table_query,
+    pg_transform,
+)
+from db.sqlite import (
+    _db_path,
+    _get_films_query as _sqlite_get_films_query,
+    _get_updated_state as _sqlite_get_updated_state,
+    _placeholders,
+    _prepare_create_query,
+    _prepare_insert_query,
+    _prepare_insert_values_list,
+)
+from db.file import _get_out_path, _write_parquet, _write_ndjson, file_transform
+from utils.async_pipeline import run_pipeline
+from utils.state import get_updated_state, set_updated_state
+from utils.chunk_tuner import get_chunk_size
+
+
+def _import_asyncpg():
+    """Импорт asyncpg (нужен для Postgres в режиме async)"""
+    try:
+        import asyncpg
+    except ImportError:
+        raise AirflowException("asyncpg is required for the async execution mode with Postgres")
+    return asyncpg
+
+
+def _import_aiosqlite():
+    """Импорт aiosqlite (нужен для SQLite в режиме async)"""
+    try:
+        import aiosqlite
+    except ImportError:
+        raise AirflowException("aiosqlite is required for the async execution mode with SQLite")
+    return aiosqlite
+
+
+def _import_async_es():
+    """Импорт асинхронного клиента Elasticsearch"""
+    try:
+        from elasticsearch import AsyncElasticsearch
+        from elasticsearch.helpers import async_bulk
+    except ImportError:
+        raise AirflowException("elasticsearch[async] is required for the async execution mode with Elasticsearch")
+    return AsyncElasticsearch, async_bulk
+
+
+async def _pg_connect(conn_id: str):
+    """Подключение asyncpg по Airflow Admin Connection"""
+    asyncpg = _import_asyncpg()
+    conn = BaseHook.get_connection(conn_id)
+    return await asyncpg.connect(
+        host=conn.host,
+        port=conn.port or 5432,
+        user=conn.login,
+        password=conn.password,
+        database=conn.schema,
+    )
+
+
+def _batches(items: List, batch_size: int):
+    """Разбиение списка на батчи"""
+    for start in range(0, len(items), batch_size):
+        yield items[start:start + batch_size]
+
+
+# Источники: асинхронные генераторы батчей в формате *_get_films_data
+
+async def _read_pg(ti: TaskInstance, state: Dict, batch_size: int, **context) -> AsyncIterator[List[Dict]]:
+    """Чтение фильмов из Postgres (asyncpg)"""
+    params = context["params"]
+    schema = params["id_db_params"]["schema"]
+    source_mode = params.get("source_mode") or SOURCE_MODE_JOIN
+    if source_mode == SOURCE_MODE_DIM_CACHE:
+        logging.warning("Source mode %s is not supported in async mode, using %s", source_mode, SOURCE_MODE_JOIN)
+        source_mode = SOURCE_MODE_JOIN
+
+    query = _pg_get_films_query(schema, params["fields"], source_mode).replace("IN %(id)s", "= ANY($1::uuid[])")
+    uses_dt_fmt = "%(dt_fmt)s" in query
+    query = query.replace("%(dt_fmt)s", "$2")
+
+    updated_state = get_updated_state(**context)
+    logging.info("Movies updated state: %s", updated_state)
+
+    conn = await _pg_connect(params["in_db_id"])
+    try:
+        await conn.set_type_codec("json", encoder=json.dumps, decoder=json.loads, schema="pg_catalog")
+        # контрольная точка - время в часовом поясе сессии источника, как в режиме tasks (psycopg2)
+        session_tz = await conn.fetchval("SHOW TimeZone")
+        since = (
+            pendulum.parse(updated_state, tz=session_tz) if updated_state
+            else datetime.min.replace(tzinfo=timezone.utc)
+        )
+        poll_table, id_column = _pg_get_poll_table(schema, source_mode)
+        items = await conn.fetch(
+            f"""
+            SELECT {id_column} AS id, updated_at
+            FROM {poll_table}
+            WHERE updated_at >= $1
+            ORDER BY updated_at
+            LIMIT $2;
+            """,
+            since,
+            get_chunk_size(**context),
+        )
+        for batch in _batches(items, batch_size):
+            args = [[item["id"] for item in batch]] + ([DT_FMT_PG] if uses_dt_fmt else [])
+            records = await conn.fetch(query, *args)
+            yield [
+                {k: str(v) if isinstance(v, uuid.UUID) else v for k, v in record.items()}
+                for record in records
+            ]
+            # asyncpg отдает timestamptz в UTC - состояние сохраняется в поясе сессии
+            state["updated_at"] = pendulum.instance(batch[-1]["updated_at"]).in_timezone(session_tz).strftime(DT_FMT)
+    finally:
+        await conn.close()
+
+
+async def _read_sqlite(ti: TaskInstance, state: Dict, batch_size: int, **context) -> AsyncIterator[List[Dict]]:
+    """Чтение фильмов из SQLite (aiosqlite)"""
+    aiosqlite = _import_aiosqlite()
+    params = context["params"]
+    query = _sqlite_get_films_query(params["fields"])
+    updated_state = _sqlite_get_updated_state(**context)
+
+    db_name = BaseHook.get_connection(params["in_db_id"]).schema
+    async with aiosqlite.connect(_db_path(db_name)) as conn:
+        conn.row_factory = sqlite3.Row
+        cursor = await conn.execute(
+            f"""
+            SELECT id, updated_at
+            FROM {SQLiteDBTables.film.value}
+            WHERE updated_at >= ?
+            ORDER BY updated_at
+            LIMIT ?
+            """,
+            (updated_state, get_chunk_size(**context)),
+        )
+        items = await cursor.fetchall()
+        for batch in _batches(items, batch_size):
+            film_ids = [item["id"] for item in batch]
+            cursor = await conn.execute(query.format(placeholders=_placeholders(film_ids)), film_ids)
+            yield [dict(row) for row in await cursor.fetchall()]
+            state["updated_at"] = str(batch[-1]["updated_at"])
+
+
+async def _read_es(ti: TaskInstance, state: Dict, batch_size: int, **context) -> AsyncIterator[List[Dict]]:
+    """Чтение фильмов из Elasticsearch (AsyncElasticsearch)"""
+    AsyncElasticsearch, _ = _import_async_es()
+    params = context["params"]
+    client = AsyncElasticsearch(hosts=_es_hosts(BaseHook.get_connection(params["in_db_id"])))
+    try:
+        items = await client.search(
+            index=params["id_db_params"]["index"],
+            query=_prepare_query_with_updated_state(**context),
+            sort=ES_SOURCE_SORT,
+            size=get_chunk_size(**context),
+            track_total_hits=False,
+        )
+        items = _get_transformed_items(items["hits"]["hits"], params["fields"])
+        for batch in _batches(items, batch_size):
+            yield batch
+            state["updated_at"] = batch[-1].get(DBFields.film_updated_at.value)
+    finally:
+        await client.close()
+
+
+# Приемники: асинхронные контекстные менеджеры, отдают функцию записи батча
+
+@asynccontextmanager
+async def _pg_sink(ti: TaskInstance, **context):
+    """Запись в Postgres (asyncpg executemany)"""
+    params = context["params"]
+    schema, table = params["out_db_params"]["schema"], params["out_db_params"]["table"]
+    fields = params["fields"]
+    columns = [DBFields[field].value for field in fields]
+    timestamp_columns = {DBFields.film_created_at.value, DBFields.film_updated_at.value}
+    # время передается строкой и приводится Postgres: источники отдают разные форматы (микросекунды, смещение +00)
+    placeholders = [
+        f"${i}::text::timestamptz" if column in timestamp_columns else f"${i}"
+        for i, column in enumerate(columns, start=1)
+    ]
+    query = f"""
+        INSERT INTO {schema}.{table} ({", ".join(columns)})
+        VALUES ({", ".join(placeholders)})
+        ON CONFLICT (id) DO UPDATE
+        SET {", ".join(f"{column} = EXCLUDED.{column}" for column in columns)};
+        """
+
+    def to_value(column, value):
+        if column in timestamp_columns and value is not None:
+            return str(value)
+        return value
+
+    conn = await _pg_connect(params["out_db_id"])
+    try:
+        # вложенные списки приходят структурами - кодируются в json драйвером
+        await conn.set_type_codec("json", encoder=json.dumps, decoder=json.loads, schema="pg_catalog")
+        await conn.execute(f"CREATE SCHEMA IF NOT EXISTS {schema}")
+        await conn.execute(_get_create_table_query(schema, table, fields))
+
+        async def write(batch: List[Dict]):
+            await conn.executemany(
+                query, [tuple(to_value(column, rec[column]) for column in columns) for rec in batch]
+            )
+
+        yield write
+    finally:
+        await conn.close()
+
+
+@asynccontextmanager
+async def _es_sink(ti: TaskInstance, **context):
+    """Запись в Elasticsearch (async_bulk)"""
+    AsyncElasticsearch, async_bulk = _import_async_es()
+    params = context["params"]
+    index = params["out_db_params"]["index"]
+    profile = _get_index_profile(**context)
+    client = AsyncElasticsearch(hosts=_es_hosts(BaseHook.get_connection(params["out_db_id"])))
+    try:
+        if not await client.indices.exists(index=index):
+            await client.indices.create(index=index, body=_get_index_schema(params["fields"], profile))
+
+        async def write(batch: List[Dict]):
+            await async_bulk(
+                client,
+                [{"_index": index, "_id": film_data["id"], "_source": film_data} for film_data in batch],
+            )
+
+        yield write
+    finally:
+        await client.close()
+
+
+@asynccontextmanager
+async def _sqlite_sink(ti: TaskInstance, **context):
+    """Запись в SQLite (aiosqlite), таблица пересоздается как в sqlite_write"""
+    aiosqlite = _import_aiosqlite()
+    db_name = BaseHook.get_connection(context["params"]["out_db_id"]).schema
+    async with aiosqlite.connect(_db_path(db_name)) as conn:
+        await conn.execute(f"DROP TABLE IF EXISTS {SQLiteDBTables.film.value};")
+        await conn.execute(_prepare_create_query())
+        await conn.commit()
+
+        async def write(batch: List[Dict]):
+            values_list, fields = _prepare_insert_values_list(batch)
+            await conn.executemany(_prepare_insert_query(batch, fields), values_list)
+            await conn.commit()
+
+        yield write
+
+
+@asynccontextmanager
+async def _file_sink(ti: TaskInstance, **context):
+    """Запись в файлы (parquet / NDJSON.gz) в пуле потоков"""
+    loop = asyncio.get_event_loop()
+    file_format = (context["params"]["out_db_params"] or {}).get("format", "parquet")
+    batch_number = 0
+
+    async def write(batch: List[Dict]):
+        nonlocal batch_number
+        path = _get_out_path(ti, batch_number, **context)
+        batch_number += 1
+        if file_format == "parquet":
+            await loop.run_in_executor(None, _write_parquet, batch, context["params"]["fields"], path)
+        else:
+            await loop.run_in_executor(None, _write_ndjson, batch, path)
+
+    yield write
+
+
+ASYNC_SOURCES = {
+    "postgres": _read_pg,
+    "sqlite": _read_sqlite,
+    "elasticsearch": _read_es,
+}
+
+ASYNC_SINKS: Dict[str, Tuple[Callable, Callable]] = {
+    "postgres": (pg_transform, _pg_sink),
+    "elasticsearch": (es_transform, _es_sink),
+    "sqlite": (lambda films_data: films_data, _sqlite_sink),
+    "fs": (file_transform, _file_sink),
+}
+
+
+def _get_batch_size(**context) -> int:
+    """Размер батча конвейера: не больше write_batch_size и не меньше ASYNC_MIN_BATCHES батчей на chunk"""
+    write_batch_size = context["params"].get("write_batch_size") or WRITE_BATCH_SIZE
+    # при одном батче стадии выполняются по очереди и не перекрываются
+    return max(1, min(write_batch_size, math.ceil(get_chunk_size(**context) / ASYNC_MIN_BATCHES)))
+
+
+async def _run(ti: TaskInstance, state: Dict, in_type: str, out_type: str, **context):
+    """Запуск конвейера для пары источник/приемник"""
+    batch_size = _get_batch_size(**context)
+    logging.info("Async pipeline batch size: %s", batch_size)
+    transform, sink = ASYNC_SINKS[out_type]
+    async with sink(ti, **context) as write:
+        source = ASYNC_SOURCES[in_type](ti, state, batch_size, **context)
+        await run_pipeline(source, transform, write, ASYNC_QUEUE_SIZE)
+
+
+def async_etl(ti: TaskInstance, **context):
+    """Перенос данных одной задачей: чтение, преобразование и запись перекрываются во времени"""
+    in_type = BaseHook.get_connection(context["params"]["in_db_id"]).conn_type
+    out_type = BaseHook.get_connection(context["params"]["out_db_id"]).conn_type
+    if in_type not in ASYNC_SOURCES:
+        raise AirflowException("Unknown input db connection type %s", in_type)
+    if out_type not in ASYNC_SINKS:
+        raise AirflowException("Unknown output db connection type %s", out_type)
+
+    state = {}
+    asyncio.run(_run(ti, state, in_type, out_type, **context))
+
+    if state.get("updated_at"):
+        ti.xcom_push(key=MOVIES_UPDATED_STATE_KEY_TMP, value=state["updated_at"])
+        set_updated_state(state["updated_at"], **context)
@@ -0,0 +1,157 @@
+from typing import Dict, List, Optional
+import csv
+import json
+import logging
+import tempfile
+
+from airflow.models.taskinstance import TaskInstance
+from airflow.hooks.base_hook import BaseHook
+from airflow.hooks.postgres_hook import PostgresHook
+from airflow.exceptions import AirflowException
+from psycopg2.extras import RealDictCursor
+
+from settings import DBFields, PGDBTables, DT_FMT_PG, SOURCE_MODE_DIM_CACHE, SOURCE_MODE_JOIN, WRITE_BATCH_SIZE
+from db.pg import _get_films_query
+from db.sinks import SINKS, SINKS_PREPARE, SINKS_FINISH
+from utils.checkpoint import get_committed_batch, commit_batch
+from utils.dim_cache import NESTED_COLUMNS
+from utils.state import set_updated_state
+
+BACKFILL_SNAPSHOT_KEY = "backfill_snapshot"
+COPY_NULL = "\\N"
+
+
+def _get_sink(**context):
+    """Преобразование и запись батча для приемника out_db_id"""
+    conn_type = BaseHook.get_connection(context["params"]["out_db_id"]).conn_type
+    if conn_type not in SINKS:
+        raise AirflowException("Backfill is not supported for output db connection type %s", conn_type)
+    return SINKS[conn_type]
+
+
+def _decode_copy_row(row: Dict[str, str]) -> Dict:
+    """Преобразование строки COPY ... CSV в формат pg_get_films_data"""
+    film_data = {}
+    for column, value in row.items():
+        if value == COPY_NULL:
+            value = None
+        elif column in NESTED_COLUMNS:
+            value = json.loads(value)
+        elif column == DBFields.rating.value:
+            value = float(value)
+        film_data[column] = value
+    return film_data
+
+
+def backfill_prepare_sink(ti: TaskInstance, **context):
+    """Проверка пары источник/приемник и подготовка приемника"""
+    if BaseHook.get_connection(context["params"]["in_db_id"]).conn_type != "postgres":
+        raise AirflowException("Backfill source must be a Postgres connection")
+    _get_sink(**context)
+
+    conn_type = BaseHook.get_connection(context["params"]["out_db_id"]).conn_type
+    if conn_type in SINKS_PREPARE:
+        SINKS_PREPARE[conn_type](ti, **context)
+
+
+def backfill_plan(ti: TaskInstance, **context) -> List[Dict]:
+    """Точка снимка и разбиение film_work на диапазоны по id или updated_at"""
+    schema = context["params"]["id_db_params"]["schema"]
+    column = context["params"]["partition_by"]
+    partitions = context["params"]["partitions"]
+
+    pg_hook = PostgresHook(postgres_conn_id=context["params"]["in_db_id"])
+    pg_conn = pg_hook.get_conn()
+    cursor = pg_conn.cursor(cursor_factory=RealDictCursor)
+
+    # граница снимка - с микросекундами (иначе строки последней секунды не попадут в выгрузку),
+    # контрольная точка инкрементальной загрузки - в формате DT_FMT
+    cursor.execute(
+        f"""
+        SELECT MAX(updated_at)::text AS snapshot, TO_CHAR(MAX(updated_at), %s) AS checkpoint
+        FROM {schema}.{PGDBTables.film.value}
+        """,
+        (DT_FMT_PG,),
+    )
+    row = cursor.fetchone()
+    snapshot = row["snapshot"]
+    if snapshot is None:
+        logging.info("No records to backfill")
+        return []
+
+    cursor.execute(
+        f"""
+        SELECT percentile_disc(%s::float8[]) WITHIN GROUP (ORDER BY {column})::text[] AS bounds
+        FROM {schema}.{PGDBTables.film.value}
+        WHERE updated_at <= %s::timestamptz
+        """,
+        ([i / partitions for i in range(1, partitions)], snapshot),
+    )
+    bounds = []
+    for bound in cursor.fetchone()["bounds"] or []:
+        if not bounds or bounds[-1] != bound:
+            bounds.append(bound)
+    edges = [None] + bounds + [None]
+
+    ti.xcom_push(key=BACKFILL_SNAPSHOT_KEY, value=row["checkpoint"])
+    ranges = [{"lower": edges[i], "upper": edges[i + 1], "snapshot": snapshot} for i in range(len(edges) - 1)]
+    logging.info("Backfill snapshot %s, %s ranges by %s", snapshot, len(ranges), column)
+    return ranges
+
+
+def backfill_range(ti: TaskInstance, lower: Optional[str], upper: Optional[str], snapshot: str, **context):
+    """Выгрузка диапазона через COPY ... TO STDOUT и запись в приемник"""
+    params = context["params"]
+    column = params["partition_by"]
+    batch_size = params.get("write_batch_size") or WRITE_BATCH_SIZE
+    transform, write = _get_sink(**context)
+
+    where = ["fw.updated_at <= %(snapshot)s::timestamptz"]
+    if lower is not None:
+        where.append(f"fw.{column} >= %(lower)s")
+    if upper is not None:
+        where.append(f"fw.{column} < %(upper)s")
+    source_mode = params.get("source_mode") or SOURCE_MODE_JOIN
+    if source_mode == SOURCE_MODE_DIM_CACHE:
+        source_mode = SOURCE_MODE_JOIN
+    query = _get_films_query(params["id_db_params"]["schema"], params["fields"], source_mode, " AND ".join(where))
+
+    pg_hook = PostgresHook(postgres_conn_id=params["in_db_id"])
+    pg_conn = pg_hook.get_conn()
+    cursor = pg_conn.cursor()
+    copy_query = cursor.mogrify(
+        f"COPY ({query.strip().rstrip(';')}) TO STDOUT WITH (FORMAT csv, HEADER true, NULL '{COPY_NULL}')",
+        {"snapshot": snapshot, "lower": lower, "upper": upper, "dt_fmt": DT_FMT_PG},
+    ).decode()
+    logging.info("Backfill range [%s, %s) by %s", lower, upper, column)
+
+    committed = get_committed_batch(ti, **context)
+    with tempfile.TemporaryFile("w+", encoding="utf-8", newline="") as buffer:
+        cursor.copy_expert(copy_query, buffer)
+        pg_conn.close()
+        buffer.seek(0)
+
+        total, batch_index, batch = 0, 0, []
+        for row in csv.DictReader(buffer):
+            batch.append(_decode_copy_row(row))
+            if len(batch) == batch_size:
+                if batch_index > committed:
+                    write(ti, transform(batch), batch_index, **context)
+                    commit_batch(ti, batch_index, **context)
+                total, batch_index, batch = total + len(batch), batch_index + 1, []
+        if batch and batch_index > committed:
+            write(ti, transform(batch), batch_index, **context)
+            commit_batch(ti, batch_index, **context)
+        total += len(batch)
+    logging.info("Backfill range [%s, %s) completed, %s movies", lower, upper, total)
+
+
+def backfill_finish(ti: TaskInstance, **context):
+    """Перевод инкрементальной загрузки на точку снимка бэкфилла"""
+    conn_type = BaseHook.get_connection(context["params"]["out_db_id"]).conn_type
+    if conn_type in SINKS_FINISH:
+        SINKS_FINISH[conn_type](ti, **context)
+
+    snapshot = ti.xcom_pull(task_ids="backfill_plan", key=BACKFILL_SNAPSHOT_KEY)
+    if snapshot:
+        set_updated_state(snapshot, **context)
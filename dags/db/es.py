@@ -1,4 +1,4 @@
-from typing import List, Dict, Union
+from typing import List, Dict, Tuple, Union
 from datetime import datetime
 import copy
 import json
@@ -6,17 +6,37 @@ import logging
 
 from airflow.models.taskinstance import TaskInstance
 from airflow.hooks.base_hook import BaseHook
+from airflow.exceptions import AirflowException
 from airflow.providers.elasticsearch.hooks.elasticsearch import ElasticsearchPythonHook
 from elasticsearch import Elasticsearch, helpers
 
 from settings import (
     DBFields,
-    MOVIES_UPDATED_STATE_KEY,
     MOVIES_UPDATED_STATE_KEY_TMP,
     DT_FMT,
+    ES_INDEX_PROFILE_DEFAULT,
+    ES_INDEX_PROFILE_WRITE_HEAVY,
+    ES_INDEX_PROFILE_READ_INCREMENTAL,
+    ES_PAGE_SIZE,
+)
+from db_schemas.es import (
+    MOVIES_BASE,
+    MOVIE_FIELDS,
+    INDEX_PROFILES,
+    INDEX_SORT_FIELDS,
+    WRITE_HEAVY_SETTINGS,
+    SERVING_SETTINGS,
 )
-from db_schemas.es import MOVIES_BASE, MOVIE_FIELDS
 from utils import transform
+from utils.state import get_updated_state
+from utils.chunk_tuner import get_chunk_size
+from utils.checkpoint import load_staged, stage, pending_batches, commit_batch
+from utils.codecs import encode, decode
+from utils.log import summary, dump_payload
+from utils.dead_letter import add_dead_letters, resolve_dead_letters, get_dead_letter_ids, is_replay
+
+# настройки индекса до профиля write_heavy, возвращаются после загрузки
+ES_RESTORE_SETTINGS_KEY = "es_restore_settings"
 
 
 def _es_hosts(conn: BaseHook) -> List[str]:
@@ -32,14 +52,14 @@ def _get_es_connection(connection: str) -> ElasticsearchPythonHook:
     return es_conn
 
 
-def _prepare_query_with_updated_state(ti: TaskInstance) -> Dict:
+def _prepare_query_with_updated_state(**context) -> Dict:
     """Подготовка updated_state"""
-    updated_state = (
-            ti.xcom_pull(
-                key=MOVIES_UPDATED_STATE_KEY,
-            )
-            or datetime.min.strftime(DT_FMT)
-    )
+    if is_replay(**context):
+        ids = get_dead_letter_ids(**context)
+        logging.info("Replaying %s dead letters", len(ids))
+        return {"ids": {"values": ids}}
+
+    updated_state = get_updated_state(**context) or datetime.min.strftime(DT_FMT)
     logging.info("Movies updated state: %s", updated_state)
 
     query = {
@@ -71,42 +91,128 @@ def _get_transformed_items(init_items: List, fields: List[str]) -> List:
     return transformed_items
 
 
-def _get_index_schema(fields: List[str]) -> Dict:
+# порядок чтения источника: совпадает с сортировкой индекса профиля read_incremental;
+# unmapped_type - индексы, созданные без этих полей, читаются без ошибки "No mapping found"
+ES_SOURCE_SORT = [
+    {DBFields[field].value: {"order": "asc", "unmapped_type": MOVIE_FIELDS[field]["type"]}}
+    for field in INDEX_SORT_FIELDS
+]
+
+
+def _get_index_profile(**context) -> str:
+    """Профиль индекса приемника"""
+    return context["params"].get("es_index_profile") or ES_INDEX_PROFILE_DEFAULT
+
+
+def _get_index_schema(fields: List[str], profile: str = ES_INDEX_PROFILE_DEFAULT) -> Dict:
     """Подготовка schema"""
     filed_properties = {
         DBFields[k].value: v for k, v in MOVIE_FIELDS.items() if k in fields
     }
     schema = copy.deepcopy(MOVIES_BASE)
     schema["mappings"]["properties"] = filed_properties
+    schema["settings"].update(copy.deepcopy(INDEX_PROFILES[profile]))
+    if profile == ES_INDEX_PROFILE_READ_INCREMENTAL:
+        # поля сортировки индекса должны быть в маппинге
+        missing = [field for field in INDEX_SORT_FIELDS if field not in fields]
+        if missing:
+            raise AirflowException(f"Index profile {profile} requires fields {missing}")
+        schema["settings"]["sort"] = {
+            "field": [DBFields[field].value for field in INDEX_SORT_FIELDS],
+            "order": ["asc"] * len(INDEX_SORT_FIELDS),
+        }
     return schema
 
 
+def es_transform(films_data: List[Dict]) -> List[Dict]:
+    """Преобразование записей для Elasticsearch"""
+    transformed_films_data = []
+    for film_data in films_data:
+        transformed_film_data = {}
+        for fw_column, fw_value in film_data.items():
+            if fw_column == DBFields.genre.value:
+                fw_value = transform.get_genres(fw_value)
+            transformed_film_data[fw_column] = fw_value
+        transformed_films_data.append(transformed_film_data)
+    return transformed_films_data
+
+
 def es_get_films_data(ti: TaskInstance, **context) -> str:
     """Сбор обновленных данных"""
 
+    staged = load_staged(ti, ti.task_id, **context)
+    if staged:
+        staged_items = decode(staged)
+        if staged_items and not is_replay(**context):
+            ti.xcom_push(key=MOVIES_UPDATED_STATE_KEY_TMP, value=staged_items[-1]["updated_at"])
+        return staged
+
     # get es connection
     es_conn = _get_es_connection(context["params"]["in_db_id"])
 
-    query = _prepare_query_with_updated_state(ti)
+    query = _prepare_query_with_updated_state(**context)
     logging.info(query)
 
-    items = es_conn.search(
-        index=context["params"]["id_db_params"]["index"],
-        query=query,
-    )
-
-    items = items["hits"]["hits"]
-    logging.info(items)
+    # постраничное чтение по (updated_at, id): на отсортированном индексе поиск завершается досрочно
+    chunk_size = get_chunk_size(**context)
+    items, search_after = [], None
+    while len(items) < chunk_size:
+        response = es_conn.search(
+            index=context["params"]["id_db_params"]["index"],
+            query=query,
+            sort=ES_SOURCE_SORT,
+            size=min(ES_PAGE_SIZE, chunk_size - len(items)),
+            search_after=search_after,
+            track_total_hits=False,
+        )
+        hits = response["hits"]["hits"]
+        if not hits:
+            break
+        items.extend(hits)
+        search_after = hits[-1]["sort"]
+    logging.info("Found documents: %s", summary(items))
 
     transformed_items = _get_transformed_items(items, context["params"]["fields"])
-    logging.info(transformed_items)
+    logging.info("Films data: %s", summary(transformed_items))
+    dump_payload("films_data", transformed_items, **context)
 
-    if transformed_items:
+    if transformed_items and not is_replay(**context):
         ti.xcom_push(
             key=MOVIES_UPDATED_STATE_KEY_TMP,
             value=transformed_items[-1]["updated_at"],
         )
-    return json.dumps(transformed_items, indent=4)
+    return stage(ti, ti.task_id, encode(transformed_items), **context)
+
+
+def _get_setting(settings: Dict, path: Tuple[str, ...]):
+    """Значение вложенной настройки индекса (None, если не задана)"""
+    for key in path:
+        settings = settings.get(key) if isinstance(settings, dict) else None
+    return settings
+
+
+def _get_restore_settings(es_conn, index: str) -> Dict:
+    """Текущие значения настроек, которые меняет профиль write_heavy"""
+    response = es_conn.indices.get_settings(index=index, include_defaults=True)
+    index_settings = next(iter(response.values()))
+    explicit = index_settings.get("settings", {}).get("index", {})
+    defaults = index_settings.get("defaults", {}).get("index", {})
+
+    def current(*path):
+        value = _get_setting(explicit, path)
+        return _get_setting(defaults, path) if value is None else value
+
+    if str(current("refresh_interval")) == WRITE_HEAVY_SETTINGS["refresh_interval"]:
+        # индекс остался в настройках загрузки после сбоя - возвращаются настройки по умолчанию
+        logging.warning("Index %s already has write heavy settings, %s will be restored", index, SERVING_SETTINGS)
+        return SERVING_SETTINGS
+    restore = {
+        "number_of_replicas": current("number_of_replicas"),
+        "refresh_interval": current("refresh_interval"),
+        "translog": {"durability": current("translog", "durability")},
+    }
+    logging.info("Index %s settings before load: %s", index, restore)
+    return restore
 
 
 def es_create_index(ti: TaskInstance, **context):
@@ -114,13 +220,20 @@ def es_create_index(ti: TaskInstance, **context):
     conn = BaseHook.get_connection(context["params"]["out_db_id"])
     es_hook = ElasticsearchPythonHook(hosts=[f"http://{conn.host}:{conn.port}"])
     es_conn = es_hook.get_conn
+    profile = _get_index_profile(**context)
+    schema = _get_index_schema(context["params"]["fields"], profile)
     logging.info(context["params"]["fields"])
-    logging.info(_get_index_schema(context["params"]["fields"]))
+    logging.info(schema)
     response = es_conn.indices.create(
         index=context["params"]["out_db_params"]["index"],
-        body=_get_index_schema(context["params"]["fields"]),
+        body=schema,
         ignore=400,
     )
+    if profile == ES_INDEX_PROFILE_WRITE_HEAVY:
+        # индекс мог существовать - настройки загрузки выставляются явно, прежние возвращает es_finish_load
+        index = context["params"]["out_db_params"]["index"]
+        ti.xcom_push(key=ES_RESTORE_SETTINGS_KEY, value=_get_restore_settings(es_conn, index))
+        es_conn.indices.put_settings(index=index, settings=WRITE_HEAVY_SETTINGS)
     if "acknowledged" in response:
         if response["acknowledged"]:
             logging.info("Индекс создан: {}".format(response["index"]))
@@ -137,18 +250,58 @@ def es_preprocess(ti: TaskInstance, **context) -> Union[str, None]:
         logging.info("No records need to be updated")
         return
 
-    films_data = json.loads(films_data)
-    logging.info(f'{type(films_data)=}')
-    logging.info(f'{films_data=}')
-    transformed_films_data = []
-    for film_data in films_data:
-        transformed_film_data = {}
-        for fw_column, fw_value in film_data.items():
-            if fw_column == DBFields.genre.value:
-                fw_value = transform.get_genres(fw_value)
-            transformed_film_data[fw_column] = fw_value
-        transformed_films_data.append(transformed_film_data)
-    return json.dumps(transformed_films_data, indent=4)
+    films_data = es_transform(decode(films_data))
+    logging.info("Transformed films data: %s", summary(films_data))
+    dump_payload("films_data", films_data, **context)
+    return encode(films_data)
+
+
+def _get_actions(films_data: List[Dict], **context) -> List[Dict]:
+    """Подготовка действий bulk-загрузки"""
+    return [
+        {
+            "_index": context["params"]["out_db_params"]["index"],
+            "_id": film_data["id"],
+            "_source": film_data,
+        }
+        for film_data in films_data
+    ]
+
+
+def _bulk_isolated(es_conn, films_data: List[Dict], **context) -> int:
+    """bulk-загрузка батча; отклоненные маппингом документы уходят в dead letter"""
+    _, errors = helpers.bulk(es_conn, _get_actions(films_data, **context), raise_on_error=False)
+    rejected = {}
+    for error in errors:
+        item = next(iter(error.values()))
+        status = item.get("status", 500)
+        if status == 429 or status >= 500:
+            # перегрузка или сбой кластера - не ошибка документа, задача повторяется целиком
+            raise AirflowException(f"Elasticsearch bulk failed with status {status}: {item.get('error')}")
+        rejected[item["_id"]] = json.dumps(item.get("error"))
+
+    films = {film_data["id"]: film_data for film_data in films_data}
+    add_dead_letters([(film_id, error, films[film_id]) for film_id, error in rejected.items()], **context)
+    resolve_dead_letters([film_id for film_id in films if film_id not in rejected], **context)
+    return len(rejected)
+
+
+def es_write_films(ti: TaskInstance, films_data: List[Dict], batch: int, **context):
+    """Запись подготовленного батча фильмов в Elasticsearch"""
+    es_conn = _get_es_connection(context["params"]["out_db_id"])
+    _bulk_isolated(es_conn, films_data, **context)
+
+
+def es_finish_load(ti: TaskInstance, **context):
+    """Возврат прежних настроек индекса после загрузки профилем write_heavy (бэкфилл)"""
+    if _get_index_profile(**context) != ES_INDEX_PROFILE_WRITE_HEAVY:
+        return
+    index = context["params"]["out_db_params"]["index"]
+    settings = ti.xcom_pull(key=ES_RESTORE_SETTINGS_KEY) or SERVING_SETTINGS
+    es_conn = _get_es_connection(context["params"]["out_db_id"])
+    es_conn.indices.put_settings(index=index, settings=settings)
+    es_conn.indices.refresh(index=index)
+    logging.info("Index %s settings restored: %s", index, settings)
 
 
 def es_write(ti: TaskInstance, **context):
@@ -162,17 +315,11 @@ def es_write(ti: TaskInstance, **context):
         logging.info("No records need to be updated")
         return
 
-    films_data = json.loads(films_data)
-    logging.info(films_data)
+    films_data = decode(films_data)
+    logging.info("Films data: %s", summary(films_data))
     logging.info("Processing %x movie:", len(films_data))
-    actions = [
-        {
-            "_index": context["params"]["out_db_params"]["index"],
-            "_id": film_data["id"],
-            "_source": film_data,
-        }
-        for film_data in films_data
-    ]
-    logging.info(actions)
-    helpers.bulk(es_conn, actions)
-    logging.info("Transfer completed, %x updated", len(actions))
+    for batch_index, batch in pending_batches(ti, films_data, **context):
+        rejected = _bulk_isolated(es_conn, batch, **context)
+        commit_batch(ti, batch_index, **context)
+        logging.info("Batch %s committed, %s movies, %s rejected", batch_index, len(batch), rejected)
+    logging.info("Transfer completed, %x updated", len(films_data))
@@ -0,0 +1,154 @@
+from typing import List, Dict, Union
+from datetime import datetime
+import gzip
+import json
+import logging
+import os
+
+import pendulum
+from airflow.models.taskinstance import TaskInstance
+from airflow.hooks.base_hook import BaseHook
+from airflow.exceptions import AirflowException
+
+from settings import DBFields, DT_FMT, FILE_SINK_DIR, FILE_BATCH_SIZE
+from db_schemas.file import MOVIE_FIELDS, PERSONS, GENRES, TIMESTAMP
+from utils import transform
+from utils.files import atomic_path
+from utils.checkpoint import pending_batches, commit_batch
+from utils.codecs import encode, decode
+
+FILE_EXTENSIONS = {
+    "parquet": "parquet",
+    "ndjson": "ndjson.gz",
+}
+
+
+def _import_pyarrow():
+    """Импорт pyarrow (нужен только для формата parquet)"""
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise AirflowException("pyarrow is required for the parquet file sink")
+    return pyarrow, pyarrow.parquet
+
+
+def _get_out_path(ti: TaskInstance, batch: int, **context) -> str:
+    """Путь файла выгрузки: <path>/<dataset>/dt=<ds>/part-<run_id>-<batch>.<ext>"""
+    conn = BaseHook.get_connection(context["params"]["out_db_id"])
+    base_dir = conn.extra_dejson.get("path") or FILE_SINK_DIR
+    out_params = context["params"]["out_db_params"] or {}
+    file_format = out_params.get("format", "parquet")
+    dataset = out_params.get("dataset", "film_work")
+    run_id = "".join(c if c.isalnum() else "_" for c in context["run_id"])
+    if ti.map_index >= 0:
+        # параллельные экземпляры задачи (dynamic task mapping) пишут в разные файлы
+        run_id = f"{run_id}-{ti.map_index}"
+    file_name = "part-{}-{:05d}.{}".format(run_id, batch, FILE_EXTENSIONS[file_format])
+    return os.path.join(base_dir, dataset, f"dt={context['ds']}", file_name)
+
+
+def _parse_timestamp(value: Union[str, None]) -> Union[datetime, None]:
+    """Преобразование строки даты в datetime"""
+    if value is None:
+        return None
+    try:
+        return datetime.strptime(value, DT_FMT)
+    except ValueError:
+        # datetime.fromisoformat в Python 3.8 не читает смещение +00 и дробные секунды не из 3/6 цифр;
+        # время со смещением приводится к UTC без зоны, как колонка timestamp("s")
+        return pendulum.parse(value).in_timezone("UTC").naive()
+
+
+def _arrow_schema(pa, fields: List[str]):
+    """Схема parquet с вложенными list<struct> для персон и жанров"""
+    person = pa.list_(pa.struct([("id", pa.string()), ("full_name", pa.string())]))
+    genre = pa.list_(pa.struct([("id", pa.string()), ("name", pa.string())]))
+    types = {
+        PERSONS: person,
+        GENRES: genre,
+        TIMESTAMP: pa.timestamp("s"),
+        "string": pa.string(),
+        "float64": pa.float64(),
+    }
+    return pa.schema([(DBFields[field].value, types[MOVIE_FIELDS[field]]) for field in fields])
+
+
+def _write_parquet(films_data: List[Dict], fields: List[str], path: str):
+    """Потоковая запись батчей в parquet (zstd)"""
+    pa, pq = _import_pyarrow()
+    schema = _arrow_schema(pa, fields)
+    timestamp_columns = [DBFields[field].value for field in fields if MOVIE_FIELDS[field] == TIMESTAMP]
+
+    with atomic_path(path) as tmp_path:
+        with pq.ParquetWriter(tmp_path, schema, compression="zstd") as writer:
+            for start in range(0, len(films_data), FILE_BATCH_SIZE):
+                batch = films_data[start:start + FILE_BATCH_SIZE]
+                for film_data in batch:
+                    for column in timestamp_columns:
+                        film_data[column] = _parse_timestamp(film_data.get(column))
+                writer.write_table(pa.Table.from_pylist(batch, schema=schema))
+
+
+def _write_ndjson(films_data: List[Dict], path: str):
+    """Потоковая запись в NDJSON со сжатием gzip"""
+    with atomic_path(path) as tmp_path:
+        with gzip.open(tmp_path, "wt", encoding="utf-8") as file:
+            for film_data in films_data:
+                file.write(json.dumps(film_data, ensure_ascii=False))
+                file.write("\n")
+
+
+def file_transform(films_data: List[Dict]) -> List[Dict]:
+    """Преобразование записей для файловой выгрузки"""
+    transformed_films_data = []
+    for film_data in films_data:
+        transformed_film_data = {}
+        for k, v in film_data.items():
+            if k in [DBFields.actors.value, DBFields.writers.value, DBFields.directors.value]:
+                v = transform.get_person_list(v)
+            elif k == DBFields.genre.value:
+                v = transform.get_genre_list(v)
+            transformed_film_data[k] = v
+        transformed_films_data.append(transformed_film_data)
+    return transformed_films_data
+
+
+def file_preprocess(ti: TaskInstance, **context) -> Union[str, None]:
+    """Преобразование данных для файловой выгрузки"""
+    prev_task = ti.xcom_pull(task_ids="in_db_branch_task")[-1]
+    films_data = ti.xcom_pull(task_ids=prev_task)
+    if not films_data:
+        logging.info("No records need to be updated")
+        return
+
+    films_data = decode(films_data)
+    return encode(file_transform(films_data))
+
+
+def file_write_films(ti: TaskInstance, films_data: List[Dict], batch: int, **context):
+    """Запись подготовленного батча фильмов в отдельный файл"""
+    # имя файла зависит только от запуска и батча - повтор перезаписывает тот же файл
+    path = _get_out_path(ti, batch, **context)
+    file_format = (context["params"]["out_db_params"] or {}).get("format", "parquet")
+    if file_format == "parquet":
+        _write_parquet(films_data, context["params"]["fields"], path)
+    else:
+        _write_ndjson(films_data, path)
+    logging.info("Batch %s written to %s", batch, path)
+
+
+def file_write(ti: TaskInstance, **context):
+    """Запись данных в файл (parquet / NDJSON.gz)"""
+    films_data = ti.xcom_pull(task_ids="file_preprocess")
+    if not films_data:
+        logging.info("No records need to be updated")
+        return
+
+    films_data = decode(films_data)
+    logging.info("Processing %s movies", len(films_data))
+
+    for batch_index, batch in pending_batches(ti, films_data, **context):
+        file_write_films(ti, batch, batch_index, **context)
+        commit_batch(ti, batch_index, **context)
+    logging.info("Transfer completed, %s movies", len(films_data))
@@ -0,0 +1,232 @@
+from typing import Dict, List, Set, Tuple
+from contextlib import closing
+from datetime import datetime
+import logging
+import re
+import uuid
+
+from airflow.models.taskinstance import TaskInstance
+from airflow.hooks.base_hook import BaseHook
+from airflow.hooks.postgres_hook import PostgresHook
+from psycopg2.extras import RealDictCursor
+
+from settings import (
+    PGDBTables,
+    SQLiteDBTables,
+    DT_FMT,
+    DT_FMT_PG,
+    INDEX_ADVISOR_OFF,
+    INDEX_ADVISOR_CREATE,
+    SOURCE_MODE_DENORM,
+)
+from db_schemas.pg import RECOMMENDED_INDEXES as PG_RECOMMENDED_INDEXES
+from db_schemas.sqlite import RECOMMENDED_INDEXES as SQLITE_RECOMMENDED_INDEXES
+from db.pg import _get_films_query as _pg_get_films_query, _get_updated_ids_query as _pg_get_updated_ids_query
+from db.sqlite import (
+    SQLITE_MAX_VARIABLES,
+    _conn_context as _sqlite_conn_context,
+    _get_films_query as _sqlite_get_films_query,
+    _get_updated_ids_query as _sqlite_get_updated_ids_query,
+    _get_updated_state as _sqlite_get_updated_state,
+    _placeholders,
+)
+from utils.state import get_updated_state
+from utils.chunk_tuner import get_chunk_size
+
+INDEX_ADVISOR_KEY = "index_advisor"
+
+# план запроса фильмов строится по фиктивным id в числе chunk_size - запрос id в источнике не выполняется
+def _sample_ids(count: int) -> List[str]:
+    return [str(uuid.UUID(int=i)) for i in range(count)]
+
+# псевдонимы таблиц в запросах извлечения (SQLite показывает их в плане)
+_SQLITE_ALIASES = {
+    "fw": SQLiteDBTables.film.value,
+    "pfw": SQLiteDBTables.film_person.value,
+    "p": SQLiteDBTables.person.value,
+    "gfw": SQLiteDBTables.film_genre.value,
+    "g": SQLiteDBTables.genre.value,
+}
+
+
+def _pg_seq_scans(plan: Dict) -> Set[str]:
+    """Таблицы, которые план читает полным сканированием"""
+    tables = {plan["Relation Name"]} if plan.get("Node Type") == "Seq Scan" else set()
+    for child in plan.get("Plans", []):
+        tables |= _pg_seq_scans(child)
+    return tables
+
+
+def _pg_explain(cursor, query: str, params) -> Tuple[float, Set[str]]:
+    """Стоимость плана и полные сканирования (EXPLAIN без выполнения запроса)"""
+    cursor.execute(f"EXPLAIN (FORMAT JSON) {query}", params)
+    plan = cursor.fetchone()["QUERY PLAN"][0]["Plan"]
+    return plan["Total Cost"], _pg_seq_scans(plan)
+
+
+def _pg_plans(cursor, **context) -> Dict[str, Dict]:
+    """Планы запросов извлечения: id обновленных фильмов и агрегированные данные"""
+    params = context["params"]
+    schema = params["id_db_params"]["schema"]
+    chunk_size = get_chunk_size(**context)
+    source_mode = params.get("source_mode")
+    ids_query = _pg_get_updated_ids_query(schema, chunk_size, source_mode=source_mode)
+    ids_params = (get_updated_state(**context) or datetime.min.strftime(DT_FMT),)
+    films_query = _pg_get_films_query(schema, params["fields"], source_mode)
+    # в режиме denorm обновления опрашиваются по film_work_denorm
+    poll_table = PGDBTables.film_denorm.value if source_mode == SOURCE_MODE_DENORM else PGDBTables.film.value
+
+    plans = {}
+    for name, query, query_params, hot_tables in (
+            ("ids", ids_query, ids_params, [poll_table]),
+            ("films", films_query, {"id": tuple(_sample_ids(chunk_size)), "dt_fmt": DT_FMT_PG},
+             [PGDBTables.film_genre.value, PGDBTables.film_person.value]),
+    ):
+        # ошибка плана (например, film_work_denorm еще не создана) - находка отчета, а не сбой запуска
+        try:
+            cost, seq_scans = _pg_explain(cursor, query, query_params)
+        except Exception as err:
+            logging.warning("Failed to explain %s query: %s", name, err)
+            plans[name] = {"error": str(err).strip(), "seq_scans": []}
+            continue
+        plans[name] = {"cost": cost, "seq_scans": sorted(seq_scans & set(hot_tables))}
+    return plans
+
+
+def _pg_has_index(cursor, schema: str, table: str, column: str) -> bool:
+    """Есть ли индекс, начинающийся с колонки column"""
+    cursor.execute(
+        """
+        SELECT 1
+        FROM pg_index i
+        JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = i.indkey[0]
+        WHERE i.indrelid = to_regclass(%s) AND a.attname = %s;
+        """,
+        (f"{schema}.{table}", column),
+    )
+    return cursor.fetchone() is not None
+
+
+def _pg_advise(mode: str, **context) -> Dict:
+    """Советник индексов Postgres"""
+    schema = context["params"]["id_db_params"]["schema"]
+    pg_conn = PostgresHook(postgres_conn_id=context["params"]["in_db_id"]).get_conn()
+    # CREATE INDEX CONCURRENTLY нельзя выполнять внутри транзакции
+    pg_conn.autocommit = True
+    try:
+        with closing(pg_conn.cursor(cursor_factory=RealDictCursor)) as cursor:
+            report = {"before": _pg_plans(cursor, **context)}
+            scanned = {table for plan in report["before"].values() for table in plan["seq_scans"]}
+            report["missing"] = sorted(
+                table for table in scanned
+                if not _pg_has_index(cursor, schema, table, PG_RECOMMENDED_INDEXES[table][1][0])
+            )
+            if mode == INDEX_ADVISOR_CREATE and report["missing"]:
+                for table in report["missing"]:
+                    name, columns = PG_RECOMMENDED_INDEXES[table]
+                    logging.info("Creating index %s on %s.%s (%s)", name, schema, table, ", ".join(columns))
+                    cursor.execute(
+                        f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {schema}.{table} ({', '.join(columns)});"
+                    )
+                    cursor.execute(f"ANALYZE {schema}.{table};")
+                report["after"] = _pg_plans(cursor, **context)
+    finally:
+        pg_conn.close()
+    return report
+
+
+def _sqlite_explain(cursor, query: str, params: List) -> Tuple[List[str], Set[str]]:
+    """План запроса и полные сканирования таблиц (EXPLAIN QUERY PLAN)"""
+    cursor.execute(f"EXPLAIN QUERY PLAN {query}", params)
+    details = [row["detail"] for row in cursor.fetchall()]
+    scans = set()
+    for detail in details:
+        match = re.match(r"SCAN (?:TABLE )?(\w+)(?: AS (\w+))?", detail)
+        # SCAN ... USING INDEX - обход индекса, а не таблицы
+        if match and "USING" not in detail:
+            name = match.group(2) or match.group(1)
+            scans.add(_SQLITE_ALIASES.get(name, name))
+    return details, scans
+
+
+def _sqlite_plans(cursor, **context) -> Dict[str, Dict]:
+    """Планы запросов извлечения SQLite (стоимость SQLite не сообщает - сохраняется текст плана)"""
+    chunk_size = get_chunk_size(**context)
+    ids_query = _sqlite_get_updated_ids_query(chunk_size)
+    ids_params = [_sqlite_get_updated_state(**context)]
+    ids = _sample_ids(min(chunk_size, SQLITE_MAX_VARIABLES))
+    films_query = _sqlite_get_films_query(context["params"]["fields"]).format(placeholders=_placeholders(ids))
+
+    plans = {}
+    for name, query, query_params, hot_tables in (
+            ("ids", ids_query, ids_params, [SQLiteDBTables.film.value]),
+            ("films", films_query, ids, [SQLiteDBTables.film_genre.value, SQLiteDBTables.film_person.value]),
+    ):
+        try:
+            details, scans = _sqlite_explain(cursor, query, query_params)
+        except Exception as err:
+            logging.warning("Failed to explain %s query: %s", name, err)
+            plans[name] = {"error": str(err).strip(), "seq_scans": []}
+            continue
+        plans[name] = {"plan": details, "seq_scans": sorted(scans & set(hot_tables))}
+    return plans
+
+
+def _sqlite_has_index(cursor, table: str, column: str) -> bool:
+    """Есть ли индекс, начинающийся с колонки column"""
+    for index in cursor.execute(f"PRAGMA index_list({table})").fetchall():
+        info = cursor.execute(f"PRAGMA index_info({index['name']})").fetchall()
+        if info and info[0]["name"] == column:
+            return True
+    return False
+
+
+def _sqlite_advise(mode: str, **context) -> Dict:
+    """Советник индексов SQLite"""
+    db_name = BaseHook.get_connection(context["params"]["in_db_id"]).schema
+    # для создания индексов нужно подключение на запись
+    with _sqlite_conn_context(db_name, read_only=mode != INDEX_ADVISOR_CREATE) as conn:
+        with closing(conn.cursor()) as cursor:
+            report = {"before": _sqlite_plans(cursor, **context)}
+            scanned = {table for plan in report["before"].values() for table in plan["seq_scans"]}
+            report["missing"] = sorted(
+                table for table in scanned
+                if not _sqlite_has_index(cursor, table, SQLITE_RECOMMENDED_INDEXES[table][1][0])
+            )
+            if mode == INDEX_ADVISOR_CREATE and report["missing"]:
+                for table in report["missing"]:
+                    name, columns = SQLITE_RECOMMENDED_INDEXES[table]
+                    logging.info("Creating index %s on %s (%s)", name, table, ", ".join(columns))
+                    cursor.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({', '.join(columns)});")
+                cursor.execute("ANALYZE;")
+                conn.commit()
+                report["after"] = _sqlite_plans(cursor, **context)
+    return report
+
+
+ADVISORS = {
+    "postgres": _pg_advise,
+    "sqlite": _sqlite_advise,
+}
+
+
+def index_advisor(ti: TaskInstance, **context):
+    """Проверка планов запросов извлечения и индексов горячих предикатов источника"""
+    mode = context["params"].get("index_advisor") or INDEX_ADVISOR_OFF
+    if mode == INDEX_ADVISOR_OFF:
+        return
+    conn_type = BaseHook.get_connection(context["params"]["in_db_id"]).conn_type
+    if conn_type not in ADVISORS:
+        logging.info("Index advisor is not available for %s", conn_type)
+        return
+
+    report = ADVISORS[conn_type](mode, **context)
+    for stage in ("before", "after"):
+        for name, plan in report.get(stage, {}).items():
+            logging.info("Plan %s (%s): %s", name, stage, plan)
+    if report["missing"]:
+        logging.warning("Sequential scans on hot predicates, missing indexes on: %s", ", ".join(report["missing"]))
+    failed = sorted(name for name, plan in report["before"].items() if "error" in plan)
+    if failed:
+        logging.warning("Could not explain queries: %s", ", ".join(failed))
+    ti.xcom_push(key=INDEX_ADVISOR_KEY, value=report)
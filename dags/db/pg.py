@@ -1,21 +1,42 @@
-from typing import Set
+from typing import Callable, Dict, List, Optional, Set, Tuple
+from contextlib import closing
 from datetime import datetime
 import json
 import logging
 
 from airflow.models.taskinstance import TaskInstance
 from airflow.hooks.postgres_hook import PostgresHook
-from psycopg2.extras import RealDictCursor
+from airflow.exceptions import AirflowException
+from airflow.stats import Stats
+import psycopg2
+from psycopg2.extras import Json, RealDictCursor
 
 from settings import (
     DBFields,
     PGDBTables,
-    MOVIES_UPDATED_STATE_KEY,
     MOVIES_UPDATED_STATE_KEY_TMP,
     DT_FMT_PG,
     DT_FMT,
+    SOURCE_MODE_DENORM,
+    SOURCE_MODE_DIM_CACHE,
+    REPLICA_MAX_LAG_SECONDS,
+    REPLICA_LAG_MARGIN_SECONDS,
 )
-from db_schemas.pg import MOVIE_FIELDS
+from db_schemas.pg import MOVIE_FIELDS, FILM_WORK_DENORM, FILM_WORK_DENORM_FILL, FILM_WORK_DENORM_POLL_INDEX
+from utils.dim_cache import NESTED_COLUMNS, PERSON_ROLES, build_films_nested, get_cache
+from utils.state import get_updated_state
+from utils.chunk_tuner import get_chunk_size
+from utils.checkpoint import load_staged, stage, pending_batches, commit_batch
+from utils.codecs import encode, decode
+from utils.lease import LEASE_MIN_ID, claim_window, is_leasing
+from utils.log import summary, dump_payload
+from utils.dead_letter import get_dead_letter_ids, is_replay, write_isolated
+
+# подключение, с которого прочитаны id запуска (реплика или основная база)
+PG_SOURCE_CONN_KEY = "pg_source_conn"
+
+# ошибки данных отдельной строки (NOT NULL, тип, формат) - такие строки уходят в dead letter
+PG_DATA_ERRORS = (psycopg2.DataError, psycopg2.IntegrityError)
 
 PG_FIELDS_TO_SQL = {
     DBFields.film_id.name: "fw.id",
@@ -34,79 +55,345 @@ PG_FIELDS_TO_SQL = {
     DBFields.genre.name: "JSON_AGG(DISTINCT jsonb_build_object('id', g.id::text, 'name', g.name)) AS genre",
 }
 
+PG_DENORM_FIELDS_TO_SQL = {
+    **PG_FIELDS_TO_SQL,
+    DBFields.actors.name: "d.actors",
+    DBFields.writers.name: "d.writers",
+    DBFields.directors.name: "d.directors",
+    DBFields.genre.name: "d.genre",
+}
 
-def pg_get_updated_movies_ids(ti: TaskInstance, **context) -> Set:
-    """Сбор обновленных записей в таблице с фильмами"""
 
-    query = f"""
-        SELECT id, updated_at
-        FROM {context["params"]["id_db_params"]["schema"]}.{PGDBTables.film.value}
-        WHERE updated_at >= %s
-        ORDER BY updated_at
-        LIMIT {context["params"]["chunk_size"]};
+def _get_films_query(schema: str, fields: List[str], source_mode: str, where: str = "fw.id IN %(id)s") -> str:
+    """Подготовка запроса агрегированных данных по фильмам"""
+    if source_mode == SOURCE_MODE_DENORM:
+        fields_query = ", ".join([PG_DENORM_FIELDS_TO_SQL[field] for field in fields])
+        return f"""
+        SELECT {fields_query}
+        FROM {schema}.{PGDBTables.film.value} fw
+        LEFT JOIN {schema}.{PGDBTables.film_denorm.value} d ON d.film_work_id = fw.id
+        WHERE {where};
+        """
+
+    fields_query = ", ".join([PG_FIELDS_TO_SQL[field] for field in fields])
+    return f"""
+        SELECT {fields_query}
+        FROM {schema}.{PGDBTables.film.value} fw
+        LEFT JOIN {schema}.{PGDBTables.film_person.value} pfw ON pfw.film_work_id = fw.id
+        LEFT JOIN {schema}.{PGDBTables.person.value} p ON p.id = pfw.person_id
+        LEFT JOIN {schema}.{PGDBTables.film_genre.value} gfw ON gfw.film_work_id = fw.id
+        LEFT JOIN {schema}.{PGDBTables.genre.value} g ON g.id = gfw.genre_id
+        WHERE {where}
+        GROUP BY fw.id;
         """
 
+
+def _get_dimension(cursor, conn_id: str, schema: str, table: PGDBTables, name_column: str, ids: Set[str]) -> Dict:
+    """Значения справочника (person/genre) по id через кэш справочников"""
+    cache = get_cache(conn_id, f"{schema}.{table.value}")
+
+    def load_updated(since) -> Dict[str, str]:
+        cursor.execute(
+            f"SELECT id::text AS id, {name_column} AS name FROM {schema}.{table.value} WHERE updated_at > %s",
+            (since,),
+        )
+        return {row["id"]: row["name"] for row in cursor.fetchall()}
+
+    def load_by_ids(missing: List[str]) -> Dict[str, str]:
+        cursor.execute(
+            f"SELECT id::text AS id, {name_column} AS name FROM {schema}.{table.value} WHERE id IN %s",
+            (tuple(missing),),
+        )
+        return {row["id"]: row["name"] for row in cursor.fetchall()}
+
+    cursor.execute(f"SELECT MAX(updated_at) AS max_updated_at, COUNT(*) AS cnt FROM {schema}.{table.value}")
+    watermark = cursor.fetchone()
+    cache.refresh((watermark["max_updated_at"], watermark["cnt"]), load_updated)
+    return cache.get_many(ids, load_by_ids) if ids else {}
+
+
+def _get_films_data_dim_cache(cursor, conn_id: str, schema: str, fields: List[str], film_ids: Set) -> List[Dict]:
+    """Сбор данных по фильмам: строки фильмов и id связей из базы, персоны и жанры из кэша"""
+    params = {"id": tuple(film_ids), "dt_fmt": DT_FMT_PG}
+    film_columns = ["fw.id::text AS id"] + [
+        PG_FIELDS_TO_SQL[field] for field in fields
+        if DBFields[field].value not in NESTED_COLUMNS and field != DBFields.film_id.name
+    ]
+    cursor.execute(
+        f"SELECT {', '.join(film_columns)} FROM {schema}.{PGDBTables.film.value} fw WHERE fw.id IN %(id)s",
+        params,
+    )
+    films = cursor.fetchall()
+
+    person_links, persons = [], {}
+    if any(DBFields[field].value in PERSON_ROLES.values() for field in fields):
+        cursor.execute(
+            f"SELECT film_work_id::text AS film_work_id, person_id::text AS person_id, role "
+            f"FROM {schema}.{PGDBTables.film_person.value} WHERE film_work_id IN %(id)s",
+            params,
+        )
+        person_links = [(row["film_work_id"], row["person_id"], row["role"]) for row in cursor.fetchall()]
+        persons = _get_dimension(
+            cursor, conn_id, schema, PGDBTables.person, "full_name", {link[1] for link in person_links}
+        )
+
+    genre_links, genres = [], {}
+    if DBFields.genre.name in fields:
+        cursor.execute(
+            f"SELECT film_work_id::text AS film_work_id, genre_id::text AS genre_id "
+            f"FROM {schema}.{PGDBTables.film_genre.value} WHERE film_work_id IN %(id)s",
+            params,
+        )
+        genre_links = [(row["film_work_id"], row["genre_id"]) for row in cursor.fetchall()]
+        genres = _get_dimension(
+            cursor, conn_id, schema, PGDBTables.genre, "name", {link[1] for link in genre_links}
+        )
+
+    return build_films_nested(films, fields, person_links, genre_links, persons, genres)
+
+
+def pg_bootstrap_denorm(ti: TaskInstance, **context):
+    """Создание и первичное заполнение film_work_denorm в источнике (режим denorm)"""
+    if context["params"].get("source_mode") != SOURCE_MODE_DENORM:
+        logging.info("Source mode is not %s, skipping", SOURCE_MODE_DENORM)
+        return
+
+    schema = context["params"]["id_db_params"]["schema"]
     pg_hook = PostgresHook(postgres_conn_id=context["params"]["in_db_id"])
     pg_conn = pg_hook.get_conn()
     cursor = pg_conn.cursor(cursor_factory=RealDictCursor)
 
-    updated_state = (
-            ti.xcom_pull(
-                key=MOVIES_UPDATED_STATE_KEY,
-            )
-            or datetime.min.strftime(DT_FMT)
+    cursor.execute("SELECT to_regclass(%s) AS name", (f"{schema}.{FILM_WORK_DENORM_POLL_INDEX}",))
+    if cursor.fetchone()["name"]:
+        logging.info("Table %s.%s already exists", schema, PGDBTables.film_denorm.value)
+        return
+
+    # таблица, функции, триггеры и заполнение - в одной транзакции; таблица без индекса опроса (прежней версии)
+    # получает новые триггеры и заполняется заново
+    cursor.execute(FILM_WORK_DENORM.format(schema=schema))
+    cursor.execute(FILM_WORK_DENORM_FILL.format(schema=schema))
+    pg_conn.commit()
+    logging.info("Table %s.%s is successfully created and filled", schema, PGDBTables.film_denorm.value)
+
+
+def _get_poll_table(schema: str, source_mode: Optional[str]) -> Tuple[str, str]:
+    """Таблица и колонка id для опроса обновлений: в режиме denorm - film_work_denorm (фильм и его связи)"""
+    if source_mode == SOURCE_MODE_DENORM:
+        return f"{schema}.{PGDBTables.film_denorm.value}", "film_work_id"
+    return f"{schema}.{PGDBTables.film.value}", "id"
+
+
+def _get_updated_ids_query(schema: str, limit: int, capped: bool = False, source_mode: Optional[str] = None) -> str:
+    """Подготовка запроса id фильмов, обновленных после контрольной точки (capped - не позже границы реплики)"""
+    table, id_column = _get_poll_table(schema, source_mode)
+    return f"""
+        SELECT {id_column} AS id, updated_at
+        FROM {table}
+        WHERE updated_at >= %s{" AND updated_at <= %s" if capped else ""}
+        ORDER BY updated_at
+        LIMIT {limit};
+        """
+
+
+def _get_leased_ids_query(schema: str, limit: int, capped: bool = False, source_mode: Optional[str] = None) -> str:
+    """Подготовка запроса id фильмов после ключа (updated_at, id) (capped - не позже границы реплики)"""
+    table, id_column = _get_poll_table(schema, source_mode)
+    return f"""
+        SELECT {id_column} AS id, updated_at
+        FROM {table}
+        WHERE (updated_at, {id_column}) > (%s, %s){" AND updated_at <= %s" if capped else ""}
+        ORDER BY updated_at, {id_column}
+        LIMIT {limit};
+        """
+
+
+def _get_window_ids_query(schema: str, source_mode: Optional[str] = None) -> str:
+    """Подготовка запроса id фильмов окна (lower, upper] по ключу (updated_at, id)"""
+    table, id_column = _get_poll_table(schema, source_mode)
+    return f"""
+        SELECT {id_column} AS id, updated_at
+        FROM {table}
+        WHERE (updated_at, {id_column}) > (%s, %s) AND (updated_at, {id_column}) <= (%s, %s)
+        ORDER BY updated_at, {id_column};
+        """
+
+
+def _get_replica_cap(pg_conn, **context) -> Tuple[bool, Optional[datetime]]:
+    """Проверка реплики: (можно ли читать, граница окна - момент воспроизведения минус запас)"""
+    with closing(pg_conn.cursor(cursor_factory=RealDictCursor)) as cursor:
+        cursor.execute(
+            """
+            SELECT pg_is_in_recovery() AS in_recovery,
+                   pg_last_xact_replay_timestamp() - make_interval(secs => %s) AS cap,
+                   CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                        ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END AS lag;
+            """,
+            (REPLICA_LAG_MARGIN_SECONDS,),
+        )
+        status = cursor.fetchone()
+    if not status["in_recovery"]:
+        # реплику повысили до основной базы - в ней видны все изменения
+        logging.info("Replica %s is not in recovery, reading without cap", context["params"]["in_db_replica_id"])
+        return True, None
+    max_lag = context["params"].get("replica_max_lag_seconds") or REPLICA_MAX_LAG_SECONDS
+    if status["cap"] is None or status["lag"] is None or status["lag"] > max_lag:
+        logging.warning("Replica lag %s s exceeds %s s, falling back to primary", status["lag"], max_lag)
+        Stats.incr("movies_etl.replica_fallback")
+        return False, None
+    Stats.gauge("movies_etl.replica_lag", float(status["lag"]))
+    logging.info("Replica lag %s s, window capped at %s", status["lag"], status["cap"])
+    return True, status["cap"]
+
+
+def _get_source_conn(**context) -> Tuple[str, object, Optional[datetime]]:
+    """Подключение для извлечения: реплика (с границей окна), если не отстает, иначе основная база"""
+    replica_id = context["params"].get("in_db_replica_id")
+    if replica_id:
+        pg_conn = PostgresHook(postgres_conn_id=replica_id).get_conn()
+        usable, cap = _get_replica_cap(pg_conn, **context)
+        if usable:
+            return replica_id, pg_conn, cap
+        pg_conn.close()
+    in_db_id = context["params"]["in_db_id"]
+    return in_db_id, PostgresHook(postgres_conn_id=in_db_id).get_conn(), None
+
+
+def _is_past_cap(cursor, value: str, cap: datetime) -> bool:
+    """Позже ли момент value границы окна реплики (сравнение на стороне Postgres - без разбора строки в Python)"""
+    cursor.execute("SELECT %s::timestamptz > %s AS past;", (value, cap))
+    return cursor.fetchone()["past"]
+
+
+def _fetch_updated_ids(cursor, query: str, updated_state: str, cap: Optional[datetime], **context) -> List[Dict]:
+    """id и updated_at обновленных фильмов: окно аренды или chunk после контрольной точки"""
+    capped = cap is not None
+    if is_leasing(**context):
+        schema = context["params"]["id_db_params"]["schema"]
+        source_mode = context["params"].get("source_mode")
+
+        def fetch_next(lower):
+            query = _get_leased_ids_query(schema, get_chunk_size(**context), capped, source_mode)
+            cursor.execute(query, (*lower, cap) if capped else lower)
+            return cursor.fetchall()
+
+        def fetch_range(lower, upper):
+            # окно, выданное по основной базе, реплика могла еще не воспроизвести - задача повторится позже
+            if capped and _is_past_cap(cursor, upper[0], cap):
+                raise AirflowException(f"Replica has not replayed leased window up to {upper[0]} yet")
+            cursor.execute(_get_window_ids_query(schema, source_mode), (*lower, *upper))
+            return cursor.fetchall()
+
+        # пересекающиеся запуски обрабатывают непересекающиеся окна
+        return claim_window(fetch_next, fetch_range, (updated_state, LEASE_MIN_ID), **context)
+    cursor.execute(query, (updated_state, cap) if capped else (updated_state,))
+    return cursor.fetchall()
+
+
+def pg_get_updated_movies_ids(ti: TaskInstance, **context) -> Set:
+    """Сбор обновленных записей в таблице с фильмами"""
+
+    staged = load_staged(ti, ti.task_id, **context)
+    if staged:
+        staged = json.loads(staged)
+        if staged["state"]:
+            ti.xcom_push(key=MOVIES_UPDATED_STATE_KEY_TMP, value=staged["state"])
+        ti.xcom_push(key=PG_SOURCE_CONN_KEY, value=staged.get("source") or context["params"]["in_db_id"])
+        return set(staged["ids"])
+
+    if is_replay(**context):
+        # контрольная точка при повторе не двигается
+        ids = get_dead_letter_ids(**context)
+        logging.info("Replaying %s dead letters", len(ids))
+        stage(ti, ti.task_id, json.dumps({"ids": ids, "state": None}), **context)
+        return set(ids)
+
+    source_id, pg_conn, cap = _get_source_conn(**context)
+    cursor = pg_conn.cursor(cursor_factory=RealDictCursor)
+    capped = cap is not None
+    query = _get_updated_ids_query(
+        context["params"]["id_db_params"]["schema"],
+        get_chunk_size(**context),
+        capped,
+        context["params"].get("source_mode"),
     )
-    logging.info("Movies updated state: %s", updated_state)
-    cursor.execute(query, (updated_state,))
-    items = cursor.fetchall()
-    logging.info(items)
-    if items:
+
+    updated_state = get_updated_state(**context) or datetime.min.strftime(DT_FMT)
+    logging.info("Movies updated state: %s, source %s", updated_state, source_id)
+    try:
+        items = _fetch_updated_ids(cursor, query, updated_state, cap, **context)
+    finally:
+        pg_conn.close()
+    logging.info("Updated movies: %s", summary(items))
+    state = items[-1]["updated_at"].strftime(DT_FMT) if items else None
+    if state:
         ti.xcom_push(
             key=MOVIES_UPDATED_STATE_KEY_TMP,
-            value=items[-1]["updated_at"].strftime(DT_FMT),
+            value=state,
         )
-    return set([x["id"] for x in items])
+    # данные фильмов читаются из той же базы, что и id: реплика не отстает от прочитанного окна
+    ti.xcom_push(key=PG_SOURCE_CONN_KEY, value=source_id)
+    ids = [x["id"] for x in items]
+    stage(ti, ti.task_id, json.dumps({"ids": ids, "state": state, "source": source_id}), **context)
+    return set(ids)
 
 
 def pg_get_films_data(ti: TaskInstance, **context):
     """Сбор агрегированных данных по фильмам"""
     logging.info(context["params"]["fields"])
-    fields_query = ", ".join(
-        [PG_FIELDS_TO_SQL[field] for field in context["params"]["fields"]]
+    query = _get_films_query(
+        context["params"]["id_db_params"]["schema"],
+        context["params"]["fields"],
+        context["params"].get("source_mode"),
     )
-    logging.info(fields_query)
-
-    query = f"""
-        SELECT {fields_query}
-        FROM {context["params"]["id_db_params"]["schema"]}.{PGDBTables.film.value} fw
-        LEFT JOIN {context["params"]["id_db_params"]["schema"]}.{PGDBTables.film_person.value} pfw ON pfw.film_work_id = fw.id
-        LEFT JOIN {context["params"]["id_db_params"]["schema"]}.{PGDBTables.person.value} p ON p.id = pfw.person_id
-        LEFT JOIN {context["params"]["id_db_params"]["schema"]}.{PGDBTables.film_genre.value} gfw ON gfw.film_work_id = fw.id
-        LEFT JOIN {context["params"]["id_db_params"]["schema"]}.{PGDBTables.genre.value} g ON g.id = gfw.genre_id
-        WHERE fw.id IN %(id)s
-        GROUP BY fw.id;
-        """
+    logging.info(query)
 
     film_ids = ti.xcom_pull(task_ids="pg_get_updated_movies_ids")
-    logging.info(film_ids)
+    logging.info("Film ids: %s", summary(film_ids))
     if len(film_ids) == 0:
         logging.info("No records need to be updated")
         return
 
-    pg_hook = PostgresHook(postgres_conn_id=context["params"]["in_db_id"])
+    staged = load_staged(ti, ti.task_id, **context)
+    if staged:
+        return staged
+
+    source_id = ti.xcom_pull(task_ids="pg_get_updated_movies_ids", key=PG_SOURCE_CONN_KEY)
+    pg_hook = PostgresHook(postgres_conn_id=source_id or context["params"]["in_db_id"])
     pg_conn = pg_hook.get_conn()
     cursor = pg_conn.cursor(cursor_factory=RealDictCursor)
 
-    cursor.execute(
-        query,
-        {
-            "id": tuple(film_ids),
-            "dt_fmt": DT_FMT_PG,
-        },
-    )
-    items = cursor.fetchall()
-    logging.info(items)
-    return json.dumps(items, indent=4)
+    if context["params"].get("source_mode") == SOURCE_MODE_DIM_CACHE:
+        items = _get_films_data_dim_cache(
+            cursor,
+            context["params"]["in_db_id"],
+            context["params"]["id_db_params"]["schema"],
+            context["params"]["fields"],
+            film_ids,
+        )
+    else:
+        cursor.execute(
+            query,
+            {
+                "id": tuple(film_ids),
+                "dt_fmt": DT_FMT_PG,
+            },
+        )
+        items = cursor.fetchall()
+    logging.info("Films data: %s", summary(items))
+    dump_payload("films_data", items, **context)
+    return stage(ti, ti.task_id, encode(items), **context)
+
+
+def _get_create_table_query(schema: str, table: str, fields: List[str]) -> str:
+    """Подготовка запроса создания таблицы-приемника"""
+    field_properties = [
+        v for k, v in MOVIE_FIELDS.items() if k in fields
+    ]
+    field_properties = ", ".join(field_properties)
+    return f"""
+    CREATE TABLE IF NOT EXISTS {schema}.
+    {table} ({field_properties})
+    """
 
 
 def pg_create_schema(ti: TaskInstance, **context):
@@ -124,14 +411,11 @@ def pg_create_schema(ti: TaskInstance, **context):
         context["params"]["out_db_params"]["schema"],
     )
 
-    field_properties = [
-        v for k, v in MOVIE_FIELDS.items() if k in context["params"]["fields"]
-    ]
-    field_properties = ", ".join(field_properties)
-    query = f"""
-    CREATE TABLE IF NOT EXISTS {context['params']['out_db_params']['schema']}.
-    {context['params']['out_db_params']['table']} ({field_properties})
-    """
+    query = _get_create_table_query(
+        context["params"]["out_db_params"]["schema"],
+        context["params"]["out_db_params"]["table"],
+        context["params"]["fields"],
+    )
     logging.info(query)
     cursor.execute(query)
     pg_conn.commit()
@@ -142,6 +426,18 @@ def pg_create_schema(ti: TaskInstance, **context):
     logging.info(msg),
 
 
+def pg_transform(films_data: List[Dict]) -> List[Dict]:
+    """Преобразование записей для Postgres (вложенные списки кодируются в json при записи)"""
+    return films_data
+
+
+def _to_pg_value(column: str, value):
+    """Значение колонки для mogrify: вложенные списки - json"""
+    if column in NESTED_COLUMNS:
+        return Json(value)
+    return value
+
+
 def pg_preprocess(ti: TaskInstance, **context):
     """Трансформация данных"""
     prev_task = ti.xcom_pull(task_ids="in_db_branch_task")[-1]
@@ -150,38 +446,14 @@ def pg_preprocess(ti: TaskInstance, **context):
         logging.info("No records need to be updated")
         return
 
-    films_data = json.loads(films_data)
-    transformed_films_data = []
-    for film_data in films_data:
-        transformed_film_data = {}
-        for k, v in film_data.items():
-            if k in [
-                DBFields.genre.value,
-                DBFields.actors.value,
-                DBFields.writers.value,
-                DBFields.directors.value,
-            ]:
-                v = json.dumps(v)
-            transformed_film_data[k] = v
-        transformed_films_data.append(transformed_film_data)
-    return json.dumps(transformed_films_data, indent=4)
-
+    films_data = pg_transform(decode(films_data))
+    logging.info("Transformed films data: %s", summary(films_data))
+    dump_payload("films_data", films_data, **context)
+    return encode(films_data)
 
-def pg_write(ti: TaskInstance, **context):
-    """Запись данных в Postgres"""
-    films_data = ti.xcom_pull(task_ids="pg_preprocess")
-    logging.info(f'{films_data=}')
-    films_data = json.loads(films_data)
-    logging.info(f'{films_data=}')
-    if not len(films_data):
-        logging.info("No records need to be updated")
-        return
-
-    logging.info("Processing %x movie:", len(films_data))
-    pg_hook = PostgresHook(postgres_conn_id=context["params"]["out_db_id"])
-    pg_conn = pg_hook.get_conn()
-    cursor = pg_conn.cursor(cursor_factory=RealDictCursor)
 
+def _get_upsert_query(**context) -> str:
+    """Подготовка запроса INSERT ... ON CONFLICT, VALUES {} заполняется при записи"""
     field_properties = ", ".join(
         DBFields[field] for field in context["params"]["fields"]
     )
@@ -191,7 +463,7 @@ def pg_write(ti: TaskInstance, **context):
     ]
     set_fields = ", ".join(set_fields)
 
-    query = (
+    return (
             f"""
     INSERT INTO {context['params']['out_db_params']['schema']}.
     {context['params']['out_db_params']['table']} ({field_properties})
@@ -204,22 +476,70 @@ def pg_write(ti: TaskInstance, **context):
     SET {set_fields};
     """
     )
-    logging.info(
-        [
-            tuple([rec[DBFields[k].value] for k in context["params"]["fields"]])
-            for rec in films_data
-        ]
-    )
-    query = cursor.mogrify(
+
+
+def _write_films(cursor, query: str, films_data: List[Dict], **context):
+    """Запись батча фильмов (без commit)"""
+    values = [
+        tuple([_to_pg_value(DBFields[k].value, rec[DBFields[k].value]) for k in context["params"]["fields"]])
+        for rec in films_data
+    ]
+    logging.debug("Upsert values: %s", summary(values))
+    batch_query = cursor.mogrify(
         query.format(
             ", ".join(["%s"] * len(films_data)),
         ),
-        [
-            tuple([rec[DBFields[k].value] for k in context["params"]["fields"]])
-            for rec in films_data
-        ],
+        values,
     )
-    logging.info(query)
-    cursor.execute(query)
-    pg_conn.commit()
+    logging.debug("Upsert query: %s", summary(batch_query))
+    cursor.execute(batch_query)
+
+
+def _get_batch_writer(pg_conn, query: str, **context) -> Callable[[List[Dict]], None]:
+    """Запись батча в отдельной транзакции (откат при ошибке)"""
+    cursor = pg_conn.cursor(cursor_factory=RealDictCursor)
+
+    def write(films_data: List[Dict]):
+        try:
+            _write_films(cursor, query, films_data, **context)
+            pg_conn.commit()
+        except psycopg2.Error:
+            pg_conn.rollback()
+            raise
+
+    return write
+
+
+def pg_write_films(ti: TaskInstance, films_data: List[Dict], batch: int, **context):
+    """Запись подготовленного батча фильмов в Postgres"""
+    pg_hook = PostgresHook(postgres_conn_id=context["params"]["out_db_id"])
+    pg_conn = pg_hook.get_conn()
+    try:
+        write = _get_batch_writer(pg_conn, _get_upsert_query(**context), **context)
+        write_isolated(films_data, write, PG_DATA_ERRORS, **context)
+    finally:
+        pg_conn.close()
+
+
+def pg_write(ti: TaskInstance, **context):
+    """Запись данных в Postgres"""
+    films_data = ti.xcom_pull(task_ids="pg_preprocess")
+    if not films_data:
+        logging.info("No records need to be updated")
+        return
+    films_data = decode(films_data)
+    logging.info("Films data: %s", summary(films_data))
+
+    logging.info("Processing %x movie:", len(films_data))
+    pg_hook = PostgresHook(postgres_conn_id=context["params"]["out_db_id"])
+    pg_conn = pg_hook.get_conn()
+    try:
+        write = _get_batch_writer(pg_conn, _get_upsert_query(**context), **context)
+        for batch_index, batch in pending_batches(ti, films_data, **context):
+            # строки, нарушающие ограничения таблицы, уходят в dead letter, остальные записываются
+            rejected = write_isolated(batch, write, PG_DATA_ERRORS, **context)
+            commit_batch(ti, batch_index, **context)
+            logging.info("Batch %s committed, %s movies, %s rejected", batch_index, len(batch), rejected)
+    finally:
+        pg_conn.close()
     logging.info("Transfer completed, %x updated", len(films_data))
@@ -0,0 +1,382 @@
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+from contextlib import closing, contextmanager
+from hashlib import md5
+import logging
+import sqlite3
+
+from airflow.models.taskinstance import TaskInstance
+from airflow.hooks.base_hook import BaseHook
+from airflow.hooks.postgres_hook import PostgresHook
+from airflow.exceptions import AirflowException
+from elasticsearch import helpers
+from psycopg2.extras import RealDictCursor
+
+from settings import (
+    DBFields,
+    PGDBTables,
+    SQLiteDBTables,
+    DT_FMT_PG,
+    SOURCE_MODE_DIM_CACHE,
+    SOURCE_MODE_JOIN,
+    ES_PAGE_SIZE,
+    RECONCILE_ROOT_PREFIX,
+    RECONCILE_LEAF_ROWS,
+    RECONCILE_PREFIX_BATCH,
+)
+from db.pg import _get_films_query as _pg_get_films_query
+from db.sqlite import (
+    _conn_context as _sqlite_conn_context,
+    _get_films_query as _sqlite_get_films_query,
+    _read_part as _sqlite_read_part,
+    _select_in,
+)
+from db.es import _get_es_connection, _get_transformed_items
+from db.sinks import SINKS
+from utils.checkpoint import load_staged, stage, pending_batches, commit_batch, clear_run
+from utils.codecs import encode, decode
+
+# корзина: (число строк, сумма старших и младших 32 бит md5 строк) - не зависит от порядка строк
+Bucket = Tuple[int, int, int]
+
+# сравниваются скалярные поля film_work - во всех базах у них одно представление;
+# вложенные списки приемники хранят по-разному, их изменения видны по updated_at
+RECONCILE_FIELDS = [
+    DBFields.film_id.name,
+    DBFields.title.name,
+    DBFields.description.name,
+    DBFields.rating.name,
+    DBFields.film_type.name,
+    DBFields.film_created_at.name,
+    DBFields.film_updated_at.name,
+]
+TIMESTAMP_COLUMNS = {DBFields.film_created_at.value, DBFields.film_updated_at.value}
+ID_COLUMN = DBFields.film_id.value
+
+# длина префикса id, дальше которой спуск не идет (uuid с дефисами)
+MAX_PREFIX = 36
+
+
+def _get_columns(fields: List[str]) -> List[str]:
+    """Сравниваемые колонки: id и запрошенные скалярные поля"""
+    if DBFields.film_id.name not in fields:
+        raise AirflowException("Reconciliation requires film_id in fields")
+    return [DBFields[field].value for field in RECONCILE_FIELDS if field in fields]
+
+
+# Представление строки: значения через "|", NULL - пустая строка, rating - сотые доли,
+# даты - первые 19 символов (YYYY-MM-DD HH:MM:SS)
+
+def _canonical(column: str, value) -> str:
+    """Значение колонки в общем для всех баз виде"""
+    if value is None:
+        return ""
+    if column == DBFields.rating.value:
+        return str(int(float(value) * 100 + 0.5))
+    if column in TIMESTAMP_COLUMNS:
+        return str(value)[:19].replace("T", " ")
+    return str(value)
+
+
+def _row_hash(row: Dict, columns: List[str]) -> str:
+    return md5("|".join(_canonical(column, row.get(column)) for column in columns).encode("utf-8")).hexdigest()
+
+
+def _hash_parts(row_hash: str) -> Tuple[int, int]:
+    return int(row_hash[:8], 16), int(row_hash[8:16], 16)
+
+
+def _pg_canonical(column: str) -> str:
+    if column == DBFields.rating.value:
+        return f"COALESCE(TRUNC(fw.{column} * 100 + 0.5)::bigint::text, '')"
+    if column in TIMESTAMP_COLUMNS:
+        return f"COALESCE(TO_CHAR(fw.{column}, '{DT_FMT_PG}'), '')"
+    return f"COALESCE(fw.{column}::text, '')"
+
+
+def _sqlite_canonical(column: str) -> str:
+    if column == DBFields.rating.value:
+        return f"COALESCE(CAST(fw.{column} * 100 + 0.5 AS INTEGER), '')"
+    if column in TIMESTAMP_COLUMNS:
+        return f"COALESCE(REPLACE(SUBSTR(fw.{column}, 1, 19), 'T', ' '), '')"
+    return f"COALESCE(fw.{column}, '')"
+
+
+def _get_side(conn_id: str, db_params: Optional[Dict]) -> Dict:
+    """Описание стороны сверки: подключение и расположение film_work"""
+    conn = BaseHook.get_connection(conn_id)
+    db_params = db_params or {}
+    return {
+        "conn_id": conn_id,
+        "conn_type": conn.conn_type,
+        "db_name": conn.schema,
+        "schema": db_params.get("schema"),
+        "table": db_params.get("table") or PGDBTables.film.value,
+        "index": db_params.get("index"),
+    }
+
+
+def _pg_buckets(side: Dict, columns: List[str], length: int, parents: Optional[List[str]]) -> Dict[str, Bucket]:
+    """Суммы корзин Postgres (md5 строк считается в базе)"""
+    where = "" if parents is None else "WHERE LEFT(fw.id::text, %(parent_length)s) = ANY(%(parents)s)"
+    query = f"""
+        SELECT bucket, COUNT(*) AS cnt,
+               SUM(('x' || SUBSTR(h, 1, 8))::bit(32)::bigint) AS h1,
+               SUM(('x' || SUBSTR(h, 9, 8))::bit(32)::bigint) AS h2
+        FROM (
+            SELECT LEFT(fw.id::text, %(length)s) AS bucket,
+                   MD5(CONCAT_WS('|', {", ".join(_pg_canonical(column) for column in columns)})) AS h
+            FROM {side["schema"]}.{side["table"]} fw
+            {where}
+        ) t
+        GROUP BY bucket;
+        """
+    pg_conn = PostgresHook(postgres_conn_id=side["conn_id"]).get_conn()
+    try:
+        with closing(pg_conn.cursor(cursor_factory=RealDictCursor)) as cursor:
+            cursor.execute(
+                query,
+                {"length": length, "parent_length": length - 1, "parents": parents},
+            )
+            return {row["bucket"]: (row["cnt"], int(row["h1"]), int(row["h2"])) for row in cursor.fetchall()}
+    finally:
+        pg_conn.close()
+
+
+def _pg_rows(side: Dict, columns: List[str], length: int, prefixes: List[str]) -> Dict[str, str]:
+    """md5 строк Postgres в корзинах prefixes"""
+    query = f"""
+        SELECT fw.id::text AS id, MD5(CONCAT_WS('|', {", ".join(_pg_canonical(column) for column in columns)})) AS h
+        FROM {side["schema"]}.{side["table"]} fw
+        WHERE LEFT(fw.id::text, %(length)s) = ANY(%(prefixes)s);
+        """
+    pg_conn = PostgresHook(postgres_conn_id=side["conn_id"]).get_conn()
+    try:
+        with closing(pg_conn.cursor(cursor_factory=RealDictCursor)) as cursor:
+            cursor.execute(query, {"length": length, "prefixes": prefixes})
+            return {row["id"]: row["h"] for row in cursor.fetchall()}
+    finally:
+        pg_conn.close()
+
+
+@contextmanager
+def _sqlite_checksum_conn(side: Dict) -> sqlite3.Connection:
+    """Read-only подключение SQLite с функциями md5 строк"""
+    with _sqlite_conn_context(side["db_name"], read_only=True) as conn:
+        conn.create_function("etl_md5", 1, lambda text: md5(text.encode("utf-8")).hexdigest(), deterministic=True)
+        conn.create_function("etl_hex", 1, lambda text: int(text, 16), deterministic=True)
+        yield conn
+
+
+def _sqlite_row_hash_sql(columns: List[str]) -> str:
+    separator = " || '|' || "
+    return f"etl_md5({separator.join(_sqlite_canonical(column) for column in columns)})"
+
+
+def _sqlite_buckets(side: Dict, columns: List[str], length: int, parents: Optional[List[str]]) -> Dict[str, Bucket]:
+    """Суммы корзин SQLite (md5 строк - функцией etl_md5 подключения)"""
+    where = "" if parents is None else f"WHERE SUBSTR(fw.id, 1, {length - 1}) IN ({{placeholders}})"
+    query = f"""
+        SELECT bucket, COUNT(*) AS cnt, SUM(etl_hex(SUBSTR(h, 1, 8))) AS h1, SUM(etl_hex(SUBSTR(h, 9, 8))) AS h2
+        FROM (
+            SELECT SUBSTR(fw.id, 1, {length}) AS bucket, {_sqlite_row_hash_sql(columns)} AS h
+            FROM {SQLiteDBTables.film.value} fw
+            {where}
+        )
+        GROUP BY bucket;
+        """
+    with _sqlite_checksum_conn(side) as conn:
+        with closing(conn.cursor()) as cursor:
+            if parents is None:
+                rows = cursor.execute(query).fetchall()
+            else:
+                rows = _select_in(cursor, query, parents)
+            return {row["bucket"]: (row["cnt"], row["h1"], row["h2"]) for row in rows}
+
+
+def _sqlite_rows(side: Dict, columns: List[str], length: int, prefixes: List[str]) -> Dict[str, str]:
+    """md5 строк SQLite в корзинах prefixes"""
+    query = f"""
+        SELECT fw.id AS id, {_sqlite_row_hash_sql(columns)} AS h
+        FROM {SQLiteDBTables.film.value} fw
+        WHERE SUBSTR(fw.id, 1, {length}) IN ({{placeholders}});
+        """
+    with _sqlite_checksum_conn(side) as conn:
+        with closing(conn.cursor()) as cursor:
+            return {row["id"]: row["h"] for row in _select_in(cursor, query, prefixes)}
+
+
+def _es_scan(side: Dict, columns: List[str], prefixes: Optional[List[str]]) -> Iterator[Tuple[str, str]]:
+    """Потоковое чтение документов Elasticsearch: (id, md5 строки)"""
+    es_conn = _get_es_connection(side["conn_id"])
+    if prefixes is None:
+        query = {"match_all": {}}
+    else:
+        query = {"bool": {"should": [{"prefix": {ID_COLUMN: prefix}} for prefix in prefixes]}}
+    for hit in helpers.scan(
+            es_conn,
+            index=side["index"],
+            query={"query": query, "_source": columns},
+            size=ES_PAGE_SIZE,
+    ):
+        yield hit["_id"], _row_hash({**hit["_source"], ID_COLUMN: hit["_id"]}, columns)
+
+
+def _es_buckets(side: Dict, columns: List[str], length: int, parents: Optional[List[str]]) -> Dict[str, Bucket]:
+    """Суммы корзин Elasticsearch (md5 строк считается при потоковом чтении)"""
+    buckets = {}
+    for film_id, row_hash in _es_scan(side, columns, parents):
+        count, h1, h2 = buckets.get(film_id[:length], (0, 0, 0))
+        part1, part2 = _hash_parts(row_hash)
+        buckets[film_id[:length]] = (count + 1, h1 + part1, h2 + part2)
+    return buckets
+
+
+def _es_rows(side: Dict, columns: List[str], length: int, prefixes: List[str]) -> Dict[str, str]:
+    """md5 строк Elasticsearch в корзинах prefixes"""
+    return dict(_es_scan(side, columns, prefixes))
+
+
+# контрольные суммы по типу подключения: (суммы корзин, md5 строк корзин)
+CHECKSUMS: Dict[str, Tuple[Callable, Callable]] = {
+    "postgres": (_pg_buckets, _pg_rows),
+    "sqlite": (_sqlite_buckets, _sqlite_rows),
+    "elasticsearch": (_es_buckets, _es_rows),
+}
+
+
+def _get_checksums(side: Dict) -> Tuple[Callable, Callable]:
+    if side["conn_type"] not in CHECKSUMS:
+        raise AirflowException(f"Reconciliation is not supported for connection type {side['conn_type']}")
+    return CHECKSUMS[side["conn_type"]]
+
+
+def _batched(values: Optional[List[str]]) -> Iterator[Optional[List[str]]]:
+    """Порции префиксов (None - вся таблица)"""
+    if values is None:
+        yield None
+        return
+    for start in range(0, len(values), RECONCILE_PREFIX_BATCH):
+        yield values[start:start + RECONCILE_PREFIX_BATCH]
+
+
+def _collect(func: Callable, side: Dict, columns: List[str], length: int, prefixes: Optional[List[str]]) -> Dict:
+    result = {}
+    for part in _batched(prefixes):
+        result.update(func(side, columns, length, part))
+    return result
+
+
+def _diff_buckets(source: Dict, sink: Dict, columns: List[str], leaf_rows: int) -> Dict[int, List[str]]:
+    """Спуск по дереву префиксов id: только в различающиеся корзины, до корзин из leaf_rows строк"""
+    source_buckets, _ = _get_checksums(source)
+    sink_buckets, _ = _get_checksums(sink)
+    leaves: Dict[int, List[str]] = {}
+    length, parents = RECONCILE_ROOT_PREFIX, None
+    while parents is None or parents:
+        source_sums = _collect(source_buckets, source, columns, length, parents)
+        sink_sums = _collect(sink_buckets, sink, columns, length, parents)
+        buckets = set(source_sums) | set(sink_sums)
+        differ = sorted(bucket for bucket in buckets if source_sums.get(bucket) != sink_sums.get(bucket))
+        logging.info("Prefix length %s: %s buckets, %s differ", length, len(buckets), len(differ))
+
+        parents = []
+        for bucket in differ:
+            rows = max(source_sums.get(bucket, (0,))[0], sink_sums.get(bucket, (0,))[0])
+            if rows > leaf_rows and length < MAX_PREFIX:
+                parents.append(bucket)
+            else:
+                leaves.setdefault(length, []).append(bucket)
+        length += 1
+    return leaves
+
+
+def reconcile_compare(ti: TaskInstance, **context) -> Dict:
+    """Сверка источника и приемника по контрольным суммам корзин id, отбор различающихся id"""
+    params = context["params"]
+    columns = _get_columns(params["fields"])
+    source = _get_side(params["in_db_id"], params["id_db_params"])
+    sink = _get_side(params["out_db_id"], params["out_db_params"])
+    leaf_rows = params.get("reconcile_leaf_rows") or RECONCILE_LEAF_ROWS
+    logging.info("Reconciling %s -> %s by %s", source["conn_id"], sink["conn_id"], ", ".join(columns))
+
+    _, source_rows = _get_checksums(source)
+    _, sink_rows = _get_checksums(sink)
+    mismatched, extra = [], 0
+    for length, prefixes in _diff_buckets(source, sink, columns, leaf_rows).items():
+        source_hashes = _collect(source_rows, source, columns, length, prefixes)
+        sink_hashes = _collect(sink_rows, sink, columns, length, prefixes)
+        mismatched.extend(
+            film_id for film_id, row_hash in source_hashes.items() if sink_hashes.get(film_id) != row_hash
+        )
+        extra += len(set(sink_hashes) - set(source_hashes))
+
+    # id есть только в приемнике - удаления не переносятся, только учитываются
+    report = {"mismatched": len(mismatched), "extra": extra}
+    logging.info("Reconciliation: %s movies differ or are missing in sink, %s only in sink", len(mismatched), extra)
+    stage(ti, ti.task_id, encode({"ids": sorted(mismatched), **report}), **context)
+    return report
+
+
+def _pg_fetch(film_ids: List[str], **context) -> List[Dict]:
+    """Данные фильмов из Postgres в формате pg_get_films_data"""
+    params = context["params"]
+    source_mode = params.get("source_mode") or SOURCE_MODE_JOIN
+    if source_mode == SOURCE_MODE_DIM_CACHE:
+        source_mode = SOURCE_MODE_JOIN
+    query = _pg_get_films_query(params["id_db_params"]["schema"], params["fields"], source_mode)
+    pg_conn = PostgresHook(postgres_conn_id=params["in_db_id"]).get_conn()
+    try:
+        with closing(pg_conn.cursor(cursor_factory=RealDictCursor)) as cursor:
+            cursor.execute(query, {"id": tuple(film_ids), "dt_fmt": DT_FMT_PG})
+            return cursor.fetchall()
+    finally:
+        pg_conn.close()
+
+
+def _sqlite_fetch(film_ids: List[str], **context) -> List[Dict]:
+    """Данные фильмов из SQLite в формате sqlite_get_films_data"""
+    return _sqlite_read_part(_sqlite_get_films_query(context["params"]["fields"]), film_ids, **context)
+
+
+def _es_fetch(film_ids: List[str], **context) -> List[Dict]:
+    """Данные фильмов из Elasticsearch в формате es_get_films_data"""
+    es_conn = _get_es_connection(context["params"]["in_db_id"])
+    response = es_conn.search(
+        index=context["params"]["id_db_params"]["index"],
+        query={"ids": {"values": film_ids}},
+        size=len(film_ids),
+    )
+    return _get_transformed_items(response["hits"]["hits"], context["params"]["fields"])
+
+
+# чтение фильмов источника по id: тип подключения -> функция
+SOURCES = {
+    "postgres": _pg_fetch,
+    "sqlite": _sqlite_fetch,
+    "elasticsearch": _es_fetch,
+}
+
+
+def reconcile_resync(ti: TaskInstance, **context):
+    """Повторная запись различающихся фильмов обычным путем записи приемника"""
+    staged = load_staged(ti, "reconcile_compare", **context)
+    film_ids = decode(staged)["ids"] if staged else []
+    if not film_ids or not context["params"].get("reconcile_resync"):
+        logging.info("No records to resync, %s movies differ", len(film_ids))
+        clear_run(ti, **context)
+        return
+
+    source_type = BaseHook.get_connection(context["params"]["in_db_id"]).conn_type
+    sink_type = BaseHook.get_connection(context["params"]["out_db_id"]).conn_type
+    if sink_type not in SINKS:
+        raise AirflowException(f"Resync is not supported for output db connection type {sink_type}")
+    fetch = SOURCES[source_type]
+    transform, write = SINKS[sink_type]
+
+    for batch_index, batch in pending_batches(ti, film_ids, **context):
+        films_data = fetch(batch, **context)
+        write(ti, transform(films_data), batch_index, **context)
+        commit_batch(ti, batch_index, **context)
+        logging.info("Batch %s resynced, %s movies", batch_index, len(films_data))
+    logging.info("Resync completed, %s movies", len(film_ids))
+    clear_run(ti, **context)
@@ -0,0 +1,23 @@
+from db.pg import pg_transform, pg_write_films, pg_create_schema
+from db.es import es_transform, es_write_films, es_create_index, es_finish_load
+from db.file import file_transform, file_write_films
+from db.sqlite import sqlite_transform, sqlite_write_films
+
+# приемники с записью произвольных батчей: тип подключения -> (преобразование, запись батча)
+SINKS = {
+    "postgres": (pg_transform, pg_write_films),
+    "elasticsearch": (es_transform, es_write_films),
+    "fs": (file_transform, file_write_films),
+    "sqlite": (sqlite_transform, sqlite_write_films),
+}
+
+# подготовка приемника (схема / индекс) перед записью
+SINKS_PREPARE = {
+    "postgres": pg_create_schema,
+    "elasticsearch": es_create_index,
+}
+
+# завершение загрузки (возврат настроек приемника)
+SINKS_FINISH = {
+    "elasticsearch": es_finish_load,
+}
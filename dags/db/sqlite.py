@@ -1,5 +1,7 @@
-from typing import List, Set, Tuple
+from typing import Dict, List, Set, Tuple, Union
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+import math
 import time
 import json
 import logging
@@ -10,7 +12,30 @@ from contextlib import contextmanager, closing
 from airflow.models.taskinstance import TaskInstance
 from airflow.hooks.base_hook import BaseHook
 
-from settings import DBFields, SQLiteDBTables, MOVIES_UPDATED_STATE_KEY, MOVIES_UPDATED_STATE_KEY_TMP
+from settings import (
+    DBFields,
+    SQLiteDBTables,
+    MOVIES_UPDATED_STATE_KEY_TMP,
+    SOURCE_MODE_DIM_CACHE,
+    SQLITE_MMAP_SIZE,
+    SQLITE_CACHE_KIB,
+    SQLITE_READ_WORKERS,
+    SQLITE_PARALLEL_MIN_ROWS,
+    SQLITE_RANGE_MAX_SPAN,
+)
+from utils.dim_cache import NESTED_COLUMNS, PERSON_ROLES, build_films_nested, get_cache
+from utils.state import get_updated_state
+from utils.chunk_tuner import get_chunk_size
+from utils.lease import LEASE_MIN_ID, claim_window, is_leasing
+from utils.log import summary, dump_payload
+from utils.dead_letter import get_dead_letter_ids, is_replay, write_isolated
+from utils.checkpoint import load_staged, stage, pending_batches, get_committed_batch, commit_batch
+from utils.codecs import encode, decode
+
+# ограничение SQLite на число параметров запроса
+SQLITE_MAX_VARIABLES = 500
+# ошибки данных отдельной строки - такие строки уходят в dead letter
+SQLITE_DATA_ERRORS = (sqlite3.IntegrityError, sqlite3.InterfaceError, sqlite3.DataError)
 
 SQLITE_FIELDS_TO_SQL = {
     DBFields.film_id.name: "fw.id",
@@ -30,35 +55,170 @@ SQLITE_FIELDS_TO_SQL = {
 }
 
 
+def _db_path(db_name: str) -> str:
+    """Путь до файла базы SQLite"""
+    if 'out' in db_name:
+        return db_name
+    return '/db/' + db_name  # путь до каталога, где лежит скрипт
+
+
 @contextmanager
-def _conn_context(db_name: str) -> sqlite3.Connection:
+def _conn_context(db_name: str, read_only: bool = False, immutable: bool = False) -> sqlite3.Connection:
     """Подключение к базе SQLite"""
-    if 'out' in db_name:
-        db_path = db_name
+    if read_only:
+        # immutable=1 - без блокировок и проверок изменений, только для неизменяемого файла
+        uri = f"file:{_db_path(db_name)}?{'immutable=1' if immutable else 'mode=ro'}"
+        conn = sqlite3.connect(uri, uri=True)
+        conn.execute("PRAGMA query_only = ON")
+        conn.execute(f"PRAGMA mmap_size = {SQLITE_MMAP_SIZE}")
+        conn.execute(f"PRAGMA cache_size = -{SQLITE_CACHE_KIB}")
     else:
-        db_path = '/db/' + db_name  # путь до каталога, где лежит скрипт
-    conn = sqlite3.connect(db_path)
+        conn = sqlite3.connect(_db_path(db_name))
     conn.row_factory = sqlite3.Row  # row_factory - данные в формате «ключ-значение»
     yield conn
     conn.close()
 
 
-def sqlite_get_updated_movies_ids(ti: TaskInstance, **context) -> Set:
-    """Сбор обновленных записей в таблице с фильмами"""
-    logging.info(f'sqlite_get_updated_movies_ids; context= , {context["params"]}')
+def _source_conn_context(**context) -> sqlite3.Connection:
+    """Read-only подключение к базе-источнику"""
+    db_name = BaseHook.get_connection(context["params"]["in_db_id"]).schema
+    return _conn_context(db_name, read_only=True, immutable=context["params"].get("sqlite_immutable", False))
 
-    query = f"""
-        SELECT id, updated_at
-        FROM {SQLiteDBTables.film.value}
-        WHERE updated_at >= ?
-        ORDER BY updated_at
-        LIMIT {context["params"]["chunk_size"]}
+
+def _placeholders(values: List) -> str:
+    """Строка плейсхолдеров для IN (...)"""
+    return ", ".join("?" * len(values))
+
+
+def _select_in(cursor, query: str, values: List) -> List[sqlite3.Row]:
+    """Выполнение запроса с IN (...) порциями по SQLITE_MAX_VARIABLES"""
+    rows = []
+    for start in range(0, len(values), SQLITE_MAX_VARIABLES):
+        part = values[start:start + SQLITE_MAX_VARIABLES]
+        cursor.execute(query.format(placeholders=_placeholders(part)), part)
+        rows.extend(cursor.fetchall())
+    return rows
+
+
+def _read_part(query: str, film_ids: List[str], **context) -> List[Dict]:
+    """Чтение части фильмов в отдельном read-only подключении"""
+    with _source_conn_context(**context) as conn:
+        with closing(conn.cursor()) as cursor:
+            return [dict(row) for row in _select_in(cursor, query, film_ids)]
+
+
+def _read_range(query: str, lower: int, upper: int, rowids: Set[int], **context) -> List[Dict]:
+    """Чтение диапазона rowid в отдельном read-only подключении (лишние фильмы диапазона отбрасываются)"""
+    with _source_conn_context(**context) as conn:
+        with closing(conn.cursor()) as cursor:
+            rows = cursor.execute(query, (lower, upper)).fetchall()
+    films_data = []
+    for row in rows:
+        film_data = dict(row)
+        if film_data.pop("etl_rowid") in rowids:
+            films_data.append(film_data)
+    return films_data
+
+
+def _select_parallel(cursor, fields: List[str], film_ids: List[str], **context) -> List[Dict]:
+    """Чтение фильмов по диапазонам rowid в пуле потоков (sqlite3 отпускает GIL на время запроса)"""
+    query = _get_films_query(fields)
+    workers = context["params"].get("sqlite_read_workers") or SQLITE_READ_WORKERS
+    if workers <= 1 or len(film_ids) < SQLITE_PARALLEL_MIN_ROWS:
+        return [dict(row) for row in _select_in(cursor, query, film_ids)]
+
+    # соседние rowid лежат на соседних страницах - каждый поток читает свой участок файла
+    rowids = sorted(
+        row[0] for row in _select_in(
+            cursor, f"SELECT rowid FROM {SQLiteDBTables.film.value} WHERE id IN ({{placeholders}})", film_ids
+        )
+    )
+    part_size = math.ceil(len(rowids) / workers)
+    parts = [rowids[start:start + part_size] for start in range(0, len(rowids), part_size)]
+    range_query = _get_films_query(fields, "fw.rowid BETWEEN ? AND ?", with_rowid=True)
+    rowid_query = _get_films_query(fields, "fw.rowid IN ({placeholders})")
+    logging.info("Reading %s movies in %s rowid ranges", len(rowids), len(parts))
+
+    def read(part: List[int]) -> List[Dict]:
+        if part[-1] - part[0] + 1 > len(part) * SQLITE_RANGE_MAX_SPAN:
+            # обновленные фильмы разрежены: диапазон прочитал бы в разы больше строк, чем нужно
+            return _read_part(rowid_query, part, **context)
+        return _read_range(range_query, part[0], part[-1], set(part), **context)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(read, parts)
+        return [film_data for result in results for film_data in result]
+
+
+def _get_dimension(cursor, conn_id: str, table: SQLiteDBTables, name_column: str, ids: Set[str]) -> Dict:
+    """Значения справочника (person/genre) по id через кэш справочников"""
+    cache = get_cache(conn_id, table.value)
+
+    def load_updated(since) -> Dict[str, str]:
+        cursor.execute(f"SELECT id, {name_column} AS name FROM {table.value} WHERE updated_at > ?", (since,))
+        return {row["id"]: row["name"] for row in cursor.fetchall()}
+
+    def load_by_ids(missing: List[str]) -> Dict[str, str]:
+        query = f"SELECT id, {name_column} AS name FROM {table.value} WHERE id IN ({{placeholders}})"
+        return {row["id"]: row["name"] for row in _select_in(cursor, query, missing)}
+
+    cursor.execute(f"SELECT MAX(updated_at) AS max_updated_at, COUNT(*) AS cnt FROM {table.value}")
+    watermark = cursor.fetchone()
+    cache.refresh((watermark["max_updated_at"], watermark["cnt"]), load_updated)
+    return cache.get_many(ids, load_by_ids) if ids else {}
+
+
+def _get_films_data_dim_cache(cursor, conn_id: str, fields: List[str], film_ids: List[str]) -> List[Dict]:
+    """Сбор данных по фильмам: строки фильмов и id связей из базы, персоны и жанры из кэша"""
+    film_columns = ["fw.id AS id"] + [
+        SQLITE_FIELDS_TO_SQL[field] for field in fields
+        if DBFields[field].value not in NESTED_COLUMNS and field != DBFields.film_id.name
+    ]
+    query = f"SELECT {', '.join(film_columns)} FROM {SQLiteDBTables.film.value} fw WHERE fw.id IN ({{placeholders}})"
+    films = [dict(row) for row in _select_in(cursor, query, film_ids)]
+
+    person_links, persons = [], {}
+    if any(DBFields[field].value in PERSON_ROLES.values() for field in fields):
+        query = f"""
+            SELECT film_work_id, person_id, role FROM {SQLiteDBTables.film_person.value}
+            WHERE film_work_id IN ({{placeholders}})
+            """
+        person_links = [tuple(row) for row in _select_in(cursor, query, film_ids)]
+        persons = _get_dimension(
+            cursor, conn_id, SQLiteDBTables.person, "full_name", {link[1] for link in person_links}
+        )
+
+    genre_links, genres = [], {}
+    if DBFields.genre.name in fields:
+        query = f"""
+            SELECT film_work_id, genre_id FROM {SQLiteDBTables.film_genre.value}
+            WHERE film_work_id IN ({{placeholders}})
+            """
+        genre_links = [tuple(row) for row in _select_in(cursor, query, film_ids)]
+        genres = _get_dimension(cursor, conn_id, SQLiteDBTables.genre, "name", {link[1] for link in genre_links})
+
+    return build_films_nested(films, fields, person_links, genre_links, persons, genres)
+
+
+def _get_films_query(fields: List[str], where: str = "fw.id IN ({placeholders})", with_rowid: bool = False) -> str:
+    """Подготовка запроса агрегированных данных по фильмам (по умолчанию - IN ({placeholders}))"""
+    columns = (["fw.rowid AS etl_rowid"] if with_rowid else []) + [SQLITE_FIELDS_TO_SQL[field] for field in fields]
+    fields_query = ", ".join(columns)
+    return f"""
+        SELECT {fields_query}
+        FROM {SQLiteDBTables.film.value} fw
+        LEFT JOIN {SQLiteDBTables.film_person.value} pfw ON pfw.film_work_id = fw.id
+        LEFT JOIN {SQLiteDBTables.person.value} p ON p.id = pfw.person_id
+        LEFT JOIN {SQLiteDBTables.film_genre.value} gfw ON gfw.film_work_id = fw.id
+        LEFT JOIN {SQLiteDBTables.genre.value} g ON g.id = gfw.genre_id
+        WHERE {where}
+        GROUP BY fw.id;
         """
 
-    updated_state = ti.xcom_pull(
-        key=MOVIES_UPDATED_STATE_KEY, include_prior_dates=True
-    ) or str(datetime.min) + '.0'
-    logging.info(f'{ti.xcom_pull(key=MOVIES_UPDATED_STATE_KEY, include_prior_dates=True)=}')
+
+def _get_updated_state(**context) -> Union[float, str]:
+    """Подготовка updated_state в формате SQLite"""
+    updated_state = get_updated_state(**context) or str(datetime.min) + '.0'
     logging.info(f'{str(datetime.min)=}')
     logging.info(f'{updated_state=}, {type(updated_state)=}')
     try:
@@ -69,66 +229,135 @@ def sqlite_get_updated_movies_ids(ti: TaskInstance, **context) -> Set:
 
     msg = f"{updated_state_sqlite=}, {type(updated_state_sqlite)=}"
     logging.info(msg)
+    return updated_state_sqlite
+
+
+def _get_updated_ids_query(limit: int) -> str:
+    """Подготовка запроса id фильмов, обновленных после контрольной точки"""
+    return f"""
+        SELECT id, updated_at
+        FROM {SQLiteDBTables.film.value}
+        WHERE updated_at >= ?
+        ORDER BY updated_at
+        LIMIT {limit}
+        """
+
+
+def _get_leased_ids_query(limit: int) -> str:
+    """Подготовка запроса id фильмов после ключа (updated_at, id)"""
+    return f"""
+        SELECT id, updated_at
+        FROM {SQLiteDBTables.film.value}
+        WHERE (updated_at, id) > (?, ?)
+        ORDER BY updated_at, id
+        LIMIT {limit}
+        """
+
+
+def _get_window_ids_query() -> str:
+    """Подготовка запроса id фильмов окна (lower, upper] по ключу (updated_at, id)"""
+    return f"""
+        SELECT id, updated_at
+        FROM {SQLiteDBTables.film.value}
+        WHERE (updated_at, id) > (?, ?) AND (updated_at, id) <= (?, ?)
+        ORDER BY updated_at, id
+        """
+
+
+def sqlite_get_updated_movies_ids(ti: TaskInstance, **context) -> Set:
+    """Сбор обновленных записей в таблице с фильмами"""
+    logging.info(f'sqlite_get_updated_movies_ids; context= , {context["params"]}')
+
+    query = _get_updated_ids_query(get_chunk_size(**context))
+
+    updated_state_sqlite = _get_updated_state(**context)
+
+    staged = load_staged(ti, ti.task_id, **context)
+    if staged:
+        staged = json.loads(staged)
+        if staged["state"]:
+            ti.xcom_push(key=MOVIES_UPDATED_STATE_KEY_TMP, value=staged["state"])
+        return set(staged["ids"])
+
+    if is_replay(**context):
+        # контрольная точка при повторе не двигается
+        ids = get_dead_letter_ids(**context)
+        logging.info("Replaying %s dead letters", len(ids))
+        stage(ti, ti.task_id, json.dumps({"ids": ids, "state": None}), **context)
+        return set(ids)
 
     # имя файла базы данных из Admin-Connections-Schema
     db_name = BaseHook.get_connection(context["params"]["in_db_id"]).schema
     logging.info(f"{db_name=}")
 
-    with _conn_context(db_name) as conn:
+    with _source_conn_context(**context) as conn:
         with closing(conn.cursor()) as cursor:
             try:
-                cursor.execute(query, (updated_state_sqlite,))
+                if is_leasing(**context):
+                    data = claim_window(
+                        lambda lower: cursor.execute(
+                            _get_leased_ids_query(get_chunk_size(**context)), lower
+                        ).fetchall(),
+                        lambda lower, upper: cursor.execute(_get_window_ids_query(), (*lower, *upper)).fetchall(),
+                        (updated_state_sqlite, LEASE_MIN_ID),
+                        **context,
+                    )
+                else:
+                    cursor.execute(query, (updated_state_sqlite,))
+                    data = cursor.fetchall()
                 # cursor.execute("""select * from person;""")
-                data = cursor.fetchall()
                 data_dict = [dict(i) for i in data]
-                logging.info(f'{data_dict=}')
+                logging.info("Updated movies: %s", summary(data_dict))
             except Exception as err:
                 logging.error(f'<<SELECT ERROR>> {err}')
+                raise err
 
-    if data_dict:
-        ti.xcom_push(key=MOVIES_UPDATED_STATE_KEY_TMP, value=str(data_dict[-1]["updated_at"]))
-    logging.error(f'MOVIES_UPDATED_STATE_KEY_TMP {data_dict[-1]["updated_at"]=}')
-    return set([x["id"] for x in data_dict])
+    state = str(data_dict[-1]["updated_at"]) if data_dict else None
+    if state:
+        ti.xcom_push(key=MOVIES_UPDATED_STATE_KEY_TMP, value=state)
+        logging.info(f'MOVIES_UPDATED_STATE_KEY_TMP {state=}')
+    ids = [x["id"] for x in data_dict]
+    stage(ti, ti.task_id, json.dumps({"ids": ids, "state": state}), **context)
+    return set(ids)
 
 
 def sqlite_get_films_data(ti: TaskInstance, **context):
     """Сбор агрегированных данных по фильмам"""
     logging.info(f'context["params"]["fields"]= {context["params"]["fields"]}')
-    fields_query = ", ".join([SQLITE_FIELDS_TO_SQL[field] for field in context["params"]["fields"]])
 
     film_ids = ti.xcom_pull(task_ids="sqlite_get_updated_movies_ids")
-    logging.info(f'film_ids= {film_ids}')
+    logging.info("Film ids: %s", summary(film_ids))
     if len(film_ids) == 0:
         logging.info("No records need to be updated")
         return
 
-    query = f"""
-        SELECT {fields_query}
-        FROM {SQLiteDBTables.film.value} fw
-        LEFT JOIN {SQLiteDBTables.film_person.value} pfw ON pfw.film_work_id = fw.id
-        LEFT JOIN {SQLiteDBTables.person.value} p ON p.id = pfw.person_id
-        LEFT JOIN {SQLiteDBTables.film_genre.value} gfw ON gfw.film_work_id = fw.id
-        LEFT JOIN {SQLiteDBTables.genre.value} g ON g.id = gfw.genre_id
-        WHERE fw.id IN {tuple(film_ids)}
-        GROUP BY fw.id;
-        """
+    staged = load_staged(ti, ti.task_id, **context)
+    if staged:
+        return staged
+
+    query = _get_films_query(context["params"]["fields"])
     logging.info(f'query= {query}')
 
     # имя файла базы данных из Admin-Connections-Schema
     db_name = BaseHook.get_connection(context["params"]["in_db_id"]).schema
     logging.info(f"{db_name=}")
 
-    with _conn_context(db_name) as conn:
+    with _source_conn_context(**context) as conn:
         with closing(conn.cursor()) as cursor:
             try:
-                cursor.execute(query)
-                data = cursor.fetchall()
-                data_dict = [dict(i) for i in data]
-                logging.info(f'{data_dict[0]=}')
+                if context["params"].get("source_mode") == SOURCE_MODE_DIM_CACHE:
+                    data_dict = _get_films_data_dim_cache(
+                        cursor, context["params"]["in_db_id"], context["params"]["fields"], list(film_ids)
+                    )
+                else:
+                    data_dict = _select_parallel(cursor, context["params"]["fields"], list(film_ids), **context)
+                logging.info("Films data: %s", summary(data_dict))
+                dump_payload("films_data", data_dict, **context)
             except Exception as err:
                 logging.error(f'<<SELECT ERROR>> {err}')
+                raise err
 
-    return json.dumps(data_dict, indent=4)
+    return stage(ti, ti.task_id, encode(data_dict), **context)
 
 
 def sqlite_preprocess(ti: TaskInstance, **context):
@@ -136,16 +365,16 @@ def sqlite_preprocess(ti: TaskInstance, **context):
     prev_task = ti.xcom_pull(task_ids="in_db_branch_task")[-1]
     logging.info(f'{prev_task=}')
     films_data = ti.xcom_pull(task_ids=prev_task)
-    films_data = json.loads(films_data)
-    logging.info(f'{films_data=}')
+    films_data = decode(films_data)
     if not films_data:
         logging.info("No records need to be updated")
         return
 
     transformed_films_data = films_data
-    logging.info(f'{transformed_films_data=}')
+    logging.info("Transformed films data: %s", summary(transformed_films_data))
+    dump_payload("films_data", transformed_films_data, **context)
 
-    return json.dumps(transformed_films_data, indent=4)
+    return encode(transformed_films_data)
 
 
 def _prepare_insert_values_list(films_data: json) -> Tuple[List, Tuple]:
@@ -156,14 +385,14 @@ def _prepare_insert_values_list(films_data: json) -> Tuple[List, Tuple]:
         key, value = zip(*dict_a.items())
         fields, values = tuple(key), tuple(value)
         values_list.append(values)
-    logging.info(f'{values_list[0]=}')
+    logging.debug("Insert values: %s", summary(values_list))
     return values_list, fields
 
 
-def _prepare_insert_query(films_data: json, fields: tuple) -> str:
-    """Подготовка SQL команды к загрузке"""
+def _prepare_insert_query(films_data: json, fields: tuple, conflict: str = "IGNORE") -> str:
+    """Подготовка SQL команды к загрузке (conflict - IGNORE или REPLACE для существующих id)"""
     query = f"""
-            INSERT OR IGNORE INTO {SQLiteDBTables.film.value} {fields}
+            INSERT OR {conflict} INTO {SQLiteDBTables.film.value} {fields}
             VALUES ({'?' + ',?' * (len(films_data[0]) - 1)});
     """
     logging.info(f'{len(films_data[0])=}')
@@ -231,33 +460,71 @@ def _test_select_count(cursor):
         raise err
 
 
+def sqlite_transform(films_data: List[Dict]) -> List[Dict]:
+    """Преобразование записей для SQLite (записываются как есть)"""
+    return films_data
+
+
+def sqlite_write_films(ti: TaskInstance, films_data: List[Dict], batch: int, **context):
+    """Запись подготовленного батча фильмов в SQLite (замена существующих записей, без пересоздания таблицы)"""
+    db_name = BaseHook.get_connection(context["params"]["out_db_id"]).schema
+    _, fields = _prepare_insert_values_list(films_data[:1])
+    insertion_query = _prepare_insert_query(films_data, fields, conflict="REPLACE")
+
+    with _conn_context(db_name) as conn:
+        with closing(conn.cursor()) as cursor:
+            create_table(_prepare_create_query(), cursor)
+
+            def write(films: List[Dict]):
+                try:
+                    insert_into_new_table(insertion_query, _prepare_insert_values_list(films)[0], cursor)
+                    conn.commit()
+                except sqlite3.Error:
+                    conn.rollback()
+                    raise
+
+            write_isolated(films_data, write, SQLITE_DATA_ERRORS, **context)
+
+
 def sqlite_write(ti: TaskInstance, **context):
     """Запись данных"""
     films_data = ti.xcom_pull(task_ids="sqlite_preprocess")
-    logging.info(f'JSON {films_data=}')
     if not films_data:
         logging.info("No records need to be updated")
         return
-    films_data = json.loads(films_data)
-    logging.info(f'{type(films_data)=}, {films_data=}')
+    films_data = decode(films_data)
+    logging.info("Films data: %s", summary(films_data))
 
     # имя файла базы данных из Admin-Connections-Schema
     db_name = BaseHook.get_connection(context["params"]["out_db_id"]).schema
     logging.info(f"{db_name=}")
 
     creation_query = _prepare_create_query()
-    values_list, fields = _prepare_insert_values_list(films_data)
+    _, fields = _prepare_insert_values_list(films_data[:1])
     insertion_query = _prepare_insert_query(films_data, fields)
 
     with _conn_context(db_name) as conn:
         with closing(conn.cursor()) as cursor:
-            drop_table_if_exists(cursor)
-            conn.commit()
-
-            create_table(creation_query, cursor)
-            conn.commit()
-
-            insert_into_new_table(insertion_query, values_list, cursor)
-            conn.commit()
+            # при повторе после сбоя таблица уже пересоздана и частично заполнена
+            if get_committed_batch(ti, **context) < 0:
+                drop_table_if_exists(cursor)
+                conn.commit()
+
+                create_table(creation_query, cursor)
+                conn.commit()
+
+            def write(batch: List[Dict]):
+                try:
+                    insert_into_new_table(insertion_query, _prepare_insert_values_list(batch)[0], cursor)
+                    conn.commit()
+                except sqlite3.Error:
+                    conn.rollback()
+                    raise
+
+            for batch_index, batch in pending_batches(ti, films_data, **context):
+                # строки с неподдерживаемыми значениями уходят в dead letter, остальные записываются
+                rejected = write_isolated(batch, write, SQLITE_DATA_ERRORS, **context)
+                commit_batch(ti, batch_index, **context)
+                logging.info("Batch %s committed, %s movies, %s rejected", batch_index, len(batch), rejected)
 
             _test_select_count(cursor)
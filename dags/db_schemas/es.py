@@ -1,4 +1,10 @@
-from settings import DBFields
+from settings import (
+    DBFields,
+    ES_INDEX_PROFILE_DEFAULT,
+    ES_INDEX_PROFILE_WRITE_HEAVY,
+    ES_INDEX_PROFILE_READ_INCREMENTAL,
+    ES_INDEX_SHARDS,
+)
 
 
 MOVIES_BASE = {
@@ -75,3 +81,19 @@ MOVIE_FIELDS = {
     DBFields.film_created_at.name: {"type": "date", "format": "yyyy-MM-dd HH:mm:ss"},
     DBFields.film_updated_at.name: {"type": "date", "format": "yyyy-MM-dd HH:mm:ss"},
 }
+
+
+# настройки на время загрузки (динамические, меняются на существующем индексе); после загрузки возвращаются
+# прежние значения индекса, SERVING_SETTINGS - если индекс уже остался в настройках загрузки
+WRITE_HEAVY_SETTINGS = {"number_of_replicas": 0, "refresh_interval": "-1", "translog": {"durability": "async"}}
+SERVING_SETTINGS = {"number_of_replicas": 1, "refresh_interval": "1s", "translog": {"durability": "request"}}
+
+INDEX_PROFILES = {
+    ES_INDEX_PROFILE_DEFAULT: {},
+    # настройки загрузки выставляются после создания, чтобы сохранить исходные для возврата
+    ES_INDEX_PROFILE_WRITE_HEAVY: {"number_of_shards": ES_INDEX_SHARDS},
+    ES_INDEX_PROFILE_READ_INCREMENTAL: {"number_of_shards": ES_INDEX_SHARDS},
+}
+
+# сортировка сегментов индекса (только при создании индекса)
+INDEX_SORT_FIELDS = [DBFields.film_updated_at.name, DBFields.film_id.name]
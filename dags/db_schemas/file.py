@@ -0,0 +1,20 @@
+from settings import DBFields
+
+PERSONS = "persons"
+GENRES = "genres"
+TIMESTAMP = "timestamp"
+
+# типы колонок файлового приемника; persons/genres - list<struct>
+MOVIE_FIELDS = {
+    DBFields.film_id.name: "string",
+    DBFields.rating.name: "float64",
+    DBFields.genre.name: GENRES,
+    DBFields.film_type.name: "string",
+    DBFields.title.name: "string",
+    DBFields.description.name: "string",
+    DBFields.actors.name: PERSONS,
+    DBFields.writers.name: PERSONS,
+    DBFields.directors.name: PERSONS,
+    DBFields.film_created_at.name: TIMESTAMP,
+    DBFields.film_updated_at.name: TIMESTAMP,
+}
@@ -1,4 +1,4 @@
-from settings import DBFields
+from settings import DBFields, PGDBTables
 
 
 MOVIE_FIELDS = {
@@ -14,3 +14,189 @@ MOVIE_FIELDS = {
     DBFields.film_created_at.name: f"{DBFields.film_created_at.value} timestamp with time zone",
     DBFields.film_updated_at.name: f"{DBFields.film_updated_at.value} timestamp with time zone",
 }
+
+
+# денормализованное представление персон и жанров фильма, поддерживается триггерами
+FILM_WORK_DENORM = """
+CREATE TABLE IF NOT EXISTS {schema}.film_work_denorm (
+    film_work_id uuid NOT NULL PRIMARY KEY REFERENCES {schema}.film_work (id) ON DELETE CASCADE,
+    actors json,
+    writers json,
+    directors json,
+    genre json,
+    updated_at timestamp with time zone NOT NULL DEFAULT now()
+);
+
+CREATE OR REPLACE FUNCTION {schema}.film_work_denorm_refresh(film_ids uuid[]) RETURNS void
+LANGUAGE sql AS $$
+    INSERT INTO {schema}.film_work_denorm (film_work_id, actors, writers, directors, genre, updated_at)
+    SELECT fw.id,
+           JSON_AGG(DISTINCT jsonb_build_object('id', p.id::text, 'full_name', p.full_name))
+               FILTER (WHERE pfw.role = 'actor'),
+           JSON_AGG(DISTINCT jsonb_build_object('id', p.id::text, 'full_name', p.full_name))
+               FILTER (WHERE pfw.role = 'writer'),
+           JSON_AGG(DISTINCT jsonb_build_object('id', p.id::text, 'full_name', p.full_name))
+               FILTER (WHERE pfw.role = 'director'),
+           JSON_AGG(DISTINCT jsonb_build_object('id', g.id::text, 'name', g.name)),
+           now()
+    FROM {schema}.film_work fw
+    LEFT JOIN {schema}.person_film_work pfw ON pfw.film_work_id = fw.id
+    LEFT JOIN {schema}.person p ON p.id = pfw.person_id
+    LEFT JOIN {schema}.genre_film_work gfw ON gfw.film_work_id = fw.id
+    LEFT JOIN {schema}.genre g ON g.id = gfw.genre_id
+    WHERE fw.id = ANY(film_ids)
+    GROUP BY fw.id
+    ON CONFLICT (film_work_id) DO UPDATE
+    SET actors = EXCLUDED.actors,
+        writers = EXCLUDED.writers,
+        directors = EXCLUDED.directors,
+        genre = EXCLUDED.genre,
+        updated_at = EXCLUDED.updated_at;
+$$;
+
+-- триггеры уровня оператора с таблицами переходов: массовое изменение пересчитывает фильмы одним вызовом
+CREATE OR REPLACE FUNCTION {schema}.film_work_denorm_film_trg() RETURNS trigger
+LANGUAGE plpgsql AS $$
+BEGIN
+    PERFORM {schema}.film_work_denorm_refresh(ARRAY(SELECT id FROM new_rows));
+    RETURN NULL;
+END
+$$;
+
+CREATE OR REPLACE FUNCTION {schema}.film_work_denorm_bridge_trg() RETURNS trigger
+LANGUAGE plpgsql AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        PERFORM {schema}.film_work_denorm_refresh(ARRAY(SELECT DISTINCT film_work_id FROM new_rows));
+    ELSIF TG_OP = 'DELETE' THEN
+        PERFORM {schema}.film_work_denorm_refresh(ARRAY(SELECT DISTINCT film_work_id FROM old_rows));
+    ELSE
+        PERFORM {schema}.film_work_denorm_refresh(
+            ARRAY(SELECT film_work_id FROM old_rows UNION SELECT film_work_id FROM new_rows)
+        );
+    END IF;
+    RETURN NULL;
+END
+$$;
+
+CREATE OR REPLACE FUNCTION {schema}.film_work_denorm_person_trg() RETURNS trigger
+LANGUAGE plpgsql AS $$
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        PERFORM {schema}.film_work_denorm_refresh(ARRAY(
+            SELECT DISTINCT pfw.film_work_id
+            FROM old_rows o JOIN {schema}.person_film_work pfw ON pfw.person_id = o.id
+        ));
+    ELSE
+        PERFORM {schema}.film_work_denorm_refresh(ARRAY(
+            SELECT DISTINCT pfw.film_work_id
+            FROM old_rows o
+            JOIN new_rows n ON n.id = o.id
+            JOIN {schema}.person_film_work pfw ON pfw.person_id = n.id
+            WHERE n.full_name IS DISTINCT FROM o.full_name
+        ));
+    END IF;
+    RETURN NULL;
+END
+$$;
+
+CREATE OR REPLACE FUNCTION {schema}.film_work_denorm_genre_trg() RETURNS trigger
+LANGUAGE plpgsql AS $$
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        PERFORM {schema}.film_work_denorm_refresh(ARRAY(
+            SELECT DISTINCT gfw.film_work_id
+            FROM old_rows o JOIN {schema}.genre_film_work gfw ON gfw.genre_id = o.id
+        ));
+    ELSE
+        PERFORM {schema}.film_work_denorm_refresh(ARRAY(
+            SELECT DISTINCT gfw.film_work_id
+            FROM old_rows o
+            JOIN new_rows n ON n.id = o.id
+            JOIN {schema}.genre_film_work gfw ON gfw.genre_id = n.id
+            WHERE n.name IS DISTINCT FROM o.name
+        ));
+    END IF;
+    RETURN NULL;
+END
+$$;
+
+-- строковые триггеры прежней версии
+DROP TRIGGER IF EXISTS film_work_denorm_trg ON {schema}.person_film_work;
+DROP TRIGGER IF EXISTS film_work_denorm_trg ON {schema}.genre_film_work;
+DROP TRIGGER IF EXISTS film_work_denorm_trg ON {schema}.person;
+DROP TRIGGER IF EXISTS film_work_denorm_trg ON {schema}.genre;
+
+-- изменения самого фильма тоже двигают film_work_denorm.updated_at - опрос идет только по этой таблице
+DROP TRIGGER IF EXISTS film_work_denorm_ins_trg ON {schema}.film_work;
+CREATE TRIGGER film_work_denorm_ins_trg AFTER INSERT ON {schema}.film_work
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION {schema}.film_work_denorm_film_trg();
+DROP TRIGGER IF EXISTS film_work_denorm_upd_trg ON {schema}.film_work;
+CREATE TRIGGER film_work_denorm_upd_trg AFTER UPDATE ON {schema}.film_work
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION {schema}.film_work_denorm_film_trg();
+
+-- связи и справочники
+DROP TRIGGER IF EXISTS film_work_denorm_ins_trg ON {schema}.person_film_work;
+CREATE TRIGGER film_work_denorm_ins_trg AFTER INSERT ON {schema}.person_film_work
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION {schema}.film_work_denorm_bridge_trg();
+DROP TRIGGER IF EXISTS film_work_denorm_upd_trg ON {schema}.person_film_work;
+CREATE TRIGGER film_work_denorm_upd_trg AFTER UPDATE ON {schema}.person_film_work
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION {schema}.film_work_denorm_bridge_trg();
+DROP TRIGGER IF EXISTS film_work_denorm_del_trg ON {schema}.person_film_work;
+CREATE TRIGGER film_work_denorm_del_trg AFTER DELETE ON {schema}.person_film_work
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION {schema}.film_work_denorm_bridge_trg();
+DROP TRIGGER IF EXISTS film_work_denorm_ins_trg ON {schema}.genre_film_work;
+CREATE TRIGGER film_work_denorm_ins_trg AFTER INSERT ON {schema}.genre_film_work
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION {schema}.film_work_denorm_bridge_trg();
+DROP TRIGGER IF EXISTS film_work_denorm_upd_trg ON {schema}.genre_film_work;
+CREATE TRIGGER film_work_denorm_upd_trg AFTER UPDATE ON {schema}.genre_film_work
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION {schema}.film_work_denorm_bridge_trg();
+DROP TRIGGER IF EXISTS film_work_denorm_del_trg ON {schema}.genre_film_work;
+CREATE TRIGGER film_work_denorm_del_trg AFTER DELETE ON {schema}.genre_film_work
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION {schema}.film_work_denorm_bridge_trg();
+DROP TRIGGER IF EXISTS film_work_denorm_upd_trg ON {schema}.person;
+CREATE TRIGGER film_work_denorm_upd_trg AFTER UPDATE ON {schema}.person
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION {schema}.film_work_denorm_person_trg();
+DROP TRIGGER IF EXISTS film_work_denorm_del_trg ON {schema}.person;
+CREATE TRIGGER film_work_denorm_del_trg AFTER DELETE ON {schema}.person
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION {schema}.film_work_denorm_person_trg();
+DROP TRIGGER IF EXISTS film_work_denorm_upd_trg ON {schema}.genre;
+CREATE TRIGGER film_work_denorm_upd_trg AFTER UPDATE ON {schema}.genre
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION {schema}.film_work_denorm_genre_trg();
+DROP TRIGGER IF EXISTS film_work_denorm_del_trg ON {schema}.genre;
+CREATE TRIGGER film_work_denorm_del_trg AFTER DELETE ON {schema}.genre
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION {schema}.film_work_denorm_genre_trg();
+"""
+
+# индекс опроса обновлений в режиме denorm (по нему pg_bootstrap_denorm узнает, что установка актуальна)
+FILM_WORK_DENORM_POLL_INDEX = "film_work_denorm_updated_at_idx"
+
+# первичное заполнение наследует updated_at фильмов: контрольная точка режима join остается верной
+FILM_WORK_DENORM_FILL = """
+SELECT {schema}.film_work_denorm_refresh(ARRAY(SELECT id FROM {schema}.film_work));
+UPDATE {schema}.film_work_denorm d SET updated_at = COALESCE(fw.updated_at, d.updated_at)
+FROM {schema}.film_work fw
+WHERE fw.id = d.film_work_id;
+CREATE INDEX IF NOT EXISTS film_work_denorm_updated_at_idx ON {schema}.film_work_denorm (updated_at, film_work_id);
+"""
+
+
+# индексы горячих предикатов извлечения: таблица -> (имя индекса, колонки)
+RECOMMENDED_INDEXES = {
+    PGDBTables.film.value: ("film_work_updated_at_idx", ["updated_at", "id"]),
+    PGDBTables.film_denorm.value: ("film_work_denorm_updated_at_idx", ["updated_at", "film_work_id"]),
+    PGDBTables.film_genre.value: ("genre_film_work_film_work_id_idx", ["film_work_id"]),
+    PGDBTables.film_person.value: ("person_film_work_film_work_id_idx", ["film_work_id"]),
+}
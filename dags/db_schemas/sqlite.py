@@ -0,0 +1,9 @@
+from settings import SQLiteDBTables
+
+
+# индексы горячих предикатов извлечения: таблица -> (имя индекса, колонки)
+RECOMMENDED_INDEXES = {
+    SQLiteDBTables.film.value: ("film_work_updated_at_idx", ["updated_at", "id"]),
+    SQLiteDBTables.film_genre.value: ("genre_film_work_film_work_id_idx", ["film_work_id"]),
+    SQLiteDBTables.film_person.value: ("person_film_work_film_work_id_idx", ["film_work_id"]),
+}
@@ -0,0 +1,73 @@
+from airflow import DAG
+from airflow.operators.python import PythonOperator
+from airflow.utils.dates import days_ago
+from airflow.models.param import Param
+
+from settings import (
+    DBFields,
+    SOURCE_MODE_JOIN,
+    SOURCE_MODES,
+    WRITE_BATCH_SIZE,
+    ES_INDEX_PROFILE_DEFAULT,
+    ES_INDEX_PROFILES,
+)
+from db.backfill import backfill_prepare_sink, backfill_plan, backfill_range, backfill_finish
+from utils.profiling import profiled, PROFILE_MODES, PROFILE_OFF
+
+DEFAULT_ARGS = {"owner": "airflow"}
+
+
+with DAG(
+        "_AIRFLOW_1_BACKFILL",
+        start_date=days_ago(1),
+        schedule_interval=None,
+        default_args=DEFAULT_ARGS,
+        tags=["AIRFLOW_1"],
+        catchup=False,
+        params={
+            # источник - только Postgres (COPY ... TO STDOUT)
+            "in_db_id": Param("movies_pg_db", type="string", enum=["movies_pg_db"]),
+            "id_db_params": Param({"schema": "content", "table": "film_work"}, type=["object", "null"]),
+            "source_mode": Param(SOURCE_MODE_JOIN, type="string", enum=SOURCE_MODES),
+            "fields": Param(["film_id", "title"], type="array", examples=DBFields.keys()),
+            "out_db_id": Param(
+                "movies_es_db",
+                type="string",
+                enum=[
+                    "movies_es_db",
+                    "movies_pg_db",
+                    "movies_file_out",
+                ],
+            ),
+            "out_db_params": Param({"index": "content"}, type=["object", "null"]),
+            # профиль создаваемого индекса Elasticsearch
+            "es_index_profile": Param(ES_INDEX_PROFILE_DEFAULT, type="string", enum=ES_INDEX_PROFILES),
+            "partitions": Param(8, type="integer", minimum=1),
+            "partition_by": Param("updated_at", type="string", enum=["updated_at", "id"]),
+            "write_batch_size": Param(WRITE_BATCH_SIZE, type="integer", minimum=1),
+            "profile": Param(PROFILE_OFF, type="string", enum=PROFILE_MODES),
+            "profile_tasks": Param([], type="array"),
+        },
+) as dag:
+    task_prepare_sink = PythonOperator(
+        task_id="backfill_prepare_sink",
+        python_callable=backfill_prepare_sink,
+    )
+
+    task_plan = PythonOperator(
+        task_id="backfill_plan",
+        python_callable=profiled(backfill_plan),
+    )
+
+    # по одному экземпляру задачи на диапазон, экземпляры выполняются параллельно
+    task_ranges = PythonOperator.partial(
+        task_id="backfill_range",
+        python_callable=profiled(backfill_range),
+    ).expand(op_kwargs=task_plan.output)
+
+    task_finish = PythonOperator(
+        task_id="backfill_finish",
+        python_callable=backfill_finish,
+    )
+
+task_prepare_sink >> task_plan >> task_ranges >> task_finish
@@ -11,9 +11,33 @@ from airflow.operators.python import PythonOperator
 from airflow.utils.dates import days_ago
 from airflow.models.param import Param
 
-from settings import DBFields, MOVIES_UPDATED_STATE_KEY  # , MOVIES_UPDATED_STATE_KEY_TMP
+from settings import (
+    DBFields,
+    MOVIES_UPDATED_STATE_KEY,
+    MOVIES_UPDATED_STATE_KEY_TMP,
+    FILE_SINK_FORMATS,
+    SOURCE_MODE_JOIN,
+    SOURCE_MODES,
+    WRITE_BATCH_SIZE,
+    CHUNK_SIZE_MODE_FIXED,
+    CHUNK_SIZE_MODES,
+    CHUNK_TARGET_SECONDS,
+    CHUNK_MAX_PAYLOAD_BYTES,
+    EXECUTION_MODE_ASYNC,
+    EXECUTION_MODE_TASKS,
+    EXECUTION_MODES,
+    SQLITE_READ_WORKERS,
+    INDEX_ADVISOR_OFF,
+    INDEX_ADVISOR_MODES,
+    ES_INDEX_PROFILE_DEFAULT,
+    ES_INDEX_PROFILE_WRITE_HEAVY,
+    ES_INDEX_PROFILES,
+    LEASE_TTL_SECONDS,
+    REPLICA_MAX_LAG_SECONDS,
+)
 from db.sqlite import sqlite_get_films_data, sqlite_get_updated_movies_ids, sqlite_preprocess, sqlite_write
 from db.pg import (
+    pg_bootstrap_denorm,
     pg_get_films_data,
     pg_get_updated_movies_ids,
     pg_create_schema,
@@ -21,9 +45,31 @@ from db.pg import (
     pg_write,
 )
 from db.es import es_get_films_data, es_create_index, es_preprocess, es_write
+from db.file import file_preprocess, file_write
+from db.async_etl import async_etl
+from db.index_advisor import index_advisor
+from utils.profiling import profiled, PROFILE_MODES, PROFILE_OFF
+from utils.checkpoint import clear_run
+from utils.lease import complete_window, is_leasing
+from utils.fanout import for_sink, get_sinks, get_out_db_ids, get_out_db_params
+from utils.chunk_tuner import measured, tune_chunk_size
 
 DEFAULT_ARGS = {"owner": "airflow"}
 
+OUT_DB_IDS = [
+    "movies_es_db",
+    "movies_pg_db",
+    "movies_sqlite_db_out",
+    "movies_file_out",
+]
+
+SINK_TASKS = {
+    "postgres": ["pg_preprocess", "pg_create_schema", "pg_write"],
+    "elasticsearch": ["es_preprocess", "es_create_index", "es_write"],
+    "sqlite": ["sqlite_preprocess", "sqlite_write"],
+    "fs": ["file_preprocess", "file_write"],
+}
+
 
 def _check_conn(conn, context_db_params):
     """Проверка Airflow Admin Connection"""
@@ -46,6 +92,12 @@ def _check_conn(conn, context_db_params):
     elif conn.conn_type == "sqlite":
         # в sqlite нет схемы и нет индексов
         return
+    elif conn.conn_type == "fs":
+        file_format = (context_db_params or {}).get("format", "parquet")
+        if file_format not in FILE_SINK_FORMATS:
+            raise AirflowException(
+                f"File format must be one of {FILE_SINK_FORMATS}"
+            )
     else:
         raise AirflowException("Unknown input db connection type %s", conn.conn_type)
 
@@ -54,10 +106,13 @@ def _check_conn(conn, context_db_params):
 def in_db_branch_func(**context):
     """Выбор базы-источника данных"""
     # https://www.restack.io/docs/airflow-faq-authoring-and-scheduling-connections-05
+    if context["params"].get("execution_mode") == EXECUTION_MODE_ASYNC:
+        return ["async_etl"]
+
     conn = BaseHook.get_connection(context["params"]["in_db_id"])
     logging.info(conn)
     if conn.conn_type == "postgres":
-        return ["pg_get_updated_movies_ids", "pg_get_films_data"]
+        return ["pg_bootstrap_denorm", "pg_get_updated_movies_ids", "pg_get_films_data"]
     elif conn.conn_type == "elasticsearch":
         return ["es_get_films_data"]
     elif conn.conn_type == "sqlite":
@@ -68,17 +123,14 @@ def in_db_branch_func(**context):
 
 @task.branch(task_id="out_db_branch_task", trigger_rule="one_success")
 def out_db_branch_func(**context):
-    """Выбор базы-назначения данных"""
+    """Выбор баз-назначения данных (задачи всех приемников выполняются параллельно)"""
     # https://www.restack.io/docs/airflow-faq-authoring-and-scheduling-connections-05
-    conn = BaseHook.get_connection(context["params"]["out_db_id"])
-    if conn.conn_type == "postgres":
-        return ["pg_preprocess", "pg_create_schema", "pg_write"]
-    elif conn.conn_type == "elasticsearch":
-        return ["es_preprocess", "es_create_index", "es_write"]
-    elif conn.conn_type == "sqlite":
-        return ["sqlite_preprocess", "sqlite_write"]
-    else:
-        raise AirflowException("Unknown input db connection type %s", conn.conn_type)
+    tasks = []
+    for conn_type in get_sinks(context["params"]):
+        if conn_type not in SINK_TASKS:
+            raise AirflowException("Unknown output db connection type %s", conn_type)
+        tasks.extend(SINK_TASKS[conn_type])
+    return tasks
 
 
 def in_param_validator(ti: TaskInstance, **context):
@@ -87,17 +139,44 @@ def in_param_validator(ti: TaskInstance, **context):
     logging.info(f'{context["params"]=}')
     _check_conn(conn, context["params"]["id_db_params"])
 
-    conn = BaseHook.get_connection(context["params"]["out_db_id"])
-    _check_conn(conn, context["params"]["out_db_params"])
+    out_db_ids = get_out_db_ids(context["params"])
+    if len(out_db_ids) > 1 and context["params"].get("execution_mode") == EXECUTION_MODE_ASYNC:
+        raise AirflowException("Several sinks are not supported in the async execution mode")
+    # заодно проверяет, что типы приемников не повторяются
+    get_sinks(context["params"])
+    if is_leasing(**context) and (
+            context["params"].get("execution_mode") == EXECUTION_MODE_ASYNC
+            or BaseHook.get_connection(context["params"]["in_db_id"]).conn_type not in ("postgres", "sqlite")
+    ):
+        raise AirflowException("Window leasing is supported only for Postgres and SQLite sources in the tasks mode")
+    replica_id = context["params"].get("in_db_replica_id")
+    if replica_id and (
+            context["params"].get("execution_mode") == EXECUTION_MODE_ASYNC
+            or conn.conn_type != "postgres"
+            or BaseHook.get_connection(replica_id).conn_type != "postgres"
+    ):
+        raise AirflowException("Read replica is supported only for Postgres sources in the tasks mode")
+    if context["params"].get("es_index_profile") == ES_INDEX_PROFILE_WRITE_HEAVY:
+        # настройки загрузки на каждом запуске по расписанию пересобирали бы реплики индекса
+        raise AirflowException("Index profile write_heavy is supported only in the backfill DAG")
+    if context["params"].get("replay_dead_letters") and context["params"].get("execution_mode") == EXECUTION_MODE_ASYNC:
+        raise AirflowException("Dead letter replay is not supported in the async execution mode")
+    for out_db_id in out_db_ids:
+        conn = BaseHook.get_connection(out_db_id)
+        _check_conn(conn, get_out_db_params(context["params"], out_db_id))
 
 
 def state_update(ti: TaskInstance, **context):
     """Обновление маркера MOVIES_UPDATED_STATE_KEY"""
-    # state = ti.xcom_pull(key=MOVIES_UPDATED_STATE_KEY_TMP)
-    state = ti.xcom_pull(key=MOVIES_UPDATED_STATE_KEY)
+    # контрольные точки приемников сохраняют задачи записи, здесь - итог запуска
+    state = ti.xcom_pull(key=MOVIES_UPDATED_STATE_KEY_TMP)
     logging.info(state)
     if state:
         ti.xcom_push(key=MOVIES_UPDATED_STATE_KEY, value=state)
+    if is_leasing(**context):
+        complete_window(**context)
+    tune_chunk_size(ti, **context)
+    clear_run(ti, **context)
 
 
 with DAG(
@@ -110,21 +189,55 @@ with DAG(
         catchup=False,
         params={
             "chunk_size": Param(11, type="integer", minimum=10),
+            # auto - chunk_size подбирается по длительности запусков и размеру данных
+            "chunk_size_mode": Param(CHUNK_SIZE_MODE_FIXED, type="string", enum=CHUNK_SIZE_MODES),
+            "chunk_target_seconds": Param(CHUNK_TARGET_SECONDS, type="integer", minimum=1),
+            "chunk_max_payload_bytes": Param(CHUNK_MAX_PAYLOAD_BYTES, type="integer", minimum=1024),
+            "execution_mode": Param(EXECUTION_MODE_TASKS, type="string", enum=EXECUTION_MODES),
+            # размер батча записи; после каждого батча фиксируется контрольная точка
+            "write_batch_size": Param(WRITE_BATCH_SIZE, type="integer", minimum=1),
             "in_db_id": Param(
                 "movies_pg_db", type="string", enum=["movies_pg_db", "movies_es_db", "movies_sqlite_db_in"]
             ),
             "id_db_params": Param({"schema": "content", "table": "film_work"}, type=["object", "null"]),
+            # реплика Postgres-источника для извлечения; при отставании больше replica_max_lag_seconds - основная база
+            "in_db_replica_id": Param(None, type=["string", "null"]),
+            "replica_max_lag_seconds": Param(REPLICA_MAX_LAG_SECONDS, type="integer", minimum=1),
+            "source_mode": Param(SOURCE_MODE_JOIN, type="string", enum=SOURCE_MODES),
+            # SQLite-источник: число потоков чтения; immutable - файл не меняется во время чтения
+            "sqlite_read_workers": Param(SQLITE_READ_WORKERS, type="integer", minimum=1),
+            "sqlite_immutable": Param(False, type="boolean"),
+            # проверка планов запросов извлечения (для разового запуска): report - отчет о недостающих индексах,
+            # create - их создание
+            "index_advisor": Param(INDEX_ADVISOR_OFF, type="string", enum=INDEX_ADVISOR_MODES),
             "fields": Param(["film_id", "title"], type="array", examples=DBFields.keys()),
+            # один приемник или список приемников разных типов (fan-out)
             "out_db_id": Param(
                 "movies_es_db",
-                type=["string", "null"],
-                enum=[
-                    "movies_es_db",
-                    "movies_pg_db",
-                    "movies_sqlite_db_out"
+                anyOf=[
+                    {"type": "string", "enum": OUT_DB_IDS},
+                    {
+                        "type": "array",
+                        "items": {"type": "string", "enum": OUT_DB_IDS},
+                        "minItems": 1,
+                        "uniqueItems": True,
+                    },
                 ],
             ),
+            # при нескольких приемниках - словарь {out_db_id: параметры приемника}
             "out_db_params": Param({"index": "content"}, type=["object", "null"]),
+            # аренда окон (updated_at, id): пересекающиеся запуски обрабатывают разные окна
+            "window_leasing": Param(False, type="boolean"),
+            "lease_ttl_seconds": Param(LEASE_TTL_SECONDS, type="integer", minimum=60),
+            # профиль создаваемого индекса Elasticsearch
+            "es_index_profile": Param(ES_INDEX_PROFILE_DEFAULT, type="string", enum=ES_INDEX_PROFILES),
+            # повторная запись только отклоненных приемниками записей (dead letter)
+            "replay_dead_letters": Param(False, type="boolean"),
+            # профилирование ETL задач: cProfile и/или tracemalloc
+            "profile": Param(PROFILE_OFF, type="string", enum=PROFILE_MODES),
+            "profile_tasks": Param([], type="array"),
+            # полные данные задач в файлы $ETL_LOG_PAYLOAD_DIR (в логе - только число строк, размер и выборка)
+            "log_payloads": Param(False, type="boolean"),
         },
 ) as dag:
     init = DummyOperator(task_id="init")
@@ -135,6 +248,12 @@ with DAG(
         provide_context=True,
     )
 
+    task_index_advisor = PythonOperator(
+        task_id="index_advisor",
+        python_callable=index_advisor,
+        provide_context=True,
+    )
+
     # https://airflow.apache.org/docs/apache-airflow/stable/core-concepts/dags.html#branching
     in_branch_op = in_db_branch_func()
 
@@ -144,68 +263,97 @@ with DAG(
         task_id="state_update",
         python_callable=state_update,
         provide_context=True,
-        trigger_rule="one_success",
+        # ждет все приемники; упавший приемник не мешает остальным сохранить свои контрольные точки
+        trigger_rule="none_failed_min_one_success",
     )
 
     final = DummyOperator(task_id="final")
 
+    # Async (extract -> transform -> load в одной задаче)
+
+    task_async_etl = PythonOperator(
+        task_id="async_etl",
+        python_callable=profiled(measured(async_etl)),
+        provide_context=True,
+    )
+
     # SQLite
 
     task_sqlite_get_movies_ids = PythonOperator(
         task_id="sqlite_get_updated_movies_ids",
-        python_callable=sqlite_get_updated_movies_ids,
+        python_callable=profiled(measured(sqlite_get_updated_movies_ids)),
         do_xcom_push=True,
         provide_context=True,
     )
 
     task_sqlite_get_films_data = PythonOperator(
         task_id="sqlite_get_films_data",
-        python_callable=sqlite_get_films_data,
+        python_callable=profiled(measured(sqlite_get_films_data)),
         provide_context=True,
     )
 
     task_sqlite_preprocess = PythonOperator(
         task_id="sqlite_preprocess",
-        python_callable=sqlite_preprocess,
+        python_callable=profiled(measured(for_sink("sqlite")(sqlite_preprocess))),
         provide_context=True,
     )
 
     task_sqlite_write = PythonOperator(
         task_id="sqlite_write",
-        python_callable=sqlite_write,
+        python_callable=profiled(measured(for_sink("sqlite", commit_state=True)(sqlite_write))),
+        provide_context=True,
+    )
+
+    # File (parquet / NDJSON)
+
+    task_file_preprocess = PythonOperator(
+        task_id="file_preprocess",
+        python_callable=profiled(measured(for_sink("fs")(file_preprocess))),
+        provide_context=True,
+    )
+
+    task_file_write = PythonOperator(
+        task_id="file_write",
+        python_callable=profiled(measured(for_sink("fs", commit_state=True)(file_write))),
         provide_context=True,
     )
 
     # Postgres
 
+    task_pg_bootstrap_denorm = PythonOperator(
+        task_id="pg_bootstrap_denorm",
+        python_callable=pg_bootstrap_denorm,
+        provide_context=True,
+    )
+
     task_pg_get_movies_ids = PythonOperator(
         task_id="pg_get_updated_movies_ids",
-        python_callable=pg_get_updated_movies_ids,
+        python_callable=profiled(measured(pg_get_updated_movies_ids)),
         do_xcom_push=True,
         provide_context=True,
     )
 
     task_pg_get_films_data = PythonOperator(
         task_id="pg_get_films_data",
-        python_callable=pg_get_films_data,
+        python_callable=profiled(measured(pg_get_films_data)),
         provide_context=True,
     )
 
     task_pg_create_schema = PythonOperator(
         task_id="pg_create_schema",
-        python_callable=pg_create_schema,
+        python_callable=for_sink("postgres")(pg_create_schema),
         provide_context=True,
     )
 
     task_pg_preprocess = PythonOperator(
         task_id="pg_preprocess",
-        python_callable=pg_preprocess,
+        python_callable=profiled(measured(for_sink("postgres")(pg_preprocess))),
         provide_context=True,
     )
 
     task_pg_write = PythonOperator(
         task_id="pg_write",
-        python_callable=pg_write,
+        python_callable=profiled(measured(for_sink("postgres", commit_state=True)(pg_write))),
         provide_context=True,
     )
 
@@ -213,37 +361,39 @@ with DAG(
 
     task_es_get_films_data = PythonOperator(
         task_id="es_get_films_data",
-        python_callable=es_get_films_data,
+        python_callable=profiled(measured(es_get_films_data)),
         do_xcom_push=True,
         provide_context=True,
     )
 
     task_es_preprocess = PythonOperator(
         task_id="es_preprocess",
-        python_callable=es_preprocess,
+        python_callable=profiled(measured(for_sink("elasticsearch")(es_preprocess))),
         provide_context=True,
     )
 
     task_es_create_index = PythonOperator(
         task_id="es_create_index",
-        python_callable=es_create_index,
+        python_callable=for_sink("elasticsearch")(es_create_index),
         provide_context=True,
     )
 
     task_es_write = PythonOperator(
         task_id="es_write",
-        python_callable=es_write,
+        python_callable=profiled(measured(for_sink("elasticsearch", commit_state=True)(es_write))),
         provide_context=True,
     )
 
-init >> task_validate_params >> in_branch_op
+init >> task_validate_params >> task_index_advisor >> in_branch_op
 
-in_branch_op >> task_pg_get_movies_ids >> task_pg_get_films_data
+in_branch_op >> task_pg_bootstrap_denorm >> task_pg_get_movies_ids >> task_pg_get_films_data
 task_pg_get_films_data >> out_branch_op
 
 in_branch_op >> task_es_get_films_data
 task_es_get_films_data >> out_branch_op
 
+in_branch_op >> task_async_etl >> task_update_state
+
 in_branch_op >> task_sqlite_get_movies_ids >> task_sqlite_get_films_data >> out_branch_op
 
 out_branch_op >> task_pg_preprocess >> task_pg_create_schema >> task_pg_write
@@ -254,4 +404,6 @@ task_es_write >> task_update_state
 
 out_branch_op >> task_sqlite_preprocess >> task_sqlite_write >> task_update_state
 
+out_branch_op >> task_file_preprocess >> task_file_write >> task_update_state
+
 task_update_state >> final
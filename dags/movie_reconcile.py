@@ -0,0 +1,57 @@
+from airflow import DAG
+from airflow.operators.python import PythonOperator
+from airflow.utils.dates import days_ago
+from airflow.models.param import Param
+
+from settings import DBFields, SOURCE_MODE_JOIN, SOURCE_MODES, WRITE_BATCH_SIZE, RECONCILE_LEAF_ROWS
+from db.reconcile import reconcile_compare, reconcile_resync
+from utils.profiling import profiled, PROFILE_MODES, PROFILE_OFF
+
+DEFAULT_ARGS = {"owner": "airflow"}
+
+
+with DAG(
+        "_AIRFLOW_1_RECONCILE",
+        start_date=days_ago(1),
+        schedule_interval=None,
+        default_args=DEFAULT_ARGS,
+        tags=["AIRFLOW_1"],
+        catchup=False,
+        params={
+            "in_db_id": Param(
+                "movies_pg_db", type="string", enum=["movies_pg_db", "movies_es_db", "movies_sqlite_db_in"]
+            ),
+            "id_db_params": Param({"schema": "content", "table": "film_work"}, type=["object", "null"]),
+            "source_mode": Param(SOURCE_MODE_JOIN, type="string", enum=SOURCE_MODES),
+            # сравниваются id и скалярные поля из списка; film_id обязателен
+            "fields": Param(["film_id", "title", "film_updated_at"], type="array", examples=DBFields.keys()),
+            "out_db_id": Param(
+                "movies_es_db",
+                type="string",
+                enum=[
+                    "movies_es_db",
+                    "movies_pg_db",
+                    "movies_sqlite_db_out",
+                ],
+            ),
+            "out_db_params": Param({"index": "content"}, type=["object", "null"]),
+            # спуск в различающиеся корзины идет, пока в корзине больше reconcile_leaf_rows строк
+            "reconcile_leaf_rows": Param(RECONCILE_LEAF_ROWS, type="integer", minimum=1),
+            # false - только отчет о расхождениях
+            "reconcile_resync": Param(True, type="boolean"),
+            "write_batch_size": Param(WRITE_BATCH_SIZE, type="integer", minimum=1),
+            "profile": Param(PROFILE_OFF, type="string", enum=PROFILE_MODES),
+            "profile_tasks": Param([], type="array"),
+        },
+) as dag:
+    task_compare = PythonOperator(
+        task_id="reconcile_compare",
+        python_callable=profiled(reconcile_compare),
+    )
+
+    task_resync = PythonOperator(
+        task_id="reconcile_resync",
+        python_callable=profiled(reconcile_resync),
+    )
+
+task_compare >> task_resync
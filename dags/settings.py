@@ -1,4 +1,5 @@
 from enum import Enum
+import os
 
 
 MOVIES_UPDATED_STATE_KEY = "movies_state"
@@ -6,6 +7,109 @@ MOVIES_UPDATED_STATE_KEY_TMP = "movies_state_tmp"
 DT_FMT = "%Y-%m-%d %H:%M:%S"
 DT_FMT_PG = "YYYY-MM-DD HH24:MI:SS"
 
+# режим чтения источника: join - агрегация по 5 таблицам, denorm - из film_work_denorm (только Postgres)
+SOURCE_MODE_JOIN = "join"
+SOURCE_MODE_DENORM = "denorm"
+# dim_cache - фильмы и id связей из источника, персоны и жанры из кэша воркера (Postgres, SQLite)
+SOURCE_MODE_DIM_CACHE = "dim_cache"
+SOURCE_MODES = [SOURCE_MODE_JOIN, SOURCE_MODE_DENORM, SOURCE_MODE_DIM_CACHE]
+DIM_CACHE_SIZE = 100_000
+
+# логирование данных: число записей, размер и выборка из LOG_SAMPLE_ROWS строк с обрезкой значений;
+# полные данные - в файлы LOG_PAYLOAD_DIR (параметр log_payloads или ETL_LOG_PAYLOADS=1)
+LOG_SAMPLE_ROWS = 3
+LOG_MAX_FIELD_CHARS = 80
+LOG_PAYLOAD_DIR = os.getenv("ETL_LOG_PAYLOAD_DIR", "/opt/airflow/logs/payloads")
+
+# каталог для артефактов профилирования (pstats, отчеты tracemalloc)
+PROFILING_DIR = os.getenv("ETL_PROFILING_DIR", "/opt/airflow/logs/profiling")
+PROFILING_TOP_N = 15
+
+# каталог выгрузок файлового приемника (если не задан path в Admin-Connection)
+FILE_SINK_DIR = os.getenv("ETL_FILE_SINK_DIR", "/opt/airflow/exports")
+FILE_SINK_FORMATS = ["parquet", "ndjson"]
+FILE_BATCH_SIZE = 1000
+
+# промежуточные данные запуска и контрольные точки записи (для повторов после сбоя)
+STAGING_DIR = os.getenv("ETL_STAGING_DIR", "/opt/airflow/staging")
+# каталоги упавших запусков (для ручного повтора) хранятся STAGING_RETENTION_DAYS дней
+STAGING_RETENTION_DAYS = int(os.getenv("ETL_STAGING_RETENTION_DAYS", "7"))
+WRITE_BATCH_SIZE = 500
+# кодек данных между задачами (XCom и staging): json, orjson, msgpack, с суффиксом +zstd - со сжатием
+PAYLOAD_CODEC_JSON = "json"
+PAYLOAD_CODEC_ORJSON = "orjson"
+PAYLOAD_CODEC_MSGPACK = "msgpack"
+PAYLOAD_COMPRESSION_ZSTD = "zstd"
+PAYLOAD_CODECS = [
+    f"{codec}{suffix}"
+    for suffix in ("", f"+{PAYLOAD_COMPRESSION_ZSTD}")
+    for codec in (PAYLOAD_CODEC_JSON, PAYLOAD_CODEC_ORJSON, PAYLOAD_CODEC_MSGPACK)
+]
+PAYLOAD_CODEC = os.getenv("ETL_PAYLOAD_CODEC", PAYLOAD_CODEC_JSON)
+PAYLOAD_ZSTD_LEVEL = 3
+# аренда окон (updated_at, id) пересекающимися запусками: локальная таблица SQLite и срок аренды
+LEASE_PATH = os.getenv("ETL_LEASE_PATH", os.path.join(STAGING_DIR, "window_lease.sqlite"))
+LEASE_TTL_SECONDS = 600
+# локальное хранилище отклоненных приемником записей (SQLite)
+DEAD_LETTER_PATH = os.getenv("ETL_DEAD_LETTER_PATH", os.path.join(STAGING_DIR, "dead_letter.sqlite"))
+# кэш справочников режима dim_cache (SQLite), общий для задач и процессов воркеров
+DIM_CACHE_PATH = os.getenv("ETL_DIM_CACHE_PATH", os.path.join(STAGING_DIR, "dim_cache.sqlite"))
+
+# режим выполнения: tasks - цепочка задач Airflow, async - конвейер asyncio в одной задаче
+EXECUTION_MODE_TASKS = "tasks"
+EXECUTION_MODE_ASYNC = "async"
+EXECUTION_MODES = [EXECUTION_MODE_TASKS, EXECUTION_MODE_ASYNC]
+# размер очередей между стадиями конвейера (в батчах)
+ASYNC_QUEUE_SIZE = 4
+# минимальное число батчей конвейера на chunk: батчи меньше write_batch_size, чтобы стадии перекрывались
+ASYNC_MIN_BATCHES = 4
+
+# автоподбор chunk_size (AIMD): рост на шаг, пока запуск укладывается в цель, иначе уменьшение в 2 раза
+CHUNK_SIZE_MODE_FIXED = "fixed"
+CHUNK_SIZE_MODE_AUTO = "auto"
+CHUNK_SIZE_MODES = [CHUNK_SIZE_MODE_FIXED, CHUNK_SIZE_MODE_AUTO]
+CHUNK_SIZE_MIN = 10
+CHUNK_SIZE_MAX = 50_000
+CHUNK_SIZE_STEP = 50
+CHUNK_SIZE_BACKOFF = 0.5
+CHUNK_TARGET_SECONDS = 30
+CHUNK_MAX_PAYLOAD_BYTES = 8 * 1024 * 1024
+
+# профиль индекса Elasticsearch: write_heavy - настройки загрузки (без реплик и refresh) до ее окончания,
+# read_incremental - сортировка сегментов по updated_at, id для чтения диапазонами и search_after
+ES_INDEX_PROFILE_DEFAULT = "default"
+ES_INDEX_PROFILE_WRITE_HEAVY = "write_heavy"
+ES_INDEX_PROFILE_READ_INCREMENTAL = "read_incremental"
+ES_INDEX_PROFILES = [ES_INDEX_PROFILE_DEFAULT, ES_INDEX_PROFILE_WRITE_HEAVY, ES_INDEX_PROFILE_READ_INCREMENTAL]
+ES_INDEX_SHARDS = 1
+# размер страницы search_after при чтении из Elasticsearch
+ES_PAGE_SIZE = 1000
+
+# чтение Postgres-источника с реплики: окно ограничивается моментом воспроизведения реплики минус запас,
+# при отставании больше REPLICA_MAX_LAG_SECONDS чтение идет с основной базы
+REPLICA_MAX_LAG_SECONDS = 60
+REPLICA_LAG_MARGIN_SECONDS = 5
+
+# сверка источника и приемника: корзины по префиксу id длиной RECONCILE_ROOT_PREFIX, спуск в различающиеся
+# корзины до RECONCILE_LEAF_ROWS строк; префиксы отбираются порциями по RECONCILE_PREFIX_BATCH
+RECONCILE_ROOT_PREFIX = 2
+RECONCILE_LEAF_ROWS = 1000
+RECONCILE_PREFIX_BATCH = 500
+
+# советник индексов источника: off - выключен, report - только отчет, create - создание недостающих индексов
+INDEX_ADVISOR_OFF = "off"
+INDEX_ADVISOR_REPORT = "report"
+INDEX_ADVISOR_CREATE = "create"
+INDEX_ADVISOR_MODES = [INDEX_ADVISOR_OFF, INDEX_ADVISOR_REPORT, INDEX_ADVISOR_CREATE]
+
+# чтение SQLite-источника: read-only подключения, mmap и пул потоков по диапазонам rowid
+SQLITE_MMAP_SIZE = 256 * 1024 * 1024
+SQLITE_CACHE_KIB = 64 * 1024
+SQLITE_READ_WORKERS = 4
+SQLITE_PARALLEL_MIN_ROWS = 1000
+# диапазон rowid читается целиком, если в нем не больше чем в SQLITE_RANGE_MAX_SPAN раз больше строк, чем нужно
+SQLITE_RANGE_MAX_SPAN = 2
+
 
 class ExtendedEnum(Enum):
     @classmethod
@@ -33,6 +137,7 @@ class DBFields(str, ExtendedEnum):
 
 class PGDBTables(str, ExtendedEnum):
     film = "film_work"
+    film_denorm = "film_work_denorm"
     genre = "genre"
     person = "person"
     film_genre = "genre_film_work"
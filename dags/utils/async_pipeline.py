@@ -0,0 +1,70 @@
+from typing import AsyncIterator, Awaitable, Callable, Dict, List
+import asyncio
+import logging
+import time
+
+_DONE = object()
+
+
+async def run_pipeline(
+        source: AsyncIterator[List],
+        transform: Callable[[List], List],
+        sink: Callable[[List], Awaitable],
+        queue_size: int,
+) -> Dict[str, float]:
+    """Конвейер extract -> transform -> load, стадии связаны ограниченными очередями"""
+    # put() в заполненную очередь ждет - медленный приемник притормаживает чтение
+    extracted = asyncio.Queue(maxsize=queue_size)
+    transformed = asyncio.Queue(maxsize=queue_size)
+    stats = {"extract": 0.0, "transform": 0.0, "load": 0.0, "batches": 0}
+
+    async def extract_stage():
+        iterator = source.__aiter__()
+        while True:
+            started = time.monotonic()
+            try:
+                batch = await iterator.__anext__()
+            except StopAsyncIteration:
+                break
+            stats["extract"] += time.monotonic() - started
+            await extracted.put(batch)
+        await extracted.put(_DONE)
+
+    async def transform_stage():
+        loop = asyncio.get_event_loop()
+        while True:
+            batch = await extracted.get()
+            if batch is _DONE:
+                await transformed.put(_DONE)
+                return
+            started = time.monotonic()
+            batch = await loop.run_in_executor(None, transform, batch)
+            stats["transform"] += time.monotonic() - started
+            await transformed.put(batch)
+
+    async def load_stage():
+        while True:
+            batch = await transformed.get()
+            if batch is _DONE:
+                return
+            started = time.monotonic()
+            await sink(batch)
+            stats["load"] += time.monotonic() - started
+            stats["batches"] += 1
+
+    started = time.monotonic()
+    tasks = [asyncio.ensure_future(stage()) for stage in (extract_stage, transform_stage, load_stage)]
+    try:
+        done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+        for task in done:
+            task.result()
+    finally:
+        for task in tasks:
+            task.cancel()
+    stats["wall"] = time.monotonic() - started
+
+    logging.info(
+        "Pipeline completed: %s batches, wall %.3fs, extract %.3fs, transform %.3fs, load %.3fs",
+        stats["batches"], stats["wall"], stats["extract"], stats["transform"], stats["load"],
+    )
+    return stats
@@ -0,0 +1,87 @@
+from typing import Iterator, List, Optional, Tuple
+import glob
+import json
+import logging
+import os
+import re
+import shutil
+import time
+
+from airflow.models.taskinstance import TaskInstance
+
+from settings import STAGING_DIR, STAGING_RETENTION_DAYS, WRITE_BATCH_SIZE
+from utils.files import atomic_write
+
+
+def _run_dir(ti: TaskInstance, **context) -> str:
+    """Каталог промежуточных данных dag_run"""
+    run_id = re.sub(r"[^\w.-]", "_", context["run_id"])
+    return os.path.join(STAGING_DIR, ti.dag_id, run_id)
+
+
+def load_staged(ti: TaskInstance, name: str, **context) -> Optional[str]:
+    """Чтение сохраненных в запуске данных (None, если их нет)"""
+    path = os.path.join(_run_dir(ti, **context), f"{name}.json")
+    if not os.path.exists(path):
+        return None
+    logging.info("Reusing staged data %s", path)
+    with open(path, encoding="utf-8") as file:
+        return file.read()
+
+
+def stage(ti: TaskInstance, name: str, payload: str, **context) -> str:
+    """Сохранение данных запуска для повторного использования при ретраях"""
+    atomic_write(os.path.join(_run_dir(ti, **context), f"{name}.json"), payload.encode("utf-8"))
+    return payload
+
+
+def _checkpoint_path(ti: TaskInstance, **context) -> str:
+    """Файл контрольной точки задачи (у экземпляров mapped задачи - свой)"""
+    name = ti.task_id if ti.map_index < 0 else f"{ti.task_id}.{ti.map_index}"
+    return os.path.join(_run_dir(ti, **context), f"{name}.checkpoint")
+
+
+def get_committed_batch(ti: TaskInstance, **context) -> int:
+    """Номер последнего записанного батча задачи (-1, если записей не было)"""
+    path = _checkpoint_path(ti, **context)
+    if not os.path.exists(path):
+        return -1
+    with open(path, encoding="utf-8") as file:
+        return json.load(file)["batch"]
+
+
+def commit_batch(ti: TaskInstance, batch: int, **context):
+    """Фиксация записанного батча"""
+    path = _checkpoint_path(ti, **context)
+    atomic_write(path, json.dumps({"batch": batch, "try_number": ti.try_number}).encode("utf-8"))
+
+
+def pending_batches(ti: TaskInstance, items: List, **context) -> Iterator[Tuple[int, List]]:
+    """Батчи для записи, начиная с первого незафиксированного"""
+    batch_size = context["params"].get("write_batch_size") or WRITE_BATCH_SIZE
+    committed = get_committed_batch(ti, **context)
+    if committed >= 0:
+        logging.info("Resuming %s after committed batch %s", ti.task_id, committed)
+    for batch, start in enumerate(range(0, len(items), batch_size)):
+        if batch > committed:
+            yield batch, items[start:start + batch_size]
+
+
+def clear_stale_runs(retention_days: int = STAGING_RETENTION_DAYS):
+    """Удаление каталогов запусков всех DAG, не менявшихся дольше retention_days (упавшие запуски)"""
+    expires_at = time.time() - retention_days * 24 * 3600
+    for dag_dir in glob.glob(os.path.join(STAGING_DIR, "*", "")):
+        for run_dir in glob.glob(os.path.join(dag_dir, "*", "")):
+            try:
+                stale = os.path.getmtime(run_dir) < expires_at
+            except OSError:
+                continue
+            if stale:
+                logging.info("Removing stale staged run %s", run_dir)
+                shutil.rmtree(run_dir, ignore_errors=True)
+
+
+def clear_run(ti: TaskInstance, **context):
+    """Удаление промежуточных данных успешно завершенного запуска и устаревших каталогов упавших запусков"""
+    shutil.rmtree(_run_dir(ti, **context), ignore_errors=True)
+    clear_stale_runs()
@@ -0,0 +1,133 @@
+from typing import Callable, Dict, Tuple
+import functools
+import logging
+import time
+
+from airflow.models import Variable
+from airflow.models.taskinstance import TaskInstance
+
+from settings import (
+    CHUNK_SIZE_MODE_AUTO,
+    CHUNK_SIZE_MIN,
+    CHUNK_SIZE_MAX,
+    CHUNK_SIZE_STEP,
+    CHUNK_SIZE_BACKOFF,
+    CHUNK_TARGET_SECONDS,
+    CHUNK_MAX_PAYLOAD_BYTES,
+)
+from utils.state import get_out_db_ids
+
+STAGE_METRICS_KEY = "stage_metrics"
+# размер чанка, с которым извлекался запуск (XCom и параметр задачи)
+CHUNK_SIZE_KEY = "chunk_size_in_effect"
+
+
+def _tuner_key(**context) -> str:
+    """Ключ Airflow Variable статистики для пары источник/приемник"""
+    params = context["params"]
+    return f"movies_chunk__{params['in_db_id']}__{'__'.join(get_out_db_ids(params))}"
+
+
+def _is_auto(**context) -> bool:
+    return context["params"].get("chunk_size_mode") == CHUNK_SIZE_MODE_AUTO
+
+
+def get_chunk_size(**context) -> int:
+    """Размер чанка: параметр DAG или подобранный по статистике прошлых запусков"""
+    if not _is_auto(**context):
+        return context["params"]["chunk_size"]
+    if context["params"].get(CHUNK_SIZE_KEY):
+        return context["params"][CHUNK_SIZE_KEY]
+    tuner = Variable.get(_tuner_key(**context), default_var=None, deserialize_json=True)
+    return tuner["chunk_size"] if tuner else context["params"]["chunk_size"]
+
+
+def measured(func: Callable) -> Callable:
+    """Обертка ETL callable: длительность, размер результата и число строк (в режиме auto)"""
+
+    @functools.wraps(func)
+    def wrapper(ti: TaskInstance, **context):
+        if not _is_auto(**context):
+            return func(ti, **context)
+
+        # задачи приемников размечает for_sink; остальные - стадии извлечения
+        sink = getattr(func, "sink", None)
+        if sink is None:
+            # Variable может смениться за время запуска - размер фиксируется при первом извлечении
+            chunk_size = ti.xcom_pull(key=CHUNK_SIZE_KEY) or get_chunk_size(**context)
+            ti.xcom_push(key=CHUNK_SIZE_KEY, value=chunk_size)
+            context = {**context, "params": {**context["params"], CHUNK_SIZE_KEY: chunk_size}}
+
+        started = time.monotonic()
+        result = func(ti, **context)
+        metrics = {"seconds": round(time.monotonic() - started, 3)}
+        if sink is not None:
+            metrics["sink"] = sink
+        if isinstance(result, str):
+            metrics["bytes"] = len(result.encode("utf-8"))
+        elif isinstance(result, (set, list)):
+            metrics["rows"] = len(result)
+        ti.xcom_push(key=STAGE_METRICS_KEY, value=metrics)
+        return result
+
+    return wrapper
+
+
+def _next_chunk_size(current: int, stages: Dict[str, Dict], **context) -> Tuple[int, str]:
+    """AIMD: аддитивный рост к целевой длительности и размеру, мультипликативное уменьшение"""
+    target_seconds = context["params"].get("chunk_target_seconds") or CHUNK_TARGET_SECONDS
+    max_payload = context["params"].get("chunk_max_payload_bytes") or CHUNK_MAX_PAYLOAD_BYTES
+    # стадии извлечения идут последовательно, а приемники - параллельно: запуск ждет самый медленный приемник
+    sinks = {}
+    duration = 0
+    for stage in stages.values():
+        if "sink" in stage:
+            sinks[stage["sink"]] = sinks.get(stage["sink"], 0) + stage.get("seconds", 0)
+        else:
+            duration += stage.get("seconds", 0)
+    duration += max(sinks.values(), default=0)
+    payload = max([stage.get("bytes", 0) for stage in stages.values()] or [0])
+    rows = [stage["rows"] for stage in stages.values() if "rows" in stage]
+
+    if payload > max_payload:
+        return max(CHUNK_SIZE_MIN, int(current * CHUNK_SIZE_BACKOFF)), \
+            f"backoff: payload {payload} B > {max_payload} B"
+    if duration > target_seconds:
+        return max(CHUNK_SIZE_MIN, int(current * CHUNK_SIZE_BACKOFF)), \
+            f"backoff: duration {duration:.1f}s > {target_seconds}s"
+    if rows and max(rows) < current:
+        return current, f"keep: source returned {max(rows)} rows < chunk {current}"
+
+    next_size = current + CHUNK_SIZE_STEP
+    # не выходить за цель по прогнозу на строку
+    if payload:
+        next_size = min(next_size, int(max_payload / (payload / current)))
+    if duration:
+        next_size = min(next_size, int(target_seconds / (duration / current)))
+    next_size = max(CHUNK_SIZE_MIN, min(CHUNK_SIZE_MAX, next_size))
+    return next_size, f"grow: duration {duration:.1f}s, payload {payload} B within target"
+
+
+def tune_chunk_size(ti: TaskInstance, **context):
+    """Сбор статистики стадий запуска и выбор следующего chunk_size (режим auto)"""
+    if not _is_auto(**context):
+        return
+
+    stages = {}
+    for task_instance in context["dag_run"].get_task_instances():
+        metrics = ti.xcom_pull(task_ids=task_instance.task_id, key=STAGE_METRICS_KEY)
+        if metrics:
+            stages[task_instance.task_id] = metrics
+    if not stages:
+        logging.info("No stage metrics collected, chunk size is not changed")
+        return
+
+    # размер, с которым запуск извлекал данные, а не текущее значение Variable
+    current = ti.xcom_pull(key=CHUNK_SIZE_KEY) or get_chunk_size(**context)
+    next_size, reason = _next_chunk_size(current, stages, **context)
+    Variable.set(
+        _tuner_key(**context),
+        {"chunk_size": next_size, "previous": current, "reason": reason, "stages": stages},
+        serialize_json=True,
+    )
+    logging.info("Chunk size %s -> %s (%s), stages: %s", current, next_size, reason, stages)
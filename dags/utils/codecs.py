@@ -0,0 +1,154 @@
+from typing import Any, Callable, Dict, Tuple
+from datetime import date, datetime
+from decimal import Decimal
+import base64
+import json
+import re
+import uuid
+
+from airflow.exceptions import AirflowException
+
+from settings import (
+    PAYLOAD_CODEC,
+    PAYLOAD_CODECS,
+    PAYLOAD_CODEC_JSON,
+    PAYLOAD_CODEC_ORJSON,
+    PAYLOAD_CODEC_MSGPACK,
+    PAYLOAD_COMPRESSION_ZSTD,
+    PAYLOAD_ZSTD_LEVEL,
+)
+
+# бинарные данные передаются строкой "<кодек>:<base64>" - XCom хранит только JSON-совместимые значения
+_HEADER = re.compile(r"^([a-z]+(?:\+[a-z]+)?):")
+
+# коды типов расширения msgpack
+_EXT_UUID = 1
+_EXT_DECIMAL = 2
+_EXT_DATETIME = 3
+_EXT_DATE = 4
+
+
+def _import_orjson():
+    """Импорт orjson (нужен только для кодека orjson)"""
+    try:
+        import orjson
+    except ImportError:
+        raise AirflowException("orjson is required for the orjson payload codec")
+    return orjson
+
+
+def _import_msgpack():
+    """Импорт msgpack (нужен только для кодека msgpack)"""
+    try:
+        import msgpack
+    except ImportError:
+        raise AirflowException("msgpack is required for the msgpack payload codec")
+    return msgpack
+
+
+def _import_zstd():
+    """Импорт zstandard (нужен только для сжатия +zstd)"""
+    try:
+        import zstandard
+    except ImportError:
+        raise AirflowException("zstandard is required for +zstd payload compression")
+    return zstandard
+
+
+def _default(value: Any) -> Any:
+    """Типы вне JSON: datetime/date - ISO 8601, UUID - строка, Decimal - число"""
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, uuid.UUID):
+        return str(value)
+    if isinstance(value, Decimal):
+        return float(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not serializable")
+
+
+def _msgpack_default(value: Any) -> Any:
+    """Типы вне msgpack - типы расширения, при чтении восстанавливаются без потерь"""
+    msgpack = _import_msgpack()
+    if isinstance(value, uuid.UUID):
+        return msgpack.ExtType(_EXT_UUID, value.bytes)
+    if isinstance(value, Decimal):
+        return msgpack.ExtType(_EXT_DECIMAL, str(value).encode("ascii"))
+    if isinstance(value, datetime):
+        return msgpack.ExtType(_EXT_DATETIME, value.isoformat().encode("ascii"))
+    if isinstance(value, date):
+        return msgpack.ExtType(_EXT_DATE, value.isoformat().encode("ascii"))
+    raise TypeError(f"Object of type {type(value).__name__} is not serializable")
+
+
+def _msgpack_ext(code: int, data: bytes) -> Any:
+    """Чтение типов расширения msgpack"""
+    if code == _EXT_UUID:
+        return uuid.UUID(bytes=data)
+    if code == _EXT_DECIMAL:
+        return Decimal(data.decode("ascii"))
+    if code == _EXT_DATETIME:
+        return datetime.fromisoformat(data.decode("ascii"))
+    if code == _EXT_DATE:
+        return date.fromisoformat(data.decode("ascii"))
+    return _import_msgpack().ExtType(code, data)
+
+
+def _json_encode(data: Any) -> bytes:
+    return json.dumps(data, default=_default, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def _orjson_encode(data: Any) -> bytes:
+    return _import_orjson().dumps(data, default=_default)
+
+
+def _msgpack_encode(data: Any) -> bytes:
+    return _import_msgpack().packb(data, default=_msgpack_default, use_bin_type=True)
+
+
+def _msgpack_decode(raw: bytes) -> Any:
+    return _import_msgpack().unpackb(raw, ext_hook=_msgpack_ext, raw=False, strict_map_key=False)
+
+
+# кодеки: имя -> (кодирование в bytes, чтение из bytes)
+CODECS: Dict[str, Tuple[Callable[[Any], bytes], Callable[[bytes], Any]]] = {
+    PAYLOAD_CODEC_JSON: (_json_encode, json.loads),
+    PAYLOAD_CODEC_ORJSON: (_orjson_encode, lambda raw: _import_orjson().loads(raw)),
+    PAYLOAD_CODEC_MSGPACK: (_msgpack_encode, _msgpack_decode),
+}
+# текстовые кодеки без сжатия передаются как есть - обычный JSON
+TEXT_CODECS = {PAYLOAD_CODEC_JSON, PAYLOAD_CODEC_ORJSON}
+
+
+def _parse_codec(codec: str) -> Tuple[str, bool]:
+    """Кодек и признак сжатия zstd"""
+    if codec not in PAYLOAD_CODECS:
+        raise AirflowException(f"Unknown payload codec {codec}, expected one of {PAYLOAD_CODECS}")
+    name, _, compression = codec.partition("+")
+    return name, compression == PAYLOAD_COMPRESSION_ZSTD
+
+
+def encode(data: Any, codec: str = PAYLOAD_CODEC) -> str:
+    """Кодирование данных для передачи между задачами"""
+    name, compressed = _parse_codec(codec)
+    raw = CODECS[name][0](data)
+    if name in TEXT_CODECS and not compressed:
+        return raw.decode("utf-8")
+    if compressed:
+        raw = _import_zstd().ZstdCompressor(level=PAYLOAD_ZSTD_LEVEL).compress(raw)
+    return f"{codec}:{base64.b64encode(raw).decode('ascii')}"
+
+
+def decode(payload: str, codec: str = PAYLOAD_CODEC) -> Any:
+    """Чтение данных любого кодека (кодек - из заголовка, без заголовка - JSON)"""
+    match = _HEADER.match(payload)
+    if match is None:
+        # JSON без заголовка, в том числе данные прежних запусков: orjson, если он выбран
+        name = _parse_codec(codec)[0]
+        return CODECS[name if name in TEXT_CODECS else PAYLOAD_CODEC_JSON][1](payload)
+
+    codec = match.group(1)
+    name, compressed = _parse_codec(codec)
+    raw = base64.b64decode(payload[match.end():])
+    if compressed:
+        raw = _import_zstd().ZstdDecompressor().decompress(raw)
+    return CODECS[name][1](raw)
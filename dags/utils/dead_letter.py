@@ -0,0 +1,130 @@
+from typing import Callable, Dict, List, Tuple, Type
+from contextlib import closing, contextmanager
+from datetime import datetime
+import json
+import logging
+import os
+import sqlite3
+
+from airflow.stats import Stats
+
+from settings import DEAD_LETTER_PATH, DT_FMT
+from utils.state import get_out_db_ids
+
+DEAD_LETTER_TABLE = """
+CREATE TABLE IF NOT EXISTS dead_letter (
+    in_db_id TEXT NOT NULL,
+    out_db_id TEXT NOT NULL,
+    source_id TEXT NOT NULL,
+    error TEXT NOT NULL,
+    payload TEXT,
+    attempts INTEGER NOT NULL DEFAULT 1,
+    created_at TEXT NOT NULL,
+    resolved_at TEXT,
+    PRIMARY KEY (in_db_id, out_db_id, source_id)
+);
+"""
+
+
+@contextmanager
+def _conn_context() -> sqlite3.Connection:
+    """Подключение к локальному хранилищу отклоненных записей"""
+    os.makedirs(os.path.dirname(DEAD_LETTER_PATH), exist_ok=True)
+    conn = sqlite3.connect(DEAD_LETTER_PATH, timeout=30)
+    try:
+        conn.execute(DEAD_LETTER_TABLE)
+        yield conn
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def add_dead_letters(rejected: List[Tuple[str, str, Dict]], **context):
+    """Сохранение отклоненных записей: (source_id, ошибка, запись)"""
+    if not rejected:
+        return
+    params = context["params"]
+    now = datetime.utcnow().strftime(DT_FMT)
+    with _conn_context() as conn:
+        conn.executemany(
+            """
+            INSERT INTO dead_letter (in_db_id, out_db_id, source_id, error, payload, created_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT (in_db_id, out_db_id, source_id) DO UPDATE
+            SET error = excluded.error, payload = excluded.payload, created_at = excluded.created_at,
+                attempts = attempts + 1, resolved_at = NULL;
+            """,
+            [
+                (params["in_db_id"], params["out_db_id"], source_id, error, json.dumps(record, default=str), now)
+                for source_id, error, record in rejected
+            ],
+        )
+    Stats.incr(f"movies_etl.dead_letter.{params['out_db_id']}", len(rejected))
+    logging.warning("%s records sent to dead letter store of %s", len(rejected), params["out_db_id"])
+
+
+def resolve_dead_letters(source_ids: List[str], **context):
+    """Отметка записей, успешно записанных в приемник"""
+    if not source_ids:
+        return
+    params = context["params"]
+    now = datetime.utcnow().strftime(DT_FMT)
+    with _conn_context() as conn:
+        with closing(conn.cursor()) as cursor:
+            cursor.executemany(
+                """
+                UPDATE dead_letter SET resolved_at = ?
+                WHERE in_db_id = ? AND out_db_id = ? AND source_id = ? AND resolved_at IS NULL;
+                """,
+                [(now, params["in_db_id"], params["out_db_id"], source_id) for source_id in source_ids],
+            )
+            if cursor.rowcount > 0:
+                logging.info("%s dead letters of %s resolved", cursor.rowcount, params["out_db_id"])
+
+
+def is_replay(**context) -> bool:
+    """Запуск повторной записи отклоненных записей вместо инкрементального окна"""
+    return bool(context["params"].get("replay_dead_letters"))
+
+
+def get_dead_letter_ids(**context) -> List[str]:
+    """id неразобранных отклоненных записей по всем приемникам запуска"""
+    params = context["params"]
+    out_db_ids = get_out_db_ids(params)
+    with _conn_context() as conn:
+        rows = conn.execute(
+            f"""
+            SELECT DISTINCT source_id FROM dead_letter
+            WHERE in_db_id = ? AND out_db_id IN ({", ".join("?" * len(out_db_ids))}) AND resolved_at IS NULL;
+            """,
+            [params["in_db_id"], *out_db_ids],
+        ).fetchall()
+    return [row[0] for row in rows]
+
+
+def write_isolated(
+        films_data: List[Dict],
+        write: Callable[[List[Dict]], None],
+        errors: Tuple[Type[Exception], ...],
+        **context,
+) -> int:
+    """Запись батча; при ошибке данных - построчно, отклоненные записи уходят в dead letter"""
+    try:
+        write(films_data)
+    except errors as err:
+        logging.warning("Batch of %s movies rejected (%s), writing one by one", len(films_data), err)
+    else:
+        resolve_dead_letters([film_data.get("id") for film_data in films_data], **context)
+        return 0
+
+    rejected, written = [], []
+    for film_data in films_data:
+        try:
+            write([film_data])
+        except errors as err:
+            rejected.append((film_data.get("id"), str(err), film_data))
+        else:
+            written.append(film_data.get("id"))
+    add_dead_letters(rejected, **context)
+    resolve_dead_letters(written, **context)
+    return len(rejected)
@@ -0,0 +1,190 @@
+from typing import Any, Callable, Dict, Iterable, List, Tuple
+from contextlib import contextmanager
+import logging
+import os
+import sqlite3
+import time
+
+from airflow.stats import Stats
+
+from settings import DBFields, DIM_CACHE_PATH, DIM_CACHE_SIZE
+
+PERSON_ROLES = {
+    "actor": DBFields.actors.value,
+    "writer": DBFields.writers.value,
+    "director": DBFields.directors.value,
+}
+NESTED_COLUMNS = {*PERSON_ROLES.values(), DBFields.genre.value}
+
+
+# кэш справочников в SQLite каталога staging: задачи выполняются в разных процессах воркеров
+DIM_CACHE_TABLES = """
+CREATE TABLE IF NOT EXISTS dim_cache_item (
+    cache TEXT NOT NULL,
+    id TEXT NOT NULL,
+    name TEXT,
+    used_at REAL NOT NULL,
+    PRIMARY KEY (cache, id)
+);
+CREATE TABLE IF NOT EXISTS dim_cache_watermark (
+    cache TEXT PRIMARY KEY,
+    max_updated_at TEXT,
+    cnt INTEGER NOT NULL
+);
+"""
+# число id в одном запросе к кэшу (ограничение SQLite на число параметров)
+_LOOKUP_BATCH = 500
+
+
+@contextmanager
+def _conn_context() -> sqlite3.Connection:
+    """Подключение к кэшу справочников"""
+    os.makedirs(os.path.dirname(DIM_CACHE_PATH), exist_ok=True)
+    conn = sqlite3.connect(DIM_CACHE_PATH, timeout=30)
+    try:
+        conn.executescript(DIM_CACHE_TABLES)
+        yield conn
+        conn.commit()
+    finally:
+        conn.close()
+
+
+class DimensionCache:
+    """Ограниченный LRU кэш справочника id -> name, инвалидируется по водяному знаку updated_at"""
+
+    def __init__(self, name: str, maxsize: int = DIM_CACHE_SIZE):
+        self.name = name
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        with _conn_context() as conn:
+            return conn.execute("SELECT COUNT(*) FROM dim_cache_item WHERE cache = ?", (self.name,)).fetchone()[0]
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def _put_many(self, conn: sqlite3.Connection, items: Dict[str, str]):
+        """Добавление записей с вытеснением давно не использованных"""
+        now = time.time()
+        conn.executemany(
+            "INSERT OR REPLACE INTO dim_cache_item (cache, id, name, used_at) VALUES (?, ?, ?, ?)",
+            [(self.name, key, value, now) for key, value in items.items()],
+        )
+        conn.execute(
+            """
+            DELETE FROM dim_cache_item WHERE cache = ? AND id IN (
+                SELECT id FROM dim_cache_item WHERE cache = ? ORDER BY used_at DESC LIMIT -1 OFFSET ?
+            )
+            """,
+            (self.name, self.name, self.maxsize),
+        )
+
+    def put_many(self, items: Dict[str, str]):
+        with _conn_context() as conn:
+            self._put_many(conn, items)
+
+    def refresh(self, watermark: Tuple[Any, int], load_updated: Callable[[Any], Dict[str, str]]):
+        """Сверка водяного знака (max(updated_at), count(*)) таблицы с сохраненным в кэше"""
+        max_updated_at, count = watermark
+        watermark = (None if max_updated_at is None else str(max_updated_at), count)
+        with _conn_context() as conn:
+            stored = conn.execute(
+                "SELECT max_updated_at, cnt FROM dim_cache_watermark WHERE cache = ?", (self.name,)
+            ).fetchone()
+            if stored == watermark:
+                return
+            if stored is not None and stored[0] is not None and stored[1] == count:
+                # число строк не изменилось - догружаем только обновленные записи
+                self._put_many(conn, load_updated(stored[0]))
+                logging.info("Dimension cache %s: refreshed since %s", self.name, stored[0])
+            else:
+                # без прогрева: записи догружаются по id, которые нужны chunk
+                conn.execute("DELETE FROM dim_cache_item WHERE cache = ?", (self.name,))
+                logging.info("Dimension cache %s: invalidated", self.name)
+            conn.execute(
+                "INSERT OR REPLACE INTO dim_cache_watermark (cache, max_updated_at, cnt) VALUES (?, ?, ?)",
+                (self.name, *watermark),
+            )
+
+    def get_many(self, ids: Iterable[str], load_by_ids: Callable[[List[str]], Dict[str, str]]) -> Dict[str, str]:
+        """Получение значений по id, промахи догружаются из источника одним запросом"""
+        ids = list(set(ids))
+        result = {}
+        with _conn_context() as conn:
+            for start in range(0, len(ids), _LOOKUP_BATCH):
+                batch = ids[start:start + _LOOKUP_BATCH]
+                placeholders = ", ".join("?" * len(batch))
+                rows = conn.execute(
+                    f"SELECT id, name FROM dim_cache_item WHERE cache = ? AND id IN ({placeholders})",
+                    (self.name, *batch),
+                ).fetchall()
+                result.update(rows)
+                conn.execute(
+                    f"UPDATE dim_cache_item SET used_at = ? WHERE cache = ? AND id IN ({placeholders})",
+                    (time.time(), self.name, *batch),
+                )
+
+            hits = len(result)
+            missing = [key for key in ids if key not in result]
+            self.hits += hits
+            self.misses += len(missing)
+            if missing:
+                loaded = load_by_ids(missing)
+                self._put_many(conn, loaded)
+                result.update(loaded)
+            size = conn.execute("SELECT COUNT(*) FROM dim_cache_item WHERE cache = ?", (self.name,)).fetchone()[0]
+
+        Stats.incr(f"movies_etl.dim_cache.{self.name}.hits", hits)
+        Stats.incr(f"movies_etl.dim_cache.{self.name}.misses", len(missing))
+        Stats.gauge(f"movies_etl.dim_cache.{self.name}.hit_rate", self.hit_rate)
+        logging.info(
+            "Dimension cache %s: size=%s hits=%s misses=%s hit_rate=%.2f",
+            self.name, size, self.hits, self.misses, self.hit_rate,
+        )
+        return result
+
+
+def get_cache(conn_id: str, table: str) -> DimensionCache:
+    """Кэш справочника table для подключения conn_id"""
+    return DimensionCache(f"{conn_id}.{table}")
+
+
+def build_films_nested(
+        films: List[Dict],
+        fields: List[str],
+        person_links: List[Tuple[str, str, str]],
+        genre_links: List[Tuple[str, str]],
+        persons: Dict[str, str],
+        genres: Dict[str, str],
+) -> List[Dict]:
+    """Сборка actors/writers/directors/genre фильмов из связей и справочников"""
+    requested = {DBFields[field].value for field in fields}
+    nested = {film["id"]: {} for film in films}
+
+    for film_id, person_id, role in person_links:
+        column = PERSON_ROLES.get(role)
+        if column in requested and film_id in nested:
+            nested[film_id].setdefault(column, []).append({"id": person_id, "full_name": persons.get(person_id)})
+    if DBFields.genre.value in requested:
+        for film_id, genre_id in genre_links:
+            if film_id in nested:
+                nested[film_id].setdefault(DBFields.genre.value, []).append(
+                    {"id": genre_id, "name": genres.get(genre_id)}
+                )
+
+    result = []
+    for film in films:
+        film_data = {}
+        for field in fields:
+            column = DBFields[field].value
+            if column in NESTED_COLUMNS:
+                # null для пустых списков - как в JSON_AGG ... FILTER
+                film_data[column] = nested[film["id"]].get(column)
+            else:
+                film_data[column] = film.get(column)
+        result.append(film_data)
+    return result
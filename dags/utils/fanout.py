@@ -0,0 +1,73 @@
+from typing import Callable, Dict, Optional
+import functools
+import logging
+
+from airflow.hooks.base_hook import BaseHook
+from airflow.models.taskinstance import TaskInstance
+from airflow.exceptions import AirflowException
+
+from settings import MOVIES_UPDATED_STATE_KEY_TMP
+from utils.state import get_out_db_ids, get_sink_state, is_past, set_updated_state
+
+
+def get_out_db_params(params: Dict, out_db_id: str) -> Optional[Dict]:
+    """Параметры приемника: при нескольких приемниках out_db_params - словарь по out_db_id"""
+    out_db_params = params["out_db_params"]
+    if len(get_out_db_ids(params)) > 1:
+        return (out_db_params or {}).get(out_db_id)
+    return out_db_params
+
+
+def get_sinks(params: Dict) -> Dict[str, str]:
+    """Приемники по типу подключения: conn_type -> out_db_id"""
+    sinks = {}
+    for out_db_id in get_out_db_ids(params):
+        conn_type = BaseHook.get_connection(out_db_id).conn_type
+        if conn_type in sinks:
+            raise AirflowException(
+                f"Sinks {sinks[conn_type]} and {out_db_id} have the same connection type {conn_type}"
+            )
+        sinks[conn_type] = out_db_id
+    return sinks
+
+
+def sink_context(conn_type: str, **context) -> Dict:
+    """Контекст задачи с out_db_id/out_db_params одного приемника"""
+    params = context["params"]
+    out_db_id = get_sinks(params)[conn_type]
+    sink_params = {**params, "out_db_id": out_db_id, "out_db_params": get_out_db_params(params, out_db_id)}
+    return {**context, "params": sink_params}
+
+
+def for_sink(conn_type: str, commit_state: bool = False) -> Callable:
+    """Обертка задачи приемника; commit_state - сдвиг контрольной точки приемника после записи"""
+
+    def decorator(func: Callable) -> Callable:
+        @functools.wraps(func)
+        def wrapper(ti: TaskInstance, **context):
+            context = sink_context(conn_type, **context)
+            out_db_id = context["params"]["out_db_id"]
+            # окно читается от самого отстающего приемника; приемник, уже прошедший окно, его не пишет.
+            # Контрольные точки - с точностью до секунды, а чтение идет с updated_at >= state: в секунде конца
+            # окна могут быть строки, которые приемник не записал, поэтому пропуск - только если он строго позже
+            state = ti.xcom_pull(key=MOVIES_UPDATED_STATE_KEY_TMP)
+            sink_state = get_sink_state(out_db_id, **context) if state else None
+            if is_past(sink_state, state):
+                logging.info(
+                    "Sink %s is already at %s, past the window up to %s, skipping", out_db_id, sink_state, state
+                )
+                return None
+            result = func(ti, **context)
+            if commit_state:
+                # каждый приемник двигает свою контрольную точку, не дожидаясь остальных
+                if state:
+                    set_updated_state(state, **context)
+                else:
+                    logging.info("No state to commit for sink %s", out_db_id)
+            return result
+
+        # measured складывает длительности приемника отдельно: приемники работают параллельно
+        wrapper.sink = conn_type
+        return wrapper
+
+    return decorator
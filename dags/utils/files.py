@@ -0,0 +1,26 @@
+from contextlib import contextmanager
+import os
+import tempfile
+
+
+@contextmanager
+def atomic_path(path: str) -> str:
+    """Запись через временный файл в том же каталоге с атомарным переименованием"""
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    # префикс "." - временные файлы не видны читателям датасета (pyarrow, spark)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".", suffix=".tmp")
+    os.close(fd)
+    try:
+        yield tmp_path
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def atomic_write(path: str, data: bytes):
+    """Атомарная запись байтов в файл"""
+    with atomic_path(path) as tmp_path:
+        with open(tmp_path, "wb") as file:
+            file.write(data)
@@ -0,0 +1,139 @@
+from typing import Any, Callable, Dict, List, Tuple
+from contextlib import contextmanager
+import logging
+import os
+import sqlite3
+import time
+
+from settings import LEASE_PATH, LEASE_TTL_SECONDS
+from utils.state import get_out_db_ids
+
+# минимальный id ключа (updated_at, id) для окна от контрольной точки
+LEASE_MIN_ID = "00000000-0000-0000-0000-000000000000"
+
+# границы окон без объявленного типа - значения хранятся в формате источника
+WINDOW_LEASE_TABLE = """
+CREATE TABLE IF NOT EXISTS window_lease (
+    pair TEXT NOT NULL,
+    run_id TEXT NOT NULL,
+    lower_ts,
+    lower_id TEXT NOT NULL,
+    upper_ts,
+    upper_id TEXT NOT NULL,
+    done INTEGER NOT NULL DEFAULT 0,
+    expires_at REAL NOT NULL,
+    PRIMARY KEY (pair, upper_ts, upper_id)
+);
+"""
+
+Keyset = Tuple[Any, str]
+
+
+@contextmanager
+def _conn_context() -> sqlite3.Connection:
+    """Подключение к таблице аренды окон (транзакции управляются явно)"""
+    os.makedirs(os.path.dirname(LEASE_PATH), exist_ok=True)
+    conn = sqlite3.connect(LEASE_PATH, timeout=30, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    try:
+        conn.execute(WINDOW_LEASE_TABLE)
+        yield conn
+    finally:
+        conn.close()
+
+
+def _pair(**context) -> str:
+    """Пара источник/приемники, для которой выдаются окна"""
+    params = context["params"]
+    return f"{params['in_db_id']}__{'__'.join(get_out_db_ids(params))}"
+
+
+def is_leasing(**context) -> bool:
+    return bool(context["params"].get("window_leasing"))
+
+
+def claim_window(
+        fetch_next: Callable[[Keyset], List[Dict]],
+        fetch_range: Callable[[Keyset, Keyset], List[Dict]],
+        checkpoint: Keyset,
+        **context,
+) -> List[Dict]:
+    """Захват окна (updated_at, id) запуском: своего, просроченного чужого или следующего за последним"""
+    pair, run_id = _pair(**context), context["run_id"]
+    ttl = context["params"].get("lease_ttl_seconds") or LEASE_TTL_SECONDS
+    now = time.time()
+    upper = None
+
+    with _conn_context() as conn:
+        # BEGIN IMMEDIATE - запуски захватывают окна по очереди
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            lease = conn.execute(
+                "SELECT * FROM window_lease WHERE pair = ? AND run_id = ? AND done = 0",
+                (pair, run_id),
+            ).fetchone()
+            if lease is None:
+                lease = conn.execute(
+                    """
+                    SELECT * FROM window_lease WHERE pair = ? AND done = 0 AND expires_at < ?
+                    ORDER BY lower_ts, lower_id LIMIT 1
+                    """,
+                    (pair, now),
+                ).fetchone()
+                if lease is not None:
+                    logging.info("Reclaiming expired lease of run %s", lease["run_id"])
+
+            if lease is not None:
+                conn.execute(
+                    "UPDATE window_lease SET run_id = ?, expires_at = ? "
+                    "WHERE pair = ? AND upper_ts = ? AND upper_id = ?",
+                    (run_id, now + ttl, pair, lease["upper_ts"], lease["upper_id"]),
+                )
+                lower, upper = (lease["lower_ts"], lease["lower_id"]), (lease["upper_ts"], lease["upper_id"])
+                rows = fetch_range(lower, upper)
+            else:
+                last = conn.execute(
+                    "SELECT upper_ts, upper_id FROM window_lease WHERE pair = ? "
+                    "ORDER BY upper_ts DESC, upper_id DESC LIMIT 1",
+                    (pair,),
+                ).fetchone()
+                lower = (last["upper_ts"], last["upper_id"]) if last else checkpoint
+                rows = fetch_next(lower)
+                if rows:
+                    upper = (str(rows[-1]["updated_at"]), str(rows[-1]["id"]))
+                    conn.execute(
+                        """
+                        INSERT INTO window_lease (pair, run_id, lower_ts, lower_id, upper_ts, upper_id, expires_at)
+                        VALUES (?, ?, ?, ?, ?, ?, ?)
+                        """,
+                        (pair, run_id, *lower, *upper, now + ttl),
+                    )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    logging.info("Run %s leased window (%s, %s] with %s movies", run_id, lower, upper, len(rows))
+    return rows
+
+
+def complete_window(**context):
+    """Закрытие окна запуска; из закрытых окон хранится только последнее - граница следующего"""
+    pair = _pair(**context)
+    with _conn_context() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute(
+            "UPDATE window_lease SET done = 1 WHERE pair = ? AND run_id = ?",
+            (pair, context["run_id"]),
+        )
+        conn.execute(
+            """
+            DELETE FROM window_lease
+            WHERE pair = ? AND done = 1 AND (upper_ts, upper_id) < (
+                SELECT upper_ts, upper_id FROM window_lease WHERE pair = ?
+                ORDER BY upper_ts DESC, upper_id DESC LIMIT 1
+            );
+            """,
+            (pair, pair),
+        )
+        conn.execute("COMMIT")
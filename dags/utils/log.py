@@ -0,0 +1,77 @@
+from typing import Any
+import itertools
+import json
+import logging
+import os
+import re
+
+from settings import LOG_SAMPLE_ROWS, LOG_MAX_FIELD_CHARS, LOG_PAYLOAD_DIR
+from utils.files import atomic_write
+
+
+def _truncate(value: Any, max_chars: int) -> Any:
+    """Обрезка длинных значений выборки"""
+    if isinstance(value, (bytes, bytearray)):
+        value = value.decode("utf-8", errors="replace")
+    if isinstance(value, str) and len(value) > max_chars:
+        return f"{value[:max_chars]}...(+{len(value) - max_chars} chars)"
+    if isinstance(value, tuple):
+        # строка значений - обрезаются только сами значения
+        return tuple(_truncate(item, max_chars) for item in value)
+    if isinstance(value, list):
+        items = [_truncate(item, max_chars) for item in value[:LOG_SAMPLE_ROWS]]
+        if len(value) > LOG_SAMPLE_ROWS:
+            items.append(f"...(+{len(value) - LOG_SAMPLE_ROWS})")
+        return items
+    if isinstance(value, dict):
+        return {k: _truncate(v, max_chars) for k, v in value.items()}
+    return value
+
+
+class Summary:
+    """Описание данных для лога: число записей, размер и ограниченная выборка (строится при форматировании)"""
+
+    def __init__(self, data: Any, sample: int = LOG_SAMPLE_ROWS, max_chars: int = LOG_MAX_FIELD_CHARS):
+        self.data = data
+        self.sample = sample
+        self.max_chars = max_chars
+
+    def __str__(self) -> str:
+        data = self.data
+        if data is None:
+            return "None"
+        if isinstance(data, (str, bytes, bytearray)):
+            size = len(data.encode("utf-8")) if isinstance(data, str) else len(data)
+            return f"{size} bytes: {_truncate(data, self.max_chars)!r}"
+        if isinstance(data, dict):
+            sample = dict(itertools.islice(data.items(), self.sample))
+            return f"{len(data)} keys, sample={_truncate(sample, self.max_chars)}"
+        try:
+            count = len(data)
+        except TypeError:
+            return repr(_truncate(data, self.max_chars))
+        rows = [_truncate(row, self.max_chars) for row in itertools.islice(data, self.sample)]
+        return f"{count} rows, sample={rows}"
+
+
+def summary(data: Any, sample: int = LOG_SAMPLE_ROWS) -> Summary:
+    """Ленивое описание данных: logging.info("Films: %s", summary(films_data))"""
+    return Summary(data, sample)
+
+
+def dump_payload(name: str, data: Any, **context):
+    """Полные данные в файл (отладка: параметр log_payloads или ETL_LOG_PAYLOADS=1)"""
+    if not (context.get("params", {}).get("log_payloads") or os.getenv("ETL_LOG_PAYLOADS") == "1"):
+        return
+    ti = context["task_instance"]
+    run_id = re.sub(r"[^\w.-]", "_", context["run_id"])
+    task = ti.task_id if ti.map_index < 0 else f"{ti.task_id}.{ti.map_index}"
+    path = os.path.join(LOG_PAYLOAD_DIR, ti.dag_id, run_id, f"{task}.{name}.json")
+    if isinstance(data, (bytes, bytearray)):
+        payload = bytes(data)
+    elif isinstance(data, str):
+        payload = data.encode("utf-8")
+    else:
+        payload = json.dumps(data, default=str, ensure_ascii=False, indent=4).encode("utf-8")
+    atomic_write(path, payload)
+    logging.info("Payload %s written to %s", name, path)
@@ -0,0 +1,101 @@
+from typing import Callable, List, Tuple
+import cProfile
+import functools
+import io
+import logging
+import os
+import pstats
+import re
+import tracemalloc
+
+from airflow.models.taskinstance import TaskInstance
+
+from settings import PROFILING_DIR, PROFILING_TOP_N
+
+PROFILE_OFF = "off"
+PROFILE_CPU = "cprofile"
+PROFILE_MEMORY = "tracemalloc"
+PROFILE_ALL = "all"
+PROFILE_MODES = [PROFILE_OFF, PROFILE_CPU, PROFILE_MEMORY, PROFILE_ALL]
+
+
+def _artifacts_dir(ti: TaskInstance, **context) -> str:
+    """Каталог артефактов профилирования для dag_run/task"""
+    run_id = re.sub(r"[^\w.-]", "_", context["run_id"])
+    path = os.path.join(PROFILING_DIR, ti.dag_id, run_id)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def _is_task_selected(task_id: str, **context) -> bool:
+    """Проверка, что задача выбрана для профилирования (пустой список - все задачи)"""
+    tasks = context["params"].get("profile_tasks") or []
+    return not tasks or task_id in tasks
+
+
+def _top_functions(profiler: cProfile.Profile) -> List[Tuple[str, int, float, float]]:
+    """Самые тяжелые функции по cumulative time"""
+    stats = pstats.Stats(profiler, stream=io.StringIO())
+    rows = []
+    for (filename, line, name), (_, ncalls, tottime, cumtime, _) in stats.stats.items():
+        rows.append((f"{name} ({os.path.basename(filename)}:{line})", ncalls, tottime, cumtime))
+    rows.sort(key=lambda row: row[3], reverse=True)
+    return rows[:PROFILING_TOP_N]
+
+
+def _save_cpu_report(profiler: cProfile.Profile, path: str):
+    """Сохранение pstats и краткой сводки по горячим функциям"""
+    profiler.dump_stats(path + ".pstats")
+    stream = io.StringIO()
+    pstats.Stats(profiler, stream=stream).sort_stats("cumulative").print_stats(PROFILING_TOP_N)
+    with open(path + ".cprofile.txt", "w") as report:
+        report.write(stream.getvalue())
+
+    logging.info("cProfile: pstats saved to %s.pstats", path)
+    for func, ncalls, tottime, cumtime in _top_functions(profiler):
+        logging.info("cProfile: %8.3fs cum %8.3fs tot %8d calls %s", cumtime, tottime, ncalls, func)
+
+
+def _save_memory_report(snapshot: tracemalloc.Snapshot, peak: int, path: str):
+    """Сохранение отчета tracemalloc по топу аллокаций"""
+    top_stats = snapshot.statistics("lineno")[:PROFILING_TOP_N]
+    with open(path + ".tracemalloc.txt", "w") as report:
+        report.write(f"peak: {peak} B\n")
+        for stat in top_stats:
+            report.write(f"{stat}\n")
+
+    logging.info("tracemalloc: peak allocation %.1f KiB, report saved to %s.tracemalloc.txt", peak / 1024, path)
+    for stat in top_stats[:5]:
+        logging.info("tracemalloc: %s", stat)
+
+
+def profiled(func: Callable) -> Callable:
+    """Обертка ETL callable: cProfile и/или tracemalloc по параметру DAG profile"""
+
+    @functools.wraps(func)
+    def wrapper(ti: TaskInstance, **context):
+        mode = context["params"].get("profile", PROFILE_OFF)
+        if mode == PROFILE_OFF or not _is_task_selected(ti.task_id, **context):
+            return func(ti, **context)
+
+        path = os.path.join(_artifacts_dir(ti, **context), f"{ti.task_id}.{ti.try_number}")
+        profiler = cProfile.Profile() if mode in (PROFILE_CPU, PROFILE_ALL) else None
+        trace_memory = mode in (PROFILE_MEMORY, PROFILE_ALL) and not tracemalloc.is_tracing()
+
+        if trace_memory:
+            tracemalloc.start(25)
+        if profiler:
+            profiler.enable()
+        try:
+            return func(ti, **context)
+        finally:
+            if profiler:
+                profiler.disable()
+                _save_cpu_report(profiler, path)
+            if trace_memory:
+                snapshot = tracemalloc.take_snapshot()
+                _, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+                _save_memory_report(snapshot, peak, path)
+
+    return wrapper
@@ -0,0 +1,73 @@
+from typing import Dict, List, Optional
+import logging
+
+import pendulum
+from airflow.models import Variable
+
+from settings import MOVIES_UPDATED_STATE_KEY
+
+
+def _state_key(in_db_id: str, out_db_id: str) -> str:
+    """Ключ Airflow Variable контрольной точки для пары источник/приемник"""
+    return f"{MOVIES_UPDATED_STATE_KEY}__{in_db_id}__{out_db_id}"
+
+
+def get_out_db_ids(params: Dict) -> List[str]:
+    """Список приемников: out_db_id - строка или список строк"""
+    out_db_id = params["out_db_id"]
+    return [out_db_id] if isinstance(out_db_id, str) else list(out_db_id)
+
+
+def get_updated_state(**context) -> Optional[str]:
+    """Контрольная точка инкрементальной загрузки (None - загрузка с начала)"""
+    params = context["params"]
+    states = [
+        Variable.get(_state_key(params["in_db_id"], out_db_id), default_var=None)
+        for out_db_id in get_out_db_ids(params)
+    ]
+    # при нескольких приемниках чтение идет от самого отстающего
+    return None if None in states else min(states)
+
+
+def _state_moment(value: str) -> Optional[pendulum.DateTime]:
+    """Момент контрольной точки для сравнения (форматы времени источников различаются)"""
+    try:
+        return pendulum.parse(str(value))
+    except ValueError:
+        return None
+
+
+def _compare(current: str, value: str) -> int:
+    """Сравнение контрольных точек: -1, 0 или 1"""
+    current_moment, moment = _state_moment(current), _state_moment(value)
+    if current_moment is None or moment is None:
+        current_moment, moment = str(current), str(value)
+    return (current_moment > moment) - (current_moment < moment)
+
+
+def is_reached(current: Optional[str], value: str) -> bool:
+    """Контрольная точка current уже не раньше value"""
+    return current is not None and _compare(current, value) >= 0
+
+
+def is_past(current: Optional[str], value: str) -> bool:
+    """Контрольная точка current строго позже value"""
+    return current is not None and _compare(current, value) > 0
+
+
+def get_sink_state(out_db_id: str, **context) -> Optional[str]:
+    """Контрольная точка одного приемника"""
+    return Variable.get(_state_key(context["params"]["in_db_id"], out_db_id), default_var=None)
+
+
+def set_updated_state(value: str, **context):
+    """Сохранение контрольной точки инкрементальной загрузки (контрольная точка не двигается назад)"""
+    params = context["params"]
+    for out_db_id in get_out_db_ids(params):
+        key = _state_key(params["in_db_id"], out_db_id)
+        current = Variable.get(key, default_var=None)
+        if is_reached(current, value):
+            logging.info("Movies updated state %s is already %s, not moving it to %s", key, current, value)
+            continue
+        Variable.set(key, value)
+        logging.info("Movies updated state %s: %s", key, value)
@@ -1,4 +1,4 @@
-from typing import List, Dict
+from typing import List, Dict, Union
 
 
 # def get_person_json(person_ids: List[str], person_names: List[str]) -> List[Dict[str, str]]:
@@ -26,3 +26,26 @@ def get_genres(genres: Dict[str, str]) -> List[str]:
         return []
 
     return [genre["name"] for genre in genres]
+
+
+def get_person_list(persons: Union[List[Dict[str, str]], str, None]) -> List[Dict[str, str]]:
+    """Формирование данных по персонам в виде [{id: ..., full_name: ...}]"""
+    if not persons:
+        return []
+    if isinstance(persons, str):
+        # SQLite отдает персон строкой вида "id : full_name, id : full_name"
+        result = []
+        for person in persons.split(", "):
+            person_id, _, full_name = person.partition(" : ")
+            result.append({"id": person_id, "full_name": full_name})
+        return result
+    return [{"id": person.get("id"), "full_name": person.get("full_name")} for person in persons if person]
+
+
+def get_genre_list(genres: Union[List[Dict[str, str]], str, None]) -> List[Dict[str, str]]:
+    """Формирование данных по жанрам в виде [{id: ..., name: ...}]"""
+    if not genres:
+        return []
+    if isinstance(genres, str):
+        return [{"id": None, "name": name} for name in genres.split(", ")]
+    return [{"id": genre.get("id"), "name": genre.get("name")} for genre in genres if genre]